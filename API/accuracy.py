@@ -0,0 +1,302 @@
+"""GPS accuracy threshold tuning from the in-app "was this right?" feedback.
+
+Each app_accuracy row says whether the indoor/outdoor answer shown to the
+user was right. Joined with the final_table row that answer came from, that
+gives a labelled sample: the reported GPS accuracy and whether the user was
+really outside. From those we compute precision and recall of "outside"
+for every candidate threshold at once (sort + cumulative sums) and suggest
+the one with the best F1, for everyone and for each user with enough
+feedback of their own.
+
+``python accuracy.py report`` prints the analysis; ``python accuracy.py
+tune`` also writes the suggestions to gps_accuracy_thresholds, which every
+API process keeps in memory through ThresholdCache.
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+# Key of the threshold that applies to users without one of their own
+GLOBAL_KEY = '*'
+# Upper bucket edges in metres; the last bucket is open-ended
+ACCURACY_BUCKETS = (5, 10, 15, 20, 30, 50, 100)
+CANDIDATE_THRESHOLDS = np.arange(3.0, 51.0, 1.0)
+MIN_GLOBAL_SAMPLES = 100
+MIN_USER_SAMPLES = 30
+
+# Each feedback row with the answer it was about: the user's latest
+# final_table row at or before it, no older than the gap that still counts as
+# the same stretch. Feedback sent while on Wi-Fi is left out, since the
+# threshold didn't decide those answers.
+ACCURACY_SAMPLES_SQL = """
+    SELECT a.user_id, COALESCE(f.gps_accuracy, a.gps_accuracy), a.correct_result, f."outside?"
+    FROM app_accuracy a
+    CROSS JOIN LATERAL (
+        SELECT f.gps_accuracy, f."outside?"
+        FROM final_table f
+        WHERE f.user_id = a.user_id
+          AND f.time <= a.time AND f.time > a.time - make_interval(secs => %s)
+        ORDER BY f.time DESC
+        LIMIT 1
+    ) f
+    WHERE a.time >= %s
+      AND a.gps_accuracy IS NOT NULL
+      AND a.is_connected_to_wifi IS NOT TRUE
+"""
+
+THRESHOLDS_UPSERT_SQL = """
+    INSERT INTO gps_accuracy_thresholds (user_id, threshold, samples, precision, recall)
+    VALUES %s
+    ON CONFLICT (user_id) DO UPDATE SET
+        threshold = EXCLUDED.threshold,
+        samples = EXCLUDED.samples,
+        precision = EXCLUDED.precision,
+        recall = EXCLUDED.recall,
+        updated_at = now()
+"""
+
+
+class Samples(NamedTuple):
+    user_ids: np.ndarray  # object
+    accuracy: np.ndarray  # float, metres
+    outside: np.ndarray  # bool, whether the user was really outside
+
+
+class Suggestion(NamedTuple):
+    threshold: float
+    samples: int
+    precision: Optional[float]
+    recall: Optional[float]
+
+
+def read_samples(cur, since: date, max_gap: float) -> Samples:
+    cur.execute(ACCURACY_SAMPLES_SQL, (max_gap, since))
+    rows = cur.fetchall()
+    if not rows:
+        return Samples(np.array([], dtype=object), np.array([]), np.array([], dtype=bool))
+    user_ids, accuracy, correct, predicted = zip(*rows)
+    correct = np.array(correct, dtype=bool)
+    predicted = np.array(predicted, dtype=bool)
+    # A wrong answer means the truth was the other one
+    return Samples(np.array(user_ids, dtype=object), np.array(accuracy, dtype=float),
+                   predicted == correct)
+
+
+def threshold_curve(accuracy: np.ndarray, outside: np.ndarray,
+                    thresholds: np.ndarray = CANDIDATE_THRESHOLDS) -> Dict[str, np.ndarray]:
+    """Precision, recall and F1 of "outside when accuracy <= t" for every t."""
+    order = np.argsort(accuracy, kind='stable')
+    sorted_accuracy = accuracy[order]
+    outside_so_far = np.concatenate(([0], np.cumsum(outside[order])))
+    predicted = np.searchsorted(sorted_accuracy, thresholds, side='right')
+    true_positives = outside_so_far[predicted]
+    total_outside = outside_so_far[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, true_positives / predicted, np.nan)
+        recall = np.where(total_outside > 0, true_positives / max(total_outside, 1), np.nan)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return {"thresholds": thresholds, "predicted_outside": predicted,
+            "precision": precision, "recall": recall, "f1": np.nan_to_num(f1)}
+
+
+def bucket_stats(accuracy: np.ndarray, outside: np.ndarray) -> List[Dict[str, Any]]:
+    """How often users in each accuracy band were really outside."""
+    edges = np.asarray(ACCURACY_BUCKETS, dtype=float)
+    index = np.searchsorted(edges, accuracy, side='left')
+    counts = np.bincount(index, minlength=len(edges) + 1)
+    outside_counts = np.bincount(index, weights=outside, minlength=len(edges) + 1)
+    total_outside = max(outside_counts.sum(), 1)
+
+    buckets = []
+    lower = 0.0
+    for i, count in enumerate(counts):
+        upper = edges[i] if i < len(edges) else None
+        buckets.append({
+            "range": f"{lower:g}-{upper:g}" if upper is not None else f">{lower:g}",
+            "samples": int(count),
+            "outside_share": _round(outside_counts[i] / count) if count else None,
+            "share_of_outside": _round(outside_counts[i] / total_outside),
+        })
+        lower = upper
+    return buckets
+
+
+def _round(value: Any) -> Optional[float]:
+    return None if value is None or np.isnan(value) else round(float(value), 3)
+
+
+def suggest_threshold(accuracy: np.ndarray, outside: np.ndarray, min_samples: int,
+                      default: float) -> Suggestion:
+    """The candidate threshold with the best F1, or ``default`` with too little data."""
+    if len(accuracy) < min_samples or not outside.any() or outside.all():
+        return Suggestion(default, len(accuracy), None, None)
+    curve = threshold_curve(accuracy, outside)
+    # argmax takes the first best, i.e. the strictest threshold among ties
+    best = int(np.argmax(curve['f1']))
+    return Suggestion(float(curve['thresholds'][best]), len(accuracy),
+                      _round(curve['precision'][best]), _round(curve['recall'][best]))
+
+
+def tune(samples: Samples, default: float, min_global: int = MIN_GLOBAL_SAMPLES,
+         min_user: int = MIN_USER_SAMPLES) -> Dict[str, Suggestion]:
+    """Suggested thresholds for everyone (GLOBAL_KEY) and for users with enough feedback."""
+    overall = suggest_threshold(samples.accuracy, samples.outside, min_global, default)
+    tuned = {GLOBAL_KEY: overall}
+    if not len(samples.user_ids):
+        return tuned
+    users, index = np.unique(samples.user_ids, return_inverse=True)
+    counts = np.bincount(index)
+    for u in np.flatnonzero(counts >= min_user):
+        mask = index == u
+        suggestion = suggest_threshold(samples.accuracy[mask], samples.outside[mask],
+                                       min_user, overall.threshold)
+        if suggestion.precision is not None:
+            tuned[str(users[u])] = suggestion
+    return tuned
+
+
+def report(samples: Samples, current: float, tuned: Dict[str, Suggestion]) -> Dict[str, Any]:
+    curve = threshold_curve(samples.accuracy, samples.outside,
+                            np.unique(np.append(CANDIDATE_THRESHOLDS, current)))
+    at_current = int(np.searchsorted(curve['thresholds'], current))
+    overall = tuned[GLOBAL_KEY]
+    return {
+        "samples": int(len(samples.accuracy)),
+        "users": int(len(np.unique(samples.user_ids))),
+        "outside_share": _round(samples.outside.mean()) if len(samples.outside) else None,
+        "buckets": bucket_stats(samples.accuracy, samples.outside),
+        "current": {
+            "threshold": current,
+            "precision": _round(curve['precision'][at_current]),
+            "recall": _round(curve['recall'][at_current]),
+        },
+        "suggested": overall._asdict(),
+        "users_tuned": len(tuned) - 1,
+        "curve": [
+            {"threshold": float(t), "precision": _round(p), "recall": _round(r), "f1": _round(f)}
+            for t, p, r, f in zip(curve['thresholds'], curve['precision'],
+                                  curve['recall'], curve['f1'])
+        ],
+    }
+
+
+def analyse(cur, days: int, max_gap: float, current: float) -> Tuple[Dict[str, Suggestion], Dict[str, Any]]:
+    samples = read_samples(cur, date.today() - timedelta(days=days), max_gap)
+    tuned = tune(samples, current)
+    return tuned, report(samples, current, tuned)
+
+
+def save_thresholds(cur, tuned: Dict[str, Suggestion]) -> int:
+    """Upsert the suggestions that are backed by enough feedback."""
+    rows = [(user_id, s.threshold, s.samples, s.precision, s.recall)
+            for user_id, s in tuned.items() if s.precision is not None]
+    if rows:
+        execute_values(cur, THRESHOLDS_UPSERT_SQL, rows)
+    return len(rows)
+
+
+class ThresholdCache:
+    """Tuned thresholds held in memory, so check_location never queries for them.
+
+    The table is reloaded in a background thread at most every ``ttl``
+    seconds, triggered by a lookup; until the first load finishes, and for
+    users without a tuned threshold, the global one (or ``default``) applies.
+    """
+
+    def __init__(self, get_conn: Callable, release_conn: Callable, default: float,
+                 ttl: float = 600.0):
+        self._get_conn = get_conn
+        self._release_conn = release_conn
+        self.default = default
+        self.ttl = ttl
+        self._thresholds: Dict[str, float] = {}
+        self._loaded_at: Optional[float] = None
+        self._next_load = 0.0
+        self._lock = threading.Lock()
+        self._loads = 0
+        self._failed_loads = 0
+
+    def get(self, user_id: str) -> float:
+        if time.monotonic() >= self._next_load:
+            self._start_reload()
+        thresholds = self._thresholds
+        return thresholds.get(user_id, thresholds.get(GLOBAL_KEY, self.default))
+
+    def _start_reload(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_load:
+                return
+            # Claim the slot so concurrent lookups don't start loads of their own
+            self._next_load = now + self.ttl
+        threading.Thread(target=self.reload, name='gps-threshold-reload', daemon=True).start()
+
+    def reload(self) -> None:
+        conn = None
+        try:
+            conn = self._get_conn()
+            cur = conn.cursor()
+            cur.execute("SELECT user_id, threshold FROM gps_accuracy_thresholds")
+            thresholds = {user_id: float(threshold) for user_id, threshold in cur.fetchall()}
+            conn.rollback()
+        except Exception as e:
+            print(f"Error loading GPS accuracy thresholds: {str(e)}")
+            with self._lock:
+                self._failed_loads += 1
+            return
+        finally:
+            if conn is not None:
+                self._release_conn(conn)
+        with self._lock:
+            # Swapped whole, so lookups never see a half-loaded dict
+            self._thresholds = thresholds
+            self._loaded_at = time.monotonic()
+            self._loads += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "default": self.default,
+                "global": self._thresholds.get(GLOBAL_KEY),
+                "users": len(self._thresholds) - (GLOBAL_KEY in self._thresholds),
+                "loads": self._loads,
+                "failed_loads": self._failed_loads,
+                "age_seconds": round(time.monotonic() - self._loaded_at, 1)
+                if self._loaded_at is not None else None,
+            }
+
+
+def main() -> None:
+    from app import DB_CONFIG, GPS_ACCURACY_THRESHOLD, MAX_TIME_BETWEEN_UPDATES
+
+    parser = argparse.ArgumentParser(description="Tune the GPS accuracy threshold from feedback")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('report', "print precision/recall by accuracy and threshold"),
+                            ('tune', "write suggested thresholds to gps_accuracy_thresholds")):
+        command = subparsers.add_parser(name, help=help_text)
+        command.add_argument('--days', type=int, default=90, help="feedback from the last N days")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        cur = conn.cursor()
+        tuned, summary = analyse(cur, args.days, MAX_TIME_BETWEEN_UPDATES, GPS_ACCURACY_THRESHOLD)
+        if args.command == 'tune':
+            written = save_thresholds(cur, tuned)
+            conn.commit()
+            summary = {**summary, "thresholds_written": written}
+        print(json.dumps(summary, indent=2))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
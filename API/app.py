@@ -1,19 +1,41 @@
-from flask import Flask, request, jsonify
-from matplotlib.patches import Arc
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
-from io import BytesIO
+from flask import Flask, Response, g, request, jsonify
+import atexit
 import base64
-from datetime import datetime, time, timedelta, date
-import psycopg2
+import hashlib
+import math
+import os
+import threading
+from time import perf_counter
+from functools import lru_cache
+from datetime import datetime, time, timedelta, timezone, date
 from typing import Dict, Any, Tuple, List, Optional
-from matplotlib import patheffects
+from db import ConnectionPool
+from render_cache import RenderCache, time_bucket
+from render_pool import RenderPool, RenderUnavailable
+from user_state import LATEST_STATE_SQL, USER_XACT_LOCK_SQL, LastState, LocalStateStore, RedisStateStore
+from accuracy import ThresholdCache, analyse
+from ingest_buffer import IngestBuffer, insert_final_rows
+from late_samples import MergeResult, merge_late_samples
+from daily_summary import read_daily_summary, upsert_daily_summary
+from export import EXPORT_FORMATS, export_filename, parse_export_request, stream_export
+from http_cache import (add_vary, chart_etag, choose_encoding, compress, etag_matches,
+                        should_compress)
+from outdoor_time import fetch_outdoor_intervals, total_seconds
+from segments import Segment, build_segments
+from lux import estimate_lux
+from metrics import (SlowRequestProfiler, TimedCursor, current_route, render_prometheus,
+                     request_seconds, span)
+from weather import Conditions, WeatherCache, make_provider
+from solar import LOCATION_DECIMALS, SUNRISE_ELEVATION, default_utc_offset, sun_elevation, sun_times
 
 app = Flask(__name__)
 
-GPS_ACCURACY_THRESHOLD = 10
+GPS_ACCURACY_THRESHOLD = 10  # metres; the fallback when no tuned threshold applies
+MAX_TIME_BETWEEN_UPDATES = 600  # 10 minutes in seconds
+MAX_BATCH_SAMPLES = 2016  # a week of 5-minute pings
+# Pings that carry a position are only recorded while the sun is at least
+# this high (degrees); the default matches sunrise/sunset, 0 or 6 skip twilight
+DAYTIME_MIN_ELEVATION = SUNRISE_ELEVATION
 
 # Database configuration
 DB_CONFIG = {
@@ -23,8 +45,227 @@ DB_CONFIG = {
     "password": "FullMetal42"
 }
 
+# Connection pool sizing; each worker process holds its own pool
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+DB_POOL_TIMEOUT = 5.0  # seconds to wait for a free connection
+
+# TimedCursor records every statement as a db_query span for /metrics
+db_pool = ConnectionPool({**DB_CONFIG, "cursor_factory": TimedCursor}, min_size=DB_POOL_MIN_SIZE,
+                         max_size=DB_POOL_MAX_SIZE, timeout=DB_POOL_TIMEOUT)
+
+# Rendered chart images, keyed by the state of the user's day (see
+# daily_cache_key and weekly_cache_key)
+RENDER_CACHE_MAX_ENTRIES = 512
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RENDER_CACHE_TIME_BUCKET = 300  # seconds; how far the current-time dot may lag
+
+render_cache = RenderCache(max_entries=RENDER_CACHE_MAX_ENTRIES,
+                           max_bytes=RENDER_CACHE_MAX_BYTES)
+
+# Chart output negotiation. The widths are those of the tight-cropped
+# figures in inches and are used to turn a requested pixel width into a dpi
+CHART_MIME_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'svg': 'image/svg+xml',
+}
+MIN_CHART_DPI = 30
+DAILY_CHART_DPI = 250
+DAILY_CHART_WIDTH_INCHES = 15.7
+WEEKLY_CHART_DPI = 120
+WEEKLY_CHART_WIDTH_INCHES = 9.65
+
+# Ranges served by /weekly-time-outside-graph, read from daily_summary.
+# 'year' is drawn as one bar per calendar month
+CHART_RANGE_DAYS = {
+    'week': 7,
+    'month': 30,
+    'year': 365,
+}
+
+# Static daily-chart layers (arc, hour markers, headings) are drawn once per
+# sunrise/sunset pair and reused; each one holds two full-size RGBA canvases
+DAILY_CHART_MAX_STATIC_LAYERS = 8
+
+# Charts render in separate processes so they can't starve /check-location.
+# Set RENDER_WORKERS to 0 to render inline on the request thread instead
+RENDER_WORKERS = 2
+RENDER_MAX_PENDING = 8  # queued + running renders before we answer 503
+RENDER_TIMEOUT = 30.0  # seconds
+RENDER_RETRY_AFTER = 5  # seconds, sent in the Retry-After header
+
+RENDER_WARM_UP = True  # start workers (matplotlib, fonts) when the server starts
+
+render_pool = RenderPool(workers=RENDER_WORKERS, max_pending=RENDER_MAX_PENDING,
+                         timeout=RENDER_TIMEOUT, retry_after=RENDER_RETRY_AFTER,
+                         daily_dpi=DAILY_CHART_DPI,
+                         max_static_layers=DAILY_CHART_MAX_STATIC_LAYERS)
+
+# Pre-render active users' charts into render_cache during the usual bursts
+# (windows in each user's local time) and at their sunset; see pregenerate.py
+PREGENERATE_CHARTS = True
+PREGENERATE_WINDOWS = (('06:30', '09:30'), ('12:00', '13:30'))
+PREGENERATE_ACTIVE_DAYS = 7  # users with a ping this recently
+PREGENERATE_CONCURRENCY = 1  # renders in flight; keep below RENDER_MAX_PENDING
+
+def warm_up_renderers() -> None:
+    """Get the render workers ready in the background. Call it from the
+    server's startup hook (asgi.py's lifespan, or gunicorn's
+    post_worker_init), not at import, so tooling that imports the app never
+    loads matplotlib."""
+    if not RENDER_WARM_UP:
+        return
+
+    def run() -> None:
+        try:
+            render_pool.warm_up()
+        except Exception as e:
+            print(f"Render warm-up failed: {str(e)}")
+
+    threading.Thread(target=run, name='render-warm-up', daemon=True).start()
+
+def start_pregeneration() -> None:
+    """Start the chart pre-generation schedule. Like warm_up_renderers, call
+    it from the server's startup hook; the render cache is per process, so
+    every process that serves charts runs its own."""
+    if PREGENERATE_CHARTS:
+        from pregenerate import pregenerator
+        pregenerator.start()
+
+# Last row per user, so /check-location doesn't have to read final_table on
+# every ping. Without USER_STATE_REDIS_URL it lives in the process, which
+# then must be the only one serving pings: a second one is refused through
+# USER_STATE_OWNER_LOCK. Point it at a Redis server to run several workers
+USER_STATE_REDIS_URL = None
+USER_STATE_MAX_USERS = 100000
+USER_STATE_OWNER_LOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_state.lock')
+
+if USER_STATE_REDIS_URL:
+    user_state_store = RedisStateStore(USER_STATE_REDIS_URL)
+else:
+    user_state_store = LocalStateStore(max_users=USER_STATE_MAX_USERS,
+                                       owner_lock=USER_STATE_OWNER_LOCK)
+
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    with span('db_connect'):
+        return db_pool.getconn()
+
+def release_db_connection(conn) -> None:
+    db_pool.putconn(conn)
+
+# GPS thresholds tuned from the in-app feedback by ``python accuracy.py tune``,
+# per user where there's enough of it, kept in memory and reloaded every
+# GPS_THRESHOLDS_REFRESH seconds. False always uses GPS_ACCURACY_THRESHOLD
+GPS_THRESHOLDS_TUNED = True
+GPS_THRESHOLDS_REFRESH = 600
+ACCURACY_ANALYTICS_DAYS = 90  # default feedback window for /accuracy-analytics
+
+gps_thresholds = ThresholdCache(get_db_connection, release_db_connection,
+                                GPS_ACCURACY_THRESHOLD, ttl=GPS_THRESHOLDS_REFRESH)
+
+def gps_threshold(user_id: str) -> float:
+    return gps_thresholds.get(user_id) if GPS_THRESHOLDS_TUNED else GPS_ACCURACY_THRESHOLD
+
+# Weather for pings sent without it, looked up here and cached per geohash
+# cell (precision 5 is ~4.9 km square) so nearby users share one lookup; see
+# weather.py. 'weatherapi' needs WEATHER_API_KEY, 'stub' makes conditions up
+# for local testing, None turns lookups off and such pings say 'Unknown'
+WEATHER_API_KEY = os.environ.get('WEATHER_API_KEY')
+WEATHER_PROVIDER = 'weatherapi' if WEATHER_API_KEY else None
+WEATHER_GEOHASH_PRECISION = 5
+WEATHER_CACHE_TTL = 600  # seconds
+WEATHER_ERROR_TTL = 60  # seconds before a failed lookup is retried
+WEATHER_STALE_TTL = 3600  # how long past expiry a cell's last answer covers for failures
+WEATHER_CACHE_MAX_CELLS = 50000
+WEATHER_TIMEOUT = 3.0
+WEATHER_MAX_SAMPLE_AGE = 1800  # seconds; older (buffered) pings don't get today's weather
+
+weather_provider = make_provider(WEATHER_PROVIDER, WEATHER_API_KEY, WEATHER_TIMEOUT)
+weather_cache = WeatherCache(weather_provider, precision=WEATHER_GEOHASH_PRECISION,
+                             ttl=WEATHER_CACHE_TTL, error_ttl=WEATHER_ERROR_TTL,
+                             stale_ttl=WEATHER_STALE_TTL, max_entries=WEATHER_CACHE_MAX_CELLS) \
+    if weather_provider is not None else None
+
+# 'direct' commits one INSERT per ping. 'buffered' acknowledges a ping once
+# it's in a local write-ahead log and inserts in batches in the background
+INGEST_MODE = 'direct'
+# Each process logs to its own subdirectory of INGEST_WAL_DIR; logs left by
+# processes that have exited are replayed by the next one to start
+INGEST_WAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingest_wal')
+INGEST_MAX_BATCH = 500
+INGEST_MAX_DELAY = 1.0  # seconds a row may wait before its batch is flushed
+# A late ping is merged in the DB, so it first waits this long for the
+# buffered rows to get there; past that the request fails and the app retries
+INGEST_LATE_FLUSH_TIMEOUT = 10.0
+
+if INGEST_MODE == 'buffered':
+    ingest_buffer = IngestBuffer(get_db_connection, release_db_connection, INGEST_WAL_DIR,
+                                 max_batch=INGEST_MAX_BATCH, max_delay=INGEST_MAX_DELAY)
+    atexit.register(ingest_buffer.close)
+else:
+    ingest_buffer = None
+
+# Opt-in: sample the stacks of requests slower than PROFILE_THRESHOLD seconds
+# and write them to PROFILE_DIR as folded stacks, ready for flamegraph.pl
+PROFILE_SLOW_REQUESTS = False
+PROFILE_THRESHOLD = 1.0
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+
+profiler = SlowRequestProfiler(PROFILE_DIR, PROFILE_THRESHOLD, PROFILE_INTERVAL) \
+    if PROFILE_SLOW_REQUESTS else None
+
+@app.before_request
+def start_request_timer() -> None:
+    g.request_started = perf_counter()
+    g.route_token = current_route.set(request.url_rule.rule if request.url_rule else 'unmatched')
+    if profiler is not None:
+        profiler.start()
+
+def finish_request_timer(status: int) -> None:
+    elapsed = perf_counter() - g.pop('request_started')
+    route = current_route.get()
+    request_seconds.observe((route, request.method, str(status)), elapsed)
+    if profiler is not None:
+        path = profiler.stop(route, elapsed)
+        if path:
+            print(f"Slow request to {route} ({elapsed:.3f}s), stacks written to {path}")
+    current_route.reset(g.pop('route_token'))
+
+@app.after_request
+def observe_request(response):
+    finish_request_timer(response.status_code)
+    return response
+
+# Bodies of at least COMPRESS_MIN_BYTES in a compressible type (JSON, text,
+# SVG) are sent brotli- or gzip-encoded, whichever the client prefers
+COMPRESS_RESPONSES = True
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5  # of 11; higher costs far more CPU for little gain
+
+# Registered after observe_request so it runs first and is part of the timing
+@app.after_request
+def compress_response(response):
+    if not COMPRESS_RESPONSES or response.direct_passthrough or response.is_streamed \
+            or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    body = response.get_data()
+    if encoding is None or not should_compress(response.mimetype, len(body), COMPRESS_MIN_BYTES):
+        return response
+    with span('compress'):
+        response.set_data(compress(body, encoding, COMPRESS_GZIP_LEVEL, COMPRESS_BROTLI_QUALITY))
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = add_vary(response.headers.get('Vary'))
+    return response
+
+@app.teardown_request
+def observe_failed_request(error) -> None:
+    # after_request doesn't run when a view raises
+    if 'request_started' in g:
+        finish_request_timer(500)
 
 def parse_device_time(device_time_str: str) -> datetime:
     try:
@@ -38,50 +279,31 @@ def format_time(total_seconds: int) -> str:
     return f"{int(hours)}:{int(minutes):02d}:{int(seconds):02d}"
 
 def calculate_time_outside(user_id: str, current_date: date) -> int:
+    """Seconds outside on ``current_date`` so far, counting an outdoor streak
+    that's still open at the latest ping up to now."""
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-
-        start_of_day = datetime.combine(current_date, time(0, 0))
-        end_of_day = datetime.combine(current_date, time(23, 59, 59))
-        
-        cur.execute(
-            """
-            SELECT time FROM final_table
-            WHERE user_id = %s AND "outside?" = TRUE
-            AND time > COALESCE(
-                (SELECT time FROM final_table
-                 WHERE user_id = %s AND "outside?" = FALSE
-                 AND time BETWEEN %s AND %s
-                 ORDER BY time DESC
-                 LIMIT 1),
-                '1970-01-01'::timestamp
-            )
-            AND time BETWEEN %s AND %s
-            ORDER BY time ASC
-            """,
-            (user_id, user_id, start_of_day, end_of_day, start_of_day, end_of_day)
-        )
-        results = cur.fetchall()
-        time_outside = 0
-        if results:
-            current_time = datetime.now()
-            for result in results:
-                last_outside_time = result[0]
-                time_outside += int((current_time - last_outside_time).total_seconds())
-        return time_outside
+        intervals = fetch_outdoor_intervals(cur, user_id, current_date,
+                                            MAX_TIME_BETWEEN_UPDATES, until=datetime.now())
+        return int(total_seconds(intervals))
     except Exception as e:
         print(f"Error calculating time outside: {e}")
         return 0
     finally:
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+
+@lru_cache(maxsize=4096)
+def parse_clock(value: str) -> time:
+    """Parse an "HH:MM" sunrise/sunset string; raises ValueError."""
+    return datetime.strptime(value, "%H:%M").time()
 
 def is_daytime(sunrise: str, sunset: str, current_time: datetime) -> bool:
     try:
         current_local_time = current_time.time()
-        sunrise_time = datetime.strptime(sunrise, "%H:%M").time()
-        sunset_time = datetime.strptime(sunset, "%H:%M").time()
+        sunrise_time = parse_clock(sunrise)
+        sunset_time = parse_clock(sunset)
         return sunrise_time <= current_local_time <= sunset_time
     except ValueError as e:
         print(f"Error parsing sunrise/sunset times: {e}")
@@ -89,14 +311,132 @@ def is_daytime(sunrise: str, sunset: str, current_time: datetime) -> bool:
 
 def calculate_available_hours(sunrise: str, sunset: str) -> float:
     try:
-        sunrise_time = datetime.strptime(sunrise, "%H:%M")
-        sunset_time = datetime.strptime(sunset, "%H:%M")
-        daylight_duration = sunset_time - sunrise_time
-        return round(daylight_duration.total_seconds() / 3600, 2)
+        sunrise_time = parse_clock(sunrise)
+        sunset_time = parse_clock(sunset)
+        daylight_minutes = ((sunset_time.hour - sunrise_time.hour) * 60 +
+                            sunset_time.minute - sunrise_time.minute)
+        return round(daylight_minutes / 60, 2)
     except ValueError as e:
         print(f"Error calculating available hours: {e}")
         return 0.0
 
+def client_location(data: Dict[str, Any]) -> Optional[Tuple[float, float, int]]:
+    """(latitude, longitude, utc_offset minutes) from a request, if it has a position."""
+    if data.get('latitude') is None or data.get('longitude') is None:
+        return None
+    latitude, longitude = float(data['latitude']), float(data['longitude'])
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude/longitude out of range")
+    utc_offset = data.get('utc_offset')
+    utc_offset = int(utc_offset) if utc_offset is not None else default_utc_offset(longitude)
+    return latitude, longitude, utc_offset
+
+def resolve_sun_times(data: Dict[str, Any], day: date) -> Tuple[Optional[str], Optional[str]]:
+    """The request's sunrise/sunset, or ones computed from its position."""
+    sunrise, sunset = data.get('sunrise'), data.get('sunset')
+    if sunrise and sunset:
+        return sunrise, sunset
+    location = client_location(data)
+    if location is None:
+        return sunrise, sunset
+    sunrise_time, sunset_time = sun_times(location[0], location[1], day, location[2])
+    if sunrise_time is None:
+        # Polar night: no daylight at all
+        return "00:00", "00:00"
+    return sunrise_time.strftime("%H:%M"), sunset_time.strftime("%H:%M")
+
+def parse_chart_options(data: Dict[str, Any], default_dpi: int,
+                        width_inches: float) -> Dict[str, Any]:
+    """Read the optional output settings for a chart request.
+
+    ``mode`` is "image" (default) or "data" for the JSON alone, ``format`` is
+    png, webp or svg, ``encoding`` is "base64" (inside the JSON, as before)
+    or "binary" for the bare image, and ``width`` is the target width in
+    pixels, from which the dpi is picked.
+    """
+    mode = data.get('mode', 'image')
+    if mode not in ('image', 'data'):
+        raise ValueError("mode must be 'image' or 'data'")
+
+    fmt = str(data.get('format', 'png')).lower()
+    if fmt not in CHART_MIME_TYPES:
+        raise ValueError(f"format must be one of {list(CHART_MIME_TYPES)}")
+
+    encoding = data.get('encoding', 'base64')
+    if encoding not in ('base64', 'binary'):
+        raise ValueError("encoding must be 'base64' or 'binary'")
+
+    dpi = default_dpi
+    if data.get('width') is not None:
+        try:
+            width = int(data['width'])
+        except (TypeError, ValueError):
+            raise ValueError("width must be a whole number of pixels")
+        if width <= 0:
+            raise ValueError("width must be positive")
+        # Round to a multiple of 10 so cached static layers get reused, and
+        # never go above the default since that's already full quality
+        dpi = int(round(width / width_inches / 10)) * 10
+        dpi = max(MIN_CHART_DPI, min(default_dpi, dpi))
+
+    return {"mode": mode, "format": fmt, "encoding": encoding, "dpi": dpi}
+
+def chart_response(image: Optional[bytes], options: Dict[str, Any],
+                   payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+    headers = headers or {}
+    if image is None:
+        return jsonify(payload), 200, headers
+    if options['encoding'] == 'binary':
+        return Response(image, mimetype=CHART_MIME_TYPES[options['format']]), 200, headers
+    with span('base64_encode'):
+        encoded = base64.b64encode(image).decode('utf-8')
+    return jsonify({
+        "image": encoded,
+        "image_format": options['format'],
+        **payload
+    }), 200, headers
+
+# Chart responses always carry an ETag, and a request whose If-None-Match
+# still matches gets a bodiless 304 before anything is rendered. Charts of
+# days at least CHART_IMMUTABLE_AFTER_DAYS old no longer change, so the
+# client may keep them for good. A phone holds back at most one batch of
+# 5-minute pings, so that's how far back a late merge can reach, plus a day
+CHART_CACHE_CONTROL = 'private, no-cache'
+CHART_IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+CHART_IMMUTABLE_AFTER_DAYS = math.ceil(MAX_BATCH_SAMPLES * 5 * 60 / 86400) + 1
+CHART_ETAG_VERSION = 1  # bump when the charts' look changes
+
+def chart_request_data() -> Optional[Dict[str, Any]]:
+    """A chart request's fields: the JSON body of a POST, or the query string
+    of a GET (which, unlike a POST, HTTP caches can keep)."""
+    if request.method == 'GET':
+        return request.args.to_dict()
+    return request.get_json(silent=True)
+
+def chart_cache_headers(etag: str, last_day: date) -> Dict[str, str]:
+    settled = last_day <= date.today() - timedelta(days=CHART_IMMUTABLE_AFTER_DAYS)
+    return {
+        "ETag": etag,
+        "Cache-Control": CHART_IMMUTABLE_CACHE_CONTROL if settled else CHART_CACHE_CONTROL,
+    }
+
+def chart_validator(cache_key: Tuple, options: Dict[str, Any], payload: Dict[str, Any],
+                    last_day: date) -> Dict[str, str]:
+    """Caching headers for a chart built from ``cache_key`` and ``payload``."""
+    # The dot's exact time is only echoed back; the key already has its bucket
+    stable = {key: value for key, value in payload.items() if key != 'current_time'}
+    etag = chart_etag(CHART_ETAG_VERSION, cache_key, options['mode'], options['encoding'], stable)
+    return chart_cache_headers(etag, last_day)
+
+def not_modified(headers: Dict[str, str]):
+    return Response(status=304, headers=headers)
+
+def render_unavailable(e):
+    """503 with Retry-After for a render the pool couldn't take or finish."""
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
 @app.route('/submit-feedback', methods=['POST'])
 def submit_feedback() -> Tuple[Dict[str, Any], int]:
     data = request.get_json()
@@ -115,11 +455,13 @@ def submit_feedback() -> Tuple[Dict[str, Any], int]:
 
         cur.execute(
             """
-            INSERT INTO app_accuracy (user_id, time, correct_result, gps_accuracy)
-            VALUES (%s, %s, %s, %s)
+            INSERT INTO app_accuracy (user_id, time, correct_result, gps_accuracy,
+                                      is_connected_to_wifi)
+            VALUES (%s, %s, %s, %s, %s)
             """,
             (data['user_id'], device_time, 
-             data['correct_result'], round(data['gps_accuracy'], 2))
+             data['correct_result'], round(data['gps_accuracy'], 2),
+             data.get('is_connected_to_wifi'))
         )
         conn.commit()
         return {"message": "Feedback submitted successfully"}, 200
@@ -127,15 +469,78 @@ def submit_feedback() -> Tuple[Dict[str, Any], int]:
         return {"error": f"Database error: {str(e)}"}, 500
     finally:
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+
+def get_hour_markers(today: date, sunrise_time: time, sunset_time: time) -> List[time]:
+    """Whole hours between sunrise and sunset, inclusive."""
+    sunrise_dt = datetime.combine(today, sunrise_time)
+    sunset_dt = datetime.combine(today, sunset_time)
+    hour_markers = []
+    current_marker = sunrise_dt.replace(minute=0, second=0, microsecond=0)
+
+    if current_marker < sunrise_dt:
+        current_marker += timedelta(hours=1)
+
+    while current_marker <= sunset_dt:
+        hour_markers.append(current_marker.time())
+        current_marker += timedelta(hours=1)
+    return hour_markers
+
+def daily_payload(formatted_time: str, sunrise_str: str, sunset_str: str,
+                  outdoor_segments: List[Segment], hour_markers: List[time],
+                  current_time: time) -> Dict[str, Any]:
+    """The JSON body of /daily-visualisation, less the image."""
+    return {
+        "total_time_outside": formatted_time,
+        "sunrise": sunrise_str,
+        "sunset": sunset_str,
+        "outdoor_segments": [
+            {"start": str(segment.start), "end": str(segment.end),
+             "start_angle": round(segment.theta1, 3), "end_angle": round(segment.theta2, 3)}
+            for segment in outdoor_segments
+        ],
+        "hour_markers": [str(m) for m in hour_markers],
+        "current_time": str(current_time),
+        "data_available": bool(outdoor_segments),
+        "calculation_method": "backward_segments"
+    }
 
-@app.route('/daily-visualisation', methods=['POST'])
+def segments_digest(segments: List[Segment]) -> str:
+    return hashlib.blake2b(repr([(s.start, s.end) for s in segments]).encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+def daily_cache_key(user_id: str, today: date, sunrise_str: str, sunset_str: str,
+                    sunrise_time: time, sunset_time: time, formatted_time: str,
+                    outdoor_segments: List[Segment], device_time: datetime,
+                    options: Dict[str, Any]) -> Tuple:
+    """render_cache key for a daily chart. It holds the day's total and
+    segments, so a late ping that changes the day misses in every worker's
+    cache. Outside daylight the time dot sits at one end of the arc, so the
+    time is clamped to sunrise..sunset and a single render serves the whole
+    evening (or early morning)."""
+    clamped = datetime.combine(today, min(max(device_time.time(), sunrise_time), sunset_time))
+    return (user_id, today, sunrise_str, sunset_str, formatted_time,
+            segments_digest(outdoor_segments), time_bucket(clamped, RENDER_CACHE_TIME_BUCKET),
+            options['format'], options['dpi'])
+
+def weekly_cache_key(user_id: str, today: date, chart_range: str, minutes: List[float],
+                     options: Dict[str, Any]) -> Tuple:
+    """render_cache key for a weekly graph; it holds the bars themselves, so
+    an entry can't go stale."""
+    return (user_id, today, 'weekly', chart_range, tuple(minutes), options['format'], options['dpi'])
+
+@app.route('/daily-visualisation', methods=['GET', 'POST'])
 def daily_visualisation():
     try:
-        data = request.get_json()
+        data = chart_request_data()
         if not data or 'user_id' not in data or 'device_time' not in data:
             return jsonify({"error": "user_id and device_time are required"}), 400
 
+        try:
+            options = parse_chart_options(data, DAILY_CHART_DPI, DAILY_CHART_WIDTH_INCHES)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         device_time = parse_device_time(data['device_time'])
         user_id = data['user_id']
         today = device_time.date()
@@ -146,15 +551,13 @@ def daily_visualisation():
         conn = get_db_connection()
         cur = conn.cursor()
 
-        if 'sunrise' not in data or 'sunset' not in data:
-            return jsonify({"error": "sunrise and sunset times are required"}), 400
-
-        sunrise_str = data['sunrise']
-        sunset_str = data['sunset']
+        sunrise_str, sunset_str = resolve_sun_times(data, today)
+        if not sunrise_str or not sunset_str:
+            return jsonify({"error": "sunrise and sunset (or latitude and longitude) are required"}), 400
 
         # Get the most recent total_time_outside_for_given_day
         cur.execute(
-            """SELECT total_time_outside_for_given_day 
+            """SELECT total_time_outside_for_given_day
                FROM final_table
                WHERE user_id = %s AND time BETWEEN %s AND %s
                ORDER BY time DESC
@@ -164,176 +567,55 @@ def daily_visualisation():
         total_result = cur.fetchone()
         total_time_seconds = total_result[0] if total_result else 0
 
-        # MODIFIED: Get all records and calculate segments ending at timestamp
-        cur.execute(
-            """SELECT time, time_outside 
-               FROM final_table
-               WHERE user_id = %s AND time BETWEEN %s AND %s
-               AND time_outside > 0
-               ORDER BY time ASC""",
-            (user_id, start_of_day, end_of_day)
-        )
-        outdoor_segments = []
-        for record_time, duration in cur.fetchall():
-            end_time = record_time.time()  # Segment ends at record time
-            start_time = (record_time - timedelta(seconds=duration)).time()  # Extends backward
-            outdoor_segments.append((start_time, end_time))
-
         # Convert sunrise/sunset strings to time objects
         try:
-            sunrise_time = datetime.strptime(sunrise_str, "%H:%M").time()
-            sunset_time = datetime.strptime(sunset_str, "%H:%M").time()
+            sunrise_time = parse_clock(sunrise_str)
+            sunset_time = parse_clock(sunset_str)
         except ValueError:
             return jsonify({"error": "Invalid time format (expected HH:MM)"}), 400
 
-        # Visualization setup (unchanged from original)
-        plt.style.use('dark_background')
-        fig, ax = plt.subplots(figsize=(20, 16), facecolor='#1a1a1a')
-        fig.patch.set_edgecolor('#FFA500')
-        fig.patch.set_linewidth(5)
-
-        radius = 25
-        center = (0, 0)
-        arc_width = 100
+        # Outdoor stretches ending at each ping, merged where they touch and
+        # clipped to daylight, so the chart draws one arc per stretch
+        outdoor_segments = build_segments(
+            ((start.time(), end.time())
+             for start, end in fetch_outdoor_intervals(cur, user_id, today, MAX_TIME_BETWEEN_UPDATES)),
+            today, sunrise_time, sunset_time)
 
-        daylight_duration = (datetime.combine(today, sunset_time) - 
-                          datetime.combine(today, sunrise_time)).total_seconds()
-        
-        def time_to_daylight_angle(t: time) -> float:
-            if t <= sunrise_time: return 0
-            if t >= sunset_time: return 180
-            seconds = (datetime.combine(today, t) - 
-                     datetime.combine(today, sunrise_time)).total_seconds()
-            return 180 * (seconds / daylight_duration)
-
-        ax.set_xlim(radius+7, -radius-7)
-
-        # Base daylight arc
-        daylight_arc = Arc(center, 2*radius, 2*radius, angle=0,
-                         theta1=0, theta2=180, color='#3a3a3a', lw=arc_width)
-        ax.add_patch(daylight_arc)
-        
-        # Draw individual outdoor segments (using modified segments)
-        for start, end in outdoor_segments:
-            start_clipped = max(start, sunrise_time)
-            end_clipped = min(end, sunset_time)
-            if start_clipped >= end_clipped: continue 
-                
-            start_angle = time_to_daylight_angle(start_clipped)
-            end_angle = time_to_daylight_angle(end_clipped)
-            
-            outdoor_arc = Arc(center, 2*radius, 2*radius, angle=0,
-                            theta1=start_angle, theta2=end_angle,
-                            color='#FFA500', lw=arc_width)
-            ax.add_patch(outdoor_arc)
-
-        # Original hour markers code (unchanged)
-        sunrise_dt = datetime.combine(today, sunrise_time)
-        sunset_dt = datetime.combine(today, sunset_time)
-        hour_markers = []
-        current_marker = sunrise_dt.replace(minute=0, second=0, microsecond=0)
-        
-        if current_marker < sunrise_dt:
-            current_marker += timedelta(hours=1)
-        
-        while current_marker <= sunset_dt:
-            hour_markers.append(current_marker.time())
-            current_marker += timedelta(hours=1)
-        
-        marker_length = 2.5
-        for marker_time in hour_markers:
-            angle = time_to_daylight_angle(marker_time)
-            rad_angle = np.radians(angle)
-            
-            x_outer = radius * np.cos(rad_angle)
-            y_outer = radius * np.sin(rad_angle)
-            
-            x_inner = (radius - marker_length) * np.cos(rad_angle)
-            y_inner = (radius - marker_length) * np.sin(rad_angle)
-            
-            ax.plot([x_outer, x_inner], [y_outer, y_inner], 
-                   color='white', linewidth=2, alpha=0.7)
-            
-            if marker_time.hour % 2 == 0:
-                label_radius = radius - marker_length - 1.5
-                x_label = label_radius * np.cos(rad_angle)
-                y_label = label_radius * np.sin(rad_angle)
-                
-                ax.text(x_label, y_label, f"{marker_time.hour}:00",
-                       color='white', ha='center', va='center',
-                       fontsize=14, alpha=0.8)
-
-        # Current time indicator (unchanged)
+        hour_markers = get_hour_markers(today, sunrise_time, sunset_time)
         current_time = device_time.time()
-        current_angle = time_to_daylight_angle(current_time)
-        rad_angle = np.radians(current_angle)
-        
-        x_dot = radius * np.cos(rad_angle)
-        y_dot = radius * np.sin(rad_angle)
-        
-        ax.plot(x_dot, y_dot, 'o',
-               color='white',
-               markersize=17,
-               alpha=0.6)
-
-        # Sunrise/sunset labels (unchanged)
-        ax.text(radius+2.8, -1.3, sunrise_str,
-               color='white', ha='left', va='center',
-               fontsize=28, fontweight='bold')
-
-        ax.text(-radius-2.8, -1.3, sunset_str,
-               color='white', ha='right', va='center',
-               fontsize=28, fontweight='bold')
-
-        # Time display (unchanged)
         formatted_time = format_time(total_time_seconds)
-        
-        ax.text(0, 8, "RECOMMENDED EXPOSURE\n45 MINUTES", 
-               color='white', ha='center', va='center',
-               fontsize=30, fontweight='bold', alpha=0.9,
-               linespacing=1.5)
-
-        ax.text(0, 0, formatted_time, 
-               color='#FFA500', ha='center', va='center',
-               fontsize=60, fontweight='bold',
-               bbox=dict(facecolor='#1a1a1a88', edgecolor='#FFA500',
-                        boxstyle='round,pad=0.8', linewidth=5))
-
-        ax.set_ylim(-2, radius+3)
-        ax.axis('off')
-        ax.set_aspect('equal')
-        
-        plt.title('Daylight Exposure', color='#FFA500', pad=20, 
-                 fontsize=44, fontweight='bold', y=1.05)
-        
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=250, bbox_inches='tight',
-                   facecolor=fig.get_facecolor(), edgecolor=fig.get_edgecolor())
-        plt.close(fig)
-        buf.seek(0)
-        
-        # Original response format (unchanged)
-        return jsonify({
-            "image": base64.b64encode(buf.read()).decode('utf-8'),
-            "total_time_outside": formatted_time,
-            "sunrise": sunrise_str,
-            "sunset": sunset_str,
-            "outdoor_segments": [
-                {"start": str(start), "end": str(end)} 
-                for start, end in outdoor_segments
-            ],
-            "hour_markers": [str(m) for m in hour_markers],
-            "current_time": str(current_time),
-            "data_available": bool(outdoor_segments),
-            "calculation_method": "backward_segments"
-        }), 200
 
+        payload = daily_payload(formatted_time, sunrise_str, sunset_str, outdoor_segments,
+                                hour_markers, current_time)
+
+        # The chart only changes when the day's outdoor time does or the time
+        # dot moves into the next bucket, so repeat refreshes are served from
+        # the cache or, if the client still has it, not sent at all
+        cache_key = daily_cache_key(user_id, today, sunrise_str, sunset_str, sunrise_time,
+                                    sunset_time, formatted_time, outdoor_segments,
+                                    device_time, options)
+        headers = chart_validator(cache_key, options, payload, today)
+        if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+            return not_modified(headers)
+        if options['mode'] == 'data':
+            return chart_response(None, options, payload, headers)
+
+        image = render_cache.get(cache_key)
+        if image is None:
+            image = render_pool.render_daily(today, sunrise_str, sunset_str,
+                                             sunrise_time, sunset_time, outdoor_segments,
+                                             hour_markers, current_time, formatted_time,
+                                             fmt=options['format'], dpi=options['dpi'])
+            render_cache.put(cache_key, image)
+        return chart_response(image, options, payload, headers)
+
+    except RenderUnavailable as e:
+        return render_unavailable(e)
     except Exception as e:
         print(f"Visualization error: {str(e)}")
         return jsonify({"error": str(e)}), 500
     finally:
-        if 'conn' in locals(): conn.close()
-        plt.close('all')
+        if 'conn' in locals(): release_db_connection(conn)
 
 def format_time(seconds):
     """Convert seconds to H:MM format"""
@@ -342,165 +624,417 @@ def format_time(seconds):
     return f"{hours}:{minutes:02d}"
 
 
-@app.route('/weekly-time-outside-graph', methods=['POST'])
+def chart_range_start(chart_range: str, today: date) -> date:
+    """First day covered by a weekly-graph ``range`` ending on ``today``."""
+    if chart_range == 'year':
+        # The first of the month eleven months back, so 12 bars with this one
+        return (date(today.year - 1, today.month, 1) + timedelta(days=31)).replace(day=1)
+    return today - timedelta(days=CHART_RANGE_DAYS[chart_range] - 1)
+
+def chart_range_series(chart_range: str, today: date, start_date: date,
+                       summaries: Dict[date, Dict[str, Any]]) -> Tuple[List[str], List[float]]:
+    """Bar labels and minutes outside for a weekly-graph ``range``."""
+    minutes = []
+    day_names = []
+
+    if chart_range == 'year':
+        # One bar per month: the average minutes outside per day so far
+        # that month, so it reads against the same daily goal
+        month_start = start_date
+        while month_start <= today:
+            next_month = (month_start + timedelta(days=31)).replace(day=1)
+            month_end = min(next_month - timedelta(days=1), today)
+            days = (month_end - month_start).days + 1
+            seconds = sum(summary["outside_seconds"] for day, summary in summaries.items()
+                          if month_start <= day <= month_end)
+            day_names.append(month_start.strftime('%b %Y'))
+            minutes.append(seconds / days / 60)
+            month_start = next_month
+    else:
+        for day_offset in range((today - start_date).days, -1, -1):
+            current_date = today - timedelta(days=day_offset)
+            day_name = current_date.strftime('%a %d-%m')
+            day_names.append(day_name)
+            summary = summaries.get(current_date)
+            minutes.append(summary["outside_seconds"] / 60 if summary else 0)
+    return day_names, minutes
+
+@app.route('/weekly-time-outside-graph', methods=['GET', 'POST'])
 def weekly_time_outside_graph():
     try:
-        data = request.get_json()
+        data = chart_request_data()
         if not data or 'user_id' not in data or 'device_time' not in data:
             return jsonify({"error": "user_id and device_time are required"}), 400
 
+        try:
+            options = parse_chart_options(data, WEEKLY_CHART_DPI, WEEKLY_CHART_WIDTH_INCHES)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        chart_range = data.get('range', 'week')
+        if chart_range not in CHART_RANGE_DAYS:
+            return jsonify({"error": f"range must be one of {list(CHART_RANGE_DAYS)}"}), 400
+
         device_time = parse_device_time(data['device_time'])
         today = device_time.date()
         user_id = data['user_id']
         conn = get_db_connection()
         cur = conn.cursor()
 
-        start_date = today - timedelta(days=6)
-        
-        start_datetime = datetime.combine(start_date, time(0, 0))
-        end_datetime = datetime.combine(today, time(23, 59, 59))
-        
-        cur.execute(
-            """
-            WITH ranked_entries AS (
-                SELECT 
-                    time::date as date,
-                    total_time_outside_for_given_day as time_seconds,
-                    ROW_NUMBER() OVER (PARTITION BY time::date 
-                                      ORDER BY time DESC) as row_num
-                FROM final_table
-                WHERE user_id = %s 
-                AND time BETWEEN %s AND %s
-            )
-            SELECT date, time_seconds
-            FROM ranked_entries
-            WHERE row_num = 1
-            ORDER BY date DESC  
-            """,
-            (user_id, start_datetime, end_datetime)
-        )
-        results = cur.fetchall()
-
-        minutes = []
-        day_names = []
-        
-        existing_data = {record[0]: record[1] for record in results}
-        
-        for day_offset in range(6, -1, -1):
-            current_date = today - timedelta(days=day_offset)
-            day_name = current_date.strftime('%a %d-%m')
-            day_names.append(day_name)
-            time_seconds = existing_data.get(current_date, 0)
-            minutes.append(time_seconds / 60)
+        start_date = chart_range_start(chart_range, today)
+        summaries = read_daily_summary(cur, user_id, start_date, today)
+        day_names, minutes = chart_range_series(chart_range, today, start_date, summaries)
 
-        plt.style.use('dark_background')
-        fig = plt.figure(figsize=(10, 6), facecolor='#1a1a1a')
-        fig.patch.set_edgecolor('#FFA500')
-        fig.patch.set_linewidth(2)
-        
-        ax = fig.add_subplot(111, facecolor='#2a2a2a')
-        
-        bars = ax.barh(
-            day_names,
-            minutes, 
-            height=0.7, 
-            color='#FFA500', 
-            alpha=0.9,
-            zorder=2
-        )
-        
-        
-        ax.set_xlabel('Minutes Outside', 
-                     color='#FFA500', 
-                     fontsize=12, 
-                     labelpad=10)
-        
-        x_max = max(max(minutes) * 1.2, 60)
-        ax.set_xlim(0, x_max)
-        
-        ax.tick_params(axis='y', colors='#FFA500', labelsize=12, pad=5)
-        ax.tick_params(axis='x', colors='#FFA500', labelsize=11)
-        
-        ax.grid(color='#FFA50033', linestyle='--', linewidth=0.8, alpha=0.5, zorder=1, axis='x')
-        ax.axvline(0, color='#FFA500', linestyle='-', linewidth=1.5, zorder=2)
-        
-        goal_minutes = 45
-        ax.axvline(goal_minutes, color='#FFA500', linestyle=':', linewidth=2.5, alpha=0.7, zorder=3)
-        ax.text(goal_minutes + 2, len(day_names) - 0.5, 
-                'Daily Goal: 45 mins', 
-                color='#FFA500', fontsize=11, va='center')
-        
-        for spine in ax.spines.values():
-            spine.set_visible(False)
-        
-        for bar in bars:
-            width = bar.get_width()
-            label_x = width + (x_max * 0.02)
-            ax.text(label_x, bar.get_y() + bar.get_height()/2,
-                   f'{int(width)} min',
-                   ha='left', va='center',
-                   color='#FFA500', fontsize=11, weight='bold')
-            
-            if width >= goal_minutes:
-                check_x = width * 0.95
-                ax.text(check_x, bar.get_y() + bar.get_height()/2,
-                       '✓', 
-                       ha='center', va='center',
-                       color='#FFFFFF', fontsize=14, weight='bold')
-
-        plt.tight_layout(pad=2)
-
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=120, bbox_inches='tight', 
-                   facecolor=fig.get_facecolor(), edgecolor=fig.get_edgecolor())
-        plt.close(fig)
-        buf.seek(0)
-        
-        return jsonify({
-            "image": base64.b64encode(buf.read()).decode('utf-8'),
+        payload = {
+            "range": chart_range,
             "days": day_names,
             "minutes": minutes,
             "seconds": [m * 60 for m in minutes]
-        }), 200
+        }
 
+        cache_key = weekly_cache_key(user_id, today, chart_range, minutes, options)
+        # Every bar is drawn into one image, so it is only as settled as its
+        # last day: a range ending today changes with each ping and is left
+        # to ETag revalidation, while a past range (asked for with an earlier
+        # device_time) is immutable once it ends CHART_IMMUTABLE_AFTER_DAYS ago
+        headers = chart_validator(cache_key, options, payload, today)
+        if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+            return not_modified(headers)
+        if options['mode'] == 'data':
+            return chart_response(None, options, payload, headers)
+
+        image = render_cache.get(cache_key)
+        if image is None:
+            image = render_pool.render_weekly(day_names, minutes,
+                                              fmt=options['format'], dpi=options['dpi'])
+            render_cache.put(cache_key, image)
+        return chart_response(image, options, payload, headers)
+
+    except RenderUnavailable as e:
+        return render_unavailable(e)
     except Exception as e:
         print(f"Error in weekly graph generation: {str(e)}")
         return jsonify({"error": str(e)}), 500
     finally:
         if 'conn' in locals():
-            conn.close()
-        plt.close('all')
+            release_db_connection(conn)
 
 
-@app.route('/check-location', methods=['POST'])
-def check_location() -> Tuple[Dict[str, Any], int]:
-    MAX_TIME_BETWEEN_UPDATES = 600  # 10 minutes in seconds
-
-    # Weather to lux mapping 
-    WEATHER_LUX_VALUES = {
-        'Clear': 100000,
-        'Sunny': 100000,
-        'Mostly Sunny': 80000,
-        'Partly Cloudy': 50000,
-        'Cloudy': 25000,
-        'Overcast': 10000,
-        'Light Rain': 15000,
-        'Rain': 8000,
-        'Heavy Rain': 5000,
-        'Thunderstorm': 3000,
-        'Snow': 15000,
-        'Fog': 10000,
-        'Unknown': 25000  # Default value
+def load_last_state(user_id: str) -> Optional[LastState]:
+    """The user's latest running totals, from the state store or, on a miss,
+    the ingest buffer and then final_table."""
+    state = user_state_store.get(user_id)
+    if state is not None:
+        return state
+
+    if ingest_buffer is not None:
+        # Rows still waiting in the buffer are newer than anything in the DB
+        row = ingest_buffer.latest_for_user(user_id)
+        if row is not None:
+            state = LastState(*row[1:6])
+            user_state_store.set(user_id, state)
+            return state
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(LATEST_STATE_SQL, (user_id,))
+        last_record = cur.fetchone()
+    finally:
+        release_db_connection(conn)
+    if last_record is None:
+        return None
+    state = LastState(*last_record)
+    user_state_store.set(user_id, state)
+    return state
+
+def advance_running_totals(last_record: Optional[LastState], current_datetime: datetime,
+                           is_outside: bool) -> Tuple[float, float, float]:
+    """Work out (time_outside, total_time_outside, total_time_outside_for_given_day)
+    for a new ping that follows ``last_record``."""
+    current_date = current_datetime.date()
+
+    # Initialize values
+    time_outside = 0
+    total_time_outside = last_record.total_time_outside if last_record else 0
+    total_time_outside_for_given_day = last_record.total_time_outside_for_given_day if last_record else 0
+
+    if last_record:
+        time_since_last = (current_datetime - last_record.time).total_seconds()
+        last_date = last_record.time.date()
+
+        # Calculate time_outside (capped at 10 mins if previous was outside and same day)
+        if last_record.outside and (current_date == last_date):
+            time_outside = min(time_since_last, MAX_TIME_BETWEEN_UPDATES)
+
+        # Reset daily total if new day
+        if current_date > last_date:
+            total_time_outside_for_given_day = 0
+
+        # Update totals
+        total_time_outside += time_outside  # Only add the new time_outside value
+        total_time_outside_for_given_day += time_outside  # Only add the new time_outside value
+
+    # First record handling
+    elif is_outside:
+        time_outside = 0  # No previous record to compare with
+        total_time_outside = 0
+        total_time_outside_for_given_day = 0
+
+    return time_outside, total_time_outside, total_time_outside_for_given_day
+
+def parse_uv(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def weather_position(data: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    """Where to look up the weather for a ping, or None when it brought its
+    own, has no position or is too old for current conditions to apply."""
+    if weather_cache is None or data.get('weather') not in (None, 'Unknown'):
+        return None
+    location = client_location(data)
+    if location is None:
+        return None
+    moment_utc = parse_device_time(data['device_time']) - timedelta(minutes=location[2])
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    if abs((now_utc - moment_utc).total_seconds()) > WEATHER_MAX_SAMPLE_AGE:
+        return None
+    return location[0], location[1]
+
+def sample_conditions(data: Dict[str, Any]) -> Optional[Conditions]:
+    position = weather_position(data)
+    return weather_cache.get(*position) if position else None
+
+def parse_location_sample(data: Dict[str, Any], threshold: float = GPS_ACCURACY_THRESHOLD,
+                          conditions: Optional[Conditions] = None) -> Dict[str, Any]:
+    """Validate one location ping and derive everything that doesn't depend on
+    the user's previous row; ``threshold`` is the user's GPS accuracy
+    threshold and ``conditions`` the server-side weather, if any (see
+    sample_conditions). Raises ValueError/KeyError on bad input."""
+    current_datetime = parse_device_time(data['device_time'])
+
+    is_connected_to_wifi = data.get('is_connected_to_wifi', False)
+    weather, temperature, uv = data.get('weather', 'Unknown'), data.get('temperature'), data.get('uv')
+    if conditions is not None:
+        weather, temperature, uv = conditions
+    sunrise, sunset = resolve_sun_times(data, current_datetime.date())
+    gps_accuracy = round(float(data['gps_accuracy']), 2)
+
+    location = client_location(data)
+    if location is not None:
+        # With a position we can ask whether the sun is actually up
+        elevation = sun_elevation(location[0], location[1], current_datetime, location[2])
+        night = elevation < DAYTIME_MIN_ELEVATION
+    else:
+        elevation = None
+        night = bool(sunrise and sunset and not is_daytime(sunrise, sunset, current_datetime))
+
+    return {
+        "time": current_datetime,
+        "is_outside": gps_accuracy <= threshold and not is_connected_to_wifi,
+        "skip_db_update": night,
+        "weather": weather,
+        "temperature": temperature,
+        "uv": uv,
+        "sunrise": sunrise,
+        "sunset": sunset,
+        "gps_accuracy": gps_accuracy,
+        "lux": estimate_lux(weather, elevation, parse_uv(uv)),
+        "location": location,
     }
 
-    def calculate_lux(weather: str) -> int:
-        """Estimate lux based on weather conditions."""
-        normalized_weather = weather.lower().strip()
-        for condition, lux in WEATHER_LUX_VALUES.items():
-            if condition.lower() in normalized_weather:
-                return lux
-        return WEATHER_LUX_VALUES['Unknown']
+def build_final_row(user_id: str, sample: Dict[str, Any],
+                    last_record: Optional[LastState]) -> Tuple:
+    """The final_table row for a parsed sample that follows ``last_record``."""
+    time_outside, total_time_outside, total_time_outside_for_given_day = \
+        advance_running_totals(last_record, sample['time'], sample['is_outside'])
+
+    sunrise, sunset = sample['sunrise'], sample['sunset']
+    total_available_hours = calculate_available_hours(sunrise, sunset) if sunrise and sunset else 0
+
+    return (
+        user_id, sample['time'], sample['is_outside'],
+        time_outside, total_time_outside, total_time_outside_for_given_day,
+        total_available_hours, sample['weather'], sample['temperature'], sample['uv'],
+        sample['gps_accuracy'], sample['lux']
+    )
+
+def state_from_row(row: Tuple) -> LastState:
+    return LastState(*row[1:6])
+
+def location_response(sample: Dict[str, Any], row: Optional[Tuple],
+                      duplicate: bool = False) -> Dict[str, Any]:
+    """``duplicate`` marks a ping that was already stored, i.e. a retry."""
+    return {
+        "is_outside": sample['is_outside'],
+        "gps_accuracy": sample['gps_accuracy'],
+        "time_outside": row[3] if row else None,
+        "total_time_outside": row[4] if row else None,
+        "total_time_outside_for_given_day": row[5] if row else None,
+        "weather": sample['weather'],
+        "temperature": sample['temperature'],
+        "uv": sample['uv'],
+        "lux": sample['lux'],
+        "sunrise": sample['sunrise'],
+        "sunset": sample['sunset'],
+        "database_updated": row is not None,
+        "duplicate": duplicate
+    }
 
+def write_final_rows(user_id: str, rows: List[Tuple]) -> None:
+    """Persist a user's new rows in one transaction (or the ingest buffer) and
+    bring the state store and render cache up to date. Call with the user's
+    lock held."""
+    if ingest_buffer is not None:
+        # Durable once it's in the local log; the flusher writes it to the DB
+        for row in rows:
+            ingest_buffer.append(row)
+    else:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            if len(rows) == 1:
+                cur.execute(
+                    """
+                    INSERT INTO final_table (
+                        user_id, time, "outside?", 
+                        time_outside, total_time_outside, total_time_outside_for_given_day,
+                        total_available_hours, weather, temperature, uv, gps_accuracy, lux
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (user_id, time) DO NOTHING
+                    """,
+                    rows[0]
+                )
+                written = rows if cur.rowcount else []
+            else:
+                written = insert_final_rows(cur, rows)
+            # A retry that another worker already stored mustn't be counted twice
+            upsert_daily_summary(cur, written)
+            try:
+                conn.commit()
+            except Exception:
+                # We no longer know whether the rows landed
+                user_state_store.invalidate(user_id)
+                raise
+        finally:
+            release_db_connection(conn)
+
+    user_state_store.set(user_id, state_from_row(rows[-1]))
+    for day in {row[1].date() for row in rows}:
+        render_cache.invalidate(user_id, day)
+
+def write_late_samples(user_id: str, samples: List[Dict[str, Any]]) -> MergeResult:
+    """Merge parsed pings that are no newer than the user's latest stored row
+    into their days (see late_samples.py). Call with the user's lock held."""
+    if ingest_buffer is not None and not ingest_buffer.wait_until_flushed(INGEST_LATE_FLUSH_TIMEOUT):
+        raise TimeoutError("Timed out waiting for buffered pings to reach the database")
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # The merge reads the DB rather than the state store, so it only has
+        # to keep other workers' writes out until it commits
+        cur.execute(USER_XACT_LOCK_SQL, (user_id,))
+        result = merge_late_samples(
+            cur, user_id, samples,
+            lambda sample, previous: build_final_row(user_id, sample, previous),
+            advance_running_totals)
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+        # Totals from the merged pings onwards may have moved, the latest
+        # row's included (or, if the commit failed, we don't know)
+        user_state_store.invalidate(user_id)
+    for day in result.days:
+        render_cache.invalidate(user_id, day)
+    return result
+
+def store_samples(user_id: str, parsed: List[Tuple[int, Dict[str, Any]]],
+                  answered: Dict[int, Dict[str, Any]]) -> List[Tuple[int, Tuple]]:
+    """Store a user's parsed (index, sample) pings, oldest first.
+
+    Pings older than the latest stored row are merged into their days,
+    repeats of stored ones are skipped, and the rest are appended. Responses
+    for the merged and repeated pings go into ``answered``, which may hold
+    pings an earlier attempt already merged; returns the appended (index,
+    row) pairs. Call with the user's lock held.
+    """
+    last_record = load_last_state(user_id)
+    late = [(index, sample) for index, sample in parsed
+            if not sample['skip_db_update'] and index not in answered
+            and last_record is not None and sample['time'] < last_record.time]
+    if late:
+        # Delayed, retried or out of order: slot them into their days
+        answered.update(late_responses(write_late_samples(user_id, [s for _, s in late]), late))
+        # The merge may have moved the latest totals
+        last_record = load_last_state(user_id)
+
+    rows = []
+    for index, sample in parsed:
+        if sample['skip_db_update'] or index in answered:
+            continue
+        if last_record is not None and sample['time'] <= last_record.time:
+            # A retry of the latest stored ping, or the same ping twice in a batch
+            answered[index] = location_response(sample, None, duplicate=True)
+            continue
+        row = build_final_row(user_id, sample, last_record)
+        last_record = state_from_row(row)
+        rows.append((index, row))
+    if rows:
+        write_final_rows(user_id, [row for _, row in rows])
+    return rows
+
+def late_responses(merged: MergeResult, late: List[Tuple[int, Dict[str, Any]]]) -> Dict[int, Dict[str, Any]]:
+    """location_response for each (index, sample) that went through write_late_samples."""
+    responses, answered = {}, set()
+    for index, sample in late:
+        row = merged.rows.get(sample['time']) if sample['time'] not in answered else None
+        answered.add(sample['time'])
+        responses[index] = location_response(sample, row, duplicate=row is None)
+    return responses
+
+USER_LOCATION_UPSERT_SQL = """
+    INSERT INTO user_location (user_id, latitude, longitude, utc_offset, updated_at)
+    VALUES (%s, %s, %s, %s, now())
+    ON CONFLICT (user_id) DO UPDATE SET
+        latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude,
+        utc_offset = EXCLUDED.utc_offset, updated_at = EXCLUDED.updated_at
+"""
+
+# Positions this process last wrote to user_location, so a ping only costs
+# a write when the user has moved (or changed time zone)
+recorded_locations: Dict[str, Tuple[float, float, int]] = {}
+
+def rounded_location(location: Tuple[float, float, int]) -> Tuple[float, float, int]:
+    return (round(location[0], LOCATION_DECIMALS), round(location[1], LOCATION_DECIMALS),
+            location[2])
+
+def record_location(user_id: str, location: Optional[Tuple[float, float, int]]) -> None:
+    """Keep user_location up to date for scheduled jobs such as chart
+    pre-generation. Failures are logged, never raised: the ping matters more."""
+    if location is None:
+        return
+    location = rounded_location(location)
+    if recorded_locations.get(user_id) == location:
+        return
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(USER_LOCATION_UPSERT_SQL, (user_id, *location))
+            conn.commit()
+        finally:
+            release_db_connection(conn)
+    except Exception as e:
+        print(f"Error recording location: {str(e)}")
+        return
+    if len(recorded_locations) >= USER_STATE_MAX_USERS:
+        recorded_locations.clear()
+    recorded_locations[user_id] = location
+
+@app.route('/check-location', methods=['POST'])
+def check_location() -> Tuple[Dict[str, Any], int]:
     data = request.get_json()
     if not data:
         return {"error": "Request must be JSON"}, 400
@@ -510,104 +1044,196 @@ def check_location() -> Tuple[Dict[str, Any], int]:
         return {"error": f"Missing required fields: {required_fields}"}, 400
 
     try:
-        device_time = parse_device_time(data['device_time'])
-        current_datetime = device_time
-        current_date = current_datetime.date()
-
-        is_connected_to_wifi = data.get('is_connected_to_wifi', False)
-        weather = data.get('weather', 'Unknown')
-        temperature = data.get('temperature')
-        uv = data.get('uv')
-        sunrise = data.get('sunrise')
-        sunset = data.get('sunset')
-        gps_accuracy = round(float(data['gps_accuracy']), 2)
-        
-        lux = calculate_lux(weather)
-        
-        is_outside = gps_accuracy <= GPS_ACCURACY_THRESHOLD and not is_connected_to_wifi
-        skip_db_update = sunrise and sunset and not is_daytime(sunrise, sunset, current_datetime)
+        sample = parse_location_sample(data, gps_threshold(data['user_id']),
+                                       sample_conditions(data))
+        rows, answered = [], {}
 
-        if not skip_db_update:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                """
-                SELECT time, "outside?", 
-                       time_outside, total_time_outside, total_time_outside_for_given_day 
-                FROM final_table 
-                WHERE user_id = %s 
-                ORDER BY time DESC 
-                LIMIT 1
-                """,
-                (data['user_id'],)
-            )
-            last_record = cur.fetchone()
-
-            # Initialize values
-            time_outside = 0
-            total_time_outside = last_record[3] if last_record else 0
-            total_time_outside_for_given_day = last_record[4] if last_record else 0
-            
-
-            if last_record:
-                time_since_last = (current_datetime - last_record[0]).total_seconds()
-                last_date = last_record[0].date()
-
-                # Calculate time_outside (capped at 10 mins if previous was outside and same day)
-                if last_record[1] and (current_date == last_date):
-                    time_outside = min(time_since_last, MAX_TIME_BETWEEN_UPDATES)
-
-                # Reset daily total if new day
-                if current_date > last_date:
-                    total_time_outside_for_given_day = 0
-
-                # Update totals
-                total_time_outside += time_outside  # Only add the new time_outside value
-                total_time_outside_for_given_day += time_outside  # Only add the new time_outside value
-
-            # First record handling
-            elif is_outside:
-                time_outside = 0  # No previous record to compare with
-                total_time_outside = 0
-                total_time_outside_for_given_day = 0
-
-            total_available_hours = calculate_available_hours(sunrise, sunset) if sunrise and sunset else 0
-
-            cur.execute(
-                """
-                INSERT INTO final_table (
-                    user_id, time, "outside?", 
-                    time_outside, total_time_outside, total_time_outside_for_given_day,
-                    total_available_hours, weather, temperature, uv, gps_accuracy, lux
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    data['user_id'], current_datetime, is_outside,
-                    time_outside, total_time_outside, total_time_outside_for_given_day,
-                    total_available_hours, weather, temperature, uv, gps_accuracy, lux
-                )
-            )
-            conn.commit()
-            conn.close()
-
-        response_data = {
-            "is_outside": is_outside,
-            "gps_accuracy": gps_accuracy,
-            "time_outside": time_outside if not skip_db_update else None,
-            "total_time_outside": total_time_outside if not skip_db_update else None,
-            "total_time_outside_for_given_day": total_time_outside_for_given_day if not skip_db_update else None,
-            "weather": weather,
-            "temperature": temperature,
-            "uv": uv,
-            "lux": lux,
-            "database_updated": not skip_db_update
-        }
+        if not sample['skip_db_update']:
+            # Serialise pings for the same user so two requests can't both
+            # build on the same previous row
+            with user_state_store.user_lock(data['user_id']):
+                rows = store_samples(data['user_id'], [(0, sample)], answered)
 
-        return response_data, 200
+        record_location(data['user_id'], sample['location'])
+        return answered.get(0) or location_response(sample, rows[0][1] if rows else None), 200
 
     except Exception as e:
         print(f"Error in check_location: {str(e)}")
         return {"error": str(e)}, 500
 
+@app.route('/check-location/batch', methods=['POST'])
+def check_location_batch() -> Tuple[Dict[str, Any], int]:
+    """Ingest an ordered array of buffered pings for one user in one pass.
+
+    Each sample has the same fields as a /check-location body, minus
+    user_id. Samples are processed oldest first and written in a single
+    transaction; ``results`` holds one entry per sample in request order,
+    either the usual /check-location response or an ``error``.
+    """
+    data = request.get_json()
+    if not data:
+        return {"error": "Request must be JSON"}, 400
+    if 'user_id' not in data or not isinstance(data.get('samples'), list):
+        return {"error": "user_id and a samples array are required"}, 400
+    if len(data['samples']) > MAX_BATCH_SAMPLES:
+        return {"error": f"At most {MAX_BATCH_SAMPLES} samples per batch"}, 400
+
+    user_id = data['user_id']
+    threshold = gps_threshold(user_id)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(data['samples'])
+    parsed = []
+    for index, raw in enumerate(data['samples']):
+        try:
+            if not isinstance(raw, dict):
+                raise ValueError("sample must be an object")
+            missing = [f for f in ('gps_accuracy', 'device_time') if f not in raw]
+            if missing:
+                raise ValueError(f"Missing required fields: {missing}")
+            parsed.append((index, parse_location_sample(raw, threshold, sample_conditions(raw))))
+        except (ValueError, TypeError) as e:
+            results[index] = {"error": str(e)}
+
+    # Running totals only make sense oldest first; sorted() keeps ties in order
+    parsed.sort(key=lambda item: item[1]['time'])
+
+    try:
+        rows = []
+        answered: Dict[int, Dict[str, Any]] = {}
+        if any(not sample['skip_db_update'] for _, sample in parsed):
+            with user_state_store.user_lock(user_id):
+                rows = store_samples(user_id, parsed, answered)
+
+        written = dict(rows)
+        for index, sample in parsed:
+            results[index] = answered.get(index) or location_response(sample, written.get(index))
+        located = [sample['location'] for _, sample in parsed if sample['location']]
+        if located:
+            record_location(user_id, located[-1])
+
+        return {
+            "user_id": user_id,
+            "received": len(results),
+            "written": sum(1 for result in results if result and result.get('database_updated')),
+            "results": results
+        }, 200
+
+    except Exception as e:
+        print(f"Error in check_location_batch: {str(e)}")
+        return {"error": str(e)}, 500
+
+# Streaming exports of final_table (see export.py). Exporting every user at
+# once needs EXPORT_ADMIN_TOKEN in the X-Admin-Token header; None disables it
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_ADMIN_TOKEN = None
+
+def export_access_error(options: Dict[str, Any], admin_token: Optional[str]) -> Optional[str]:
+    if options['user_id'] is not None:
+        return None
+    if EXPORT_ADMIN_TOKEN and admin_token == EXPORT_ADMIN_TOKEN:
+        return None
+    return "user_id is required"
+
+def export_headers(options: Dict[str, Any]) -> Dict[str, str]:
+    return {"Content-Disposition": f'attachment; filename="{export_filename(options)}"'}
+
+@app.route('/export', methods=['GET'])
+def export_history():
+    """A user's final_table rows (or everyone's, for admin jobs) as CSV or Parquet."""
+    try:
+        options = parse_export_request(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    error = export_access_error(options, request.headers.get('X-Admin-Token'))
+    if error:
+        return jsonify({"error": error}), 403
+
+    conn = get_db_connection()
+
+    def generate():
+        try:
+            yield from stream_export(conn, options, EXPORT_CHUNK_ROWS)
+        except Exception as e:
+            # Headers are already out, so all we can do is cut the file short
+            print(f"Error streaming export: {str(e)}")
+
+    response = Response(generate(), mimetype=EXPORT_FORMATS[options['format']],
+                        headers=export_headers(options))
+    # Runs once the body is sent or the client goes away, even if it never started
+    response.call_on_close(lambda: release_db_connection(conn))
+    return response
+
+def parse_analytics_days(value: Any) -> int:
+    try:
+        days = int(value if value is not None else ACCURACY_ANALYTICS_DAYS)
+    except (TypeError, ValueError):
+        days = 0
+    if days <= 0:
+        raise ValueError("days must be a positive whole number")
+    return days
+
+def accuracy_report(days: int) -> Dict[str, Any]:
+    """Precision/recall of the outdoor call by GPS accuracy, from the feedback."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        _, summary = analyse(cur, days, MAX_TIME_BETWEEN_UPDATES, GPS_ACCURACY_THRESHOLD)
+    finally:
+        release_db_connection(conn)
+    return {"days": days, **summary, "in_use": gps_thresholds.stats()}
+
+@app.route('/accuracy-analytics', methods=['GET'])
+def accuracy_analytics() -> Tuple[Dict[str, Any], int]:
+    try:
+        days = parse_analytics_days(request.args.get('days'))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    try:
+        return accuracy_report(days), 200
+    except Exception as e:
+        print(f"Error computing accuracy analytics: {str(e)}")
+        return {"error": str(e)}, 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms in the Prometheus text format."""
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/db-pool-stats', methods=['GET'])
+def db_pool_stats() -> Tuple[Dict[str, Any], int]:
+    return db_pool.stats(), 200
+
+@app.route('/render-cache-stats', methods=['GET'])
+def render_cache_stats() -> Tuple[Dict[str, Any], int]:
+    return render_cache.stats(), 200
+
+@app.route('/render-pool-stats', methods=['GET'])
+def render_pool_stats() -> Tuple[Dict[str, Any], int]:
+    return render_pool.stats(), 200
+
+@app.route('/pregenerate-stats', methods=['GET'])
+def pregenerate_stats() -> Tuple[Dict[str, Any], int]:
+    from pregenerate import pregenerator
+    return pregenerator.stats(), 200
+
+@app.route('/ingest-stats', methods=['GET'])
+def ingest_stats() -> Tuple[Dict[str, Any], int]:
+    if ingest_buffer is None:
+        return {"mode": INGEST_MODE}, 200
+    return {"mode": INGEST_MODE, **ingest_buffer.stats()}, 200
+
+@app.route('/gps-threshold-stats', methods=['GET'])
+def gps_threshold_stats() -> Tuple[Dict[str, Any], int]:
+    return {"tuned": GPS_THRESHOLDS_TUNED, **gps_thresholds.stats()}, 200
+
+@app.route('/weather-cache-stats', methods=['GET'])
+def weather_cache_stats() -> Tuple[Dict[str, Any], int]:
+    if weather_cache is None:
+        return {"provider": None}, 200
+    return weather_cache.stats(), 200
+
+@app.route('/user-state-stats', methods=['GET'])
+def user_state_stats() -> Tuple[Dict[str, Any], int]:
+    return user_state_store.stats(), 200
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,644 @@
+"""Production ASGI entry point, serving app.py's routes on asyncpg.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Request and response bodies are the same as the Flask app's. More than one
+worker (--workers N) needs USER_STATE_REDIS_URL so they share each user's
+latest row and lock; without it a second worker refuses pings. Database
+access goes through an asyncpg pool, so a waiting query doesn't tie up a
+thread. Chart renders still run on app.render_pool's worker processes; the
+event loop only waits on them from a helper thread. Configuration, the
+render cache, the user state store and the ingest buffer are all shared with
+app.py.
+"""
+import asyncio
+import base64
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, time
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+import app as flask_app
+from app import (
+    CHART_MIME_TYPES, CHART_RANGE_DAYS, COMPRESS_BROTLI_QUALITY, COMPRESS_GZIP_LEVEL,
+    COMPRESS_MIN_BYTES, DAILY_CHART_DPI, DAILY_CHART_WIDTH_INCHES, DB_CONFIG, MAX_BATCH_SAMPLES, MAX_TIME_BETWEEN_UPDATES, USER_LOCATION_UPSERT_SQL, WEEKLY_CHART_DPI,
+    WEEKLY_CHART_WIDTH_INCHES,
+    accuracy_report, build_final_row, chart_range_series, chart_range_start, chart_validator,
+    daily_cache_key, daily_payload, export_access_error, export_headers, format_time, get_hour_markers,
+    gps_threshold, late_responses, location_response, parse_analytics_days, parse_chart_options, parse_clock,
+    parse_device_time, parse_location_sample, recorded_locations, render_cache, render_pool,
+    resolve_sun_times, rounded_location, state_from_row, user_state_store, weather_cache,
+    weather_position, weekly_cache_key, write_late_samples,
+)
+from daily_summary import (DAILY_SUMMARY_UPSERT_SQL, READ_DAILY_SUMMARY_SQL,
+                           summaries_by_day, summarise_rows)
+from export import EXPORT_FORMATS, export_query, make_encoder, parse_export_request
+from http_cache import CompressionMiddleware, etag_matches
+from ingest_buffer import FINAL_TABLE_COLUMNS
+from metrics import current_route, render_prometheus, request_seconds, span
+from outdoor_time import OUTDOOR_INTERVALS_SQL, merge_intervals
+from render_pool import RenderUnavailable
+from segments import build_segments
+from user_state import LATEST_STATE_SQL, LastState
+from weather import Conditions
+
+ASYNC_DB_POOL_MIN_SIZE = 2
+ASYNC_DB_POOL_MAX_SIZE = 20
+ASYNC_DB_POOL_TIMEOUT = 5.0  # seconds to wait for a free connection
+USER_LOCK_STRIPES = 256
+
+db_pool: Optional[asyncpg.Pool] = None
+
+# Same role as user_state_store.user_lock, but awaitable so a user waiting on
+# their own earlier ping doesn't block the event loop
+_user_locks = [asyncio.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+
+@asynccontextmanager
+async def user_lock(user_id: str):
+    """Hold ``user_id``'s lock in this process and, if the state store is
+    shared, across every worker too."""
+    async with _user_locks[hash(user_id) % len(_user_locks)]:
+        if not user_state_store.shared:
+            yield
+            return
+        shared_lock = user_state_store.user_lock(user_id)
+        await asyncio.to_thread(shared_lock.acquire)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(shared_lock.release)
+
+
+@lru_cache(maxsize=None)
+def _pg(query: str) -> str:
+    """Rewrite psycopg2's %s placeholders as asyncpg's $1, $2, ..."""
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda _: f"${next(counter)}", query)
+
+
+FINAL_TABLE_TYPES = ('text', 'timestamp', 'boolean', 'float8', 'float8', 'float8',
+                     'float8', 'text', 'float8', 'float8', 'float8', 'integer')
+# One statement for any number of rows, one array per column, so RETURNING
+# can say which rows weren't already stored
+INSERT_FINAL_ROWS_SQL = (
+    f"INSERT INTO final_table ({', '.join(FINAL_TABLE_COLUMNS)}) "
+    f"SELECT * FROM unnest({', '.join(f'${i}::{t}[]' for i, t in enumerate(FINAL_TABLE_TYPES, 1))}) "
+    "ON CONFLICT (user_id, time) DO NOTHING RETURNING user_id, time"
+)
+UPSERT_SUMMARY_SQL = DAILY_SUMMARY_UPSERT_SQL.format(
+    values='(' + ', '.join(f"${i}" for i in range(1, 8)) + ')')
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global db_pool
+    db_pool = await asyncpg.create_pool(
+        host=DB_CONFIG['host'], database=DB_CONFIG['database'],
+        user=DB_CONFIG['user'], password=DB_CONFIG['password'],
+        min_size=ASYNC_DB_POOL_MIN_SIZE, max_size=ASYNC_DB_POOL_MAX_SIZE)
+    flask_app.warm_up_renderers()
+    flask_app.start_pregeneration()
+    try:
+        yield
+    finally:
+        if flask_app.PREGENERATE_CHARTS:
+            from pregenerate import pregenerator
+            pregenerator.shutdown()
+        await db_pool.close()
+        render_pool.shutdown()
+        if flask_app.ingest_buffer is not None:
+            flask_app.ingest_buffer.close()
+
+
+app = FastAPI(lifespan=lifespan)
+if flask_app.COMPRESS_RESPONSES:
+    # Added before observe_request so it sits inside it and is part of the timing
+    app.add_middleware(CompressionMiddleware, min_bytes=COMPRESS_MIN_BYTES,
+                       gzip_level=COMPRESS_GZIP_LEVEL, brotli_quality=COMPRESS_BROTLI_QUALITY)
+
+
+@app.middleware('http')
+async def observe_request(request: Request, call_next):
+    # Label by route path; anything else shares one label to bound cardinality
+    path = request.url.path
+    route = path if path in _route_paths() else 'unmatched'
+    token = current_route.set(route)
+    started = perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        request_seconds.observe((route, request.method, str(status)), perf_counter() - started)
+        current_route.reset(token)
+
+
+@lru_cache(maxsize=None)
+def _route_paths() -> frozenset:
+    return frozenset(getattr(route, 'path', None) for route in app.routes)
+
+
+async def _json_body(request: Request) -> Optional[Dict[str, Any]]:
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+async def _chart_request_data(request: Request) -> Optional[Dict[str, Any]]:
+    if request.method == 'GET':
+        return dict(request.query_params)
+    return await _json_body(request)
+
+
+def _connection():
+    return db_pool.acquire(timeout=ASYNC_DB_POOL_TIMEOUT)
+
+
+async def _store(fn, *args):
+    # The Redis store does network I/O; the local one is a dict lookup
+    if flask_app.USER_STATE_REDIS_URL:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def chart_response(image: Optional[bytes], options: Dict[str, Any],
+                   payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> Response:
+    if image is None:
+        return JSONResponse(payload, headers=headers)
+    if options['encoding'] == 'binary':
+        return Response(image, media_type=CHART_MIME_TYPES[options['format']], headers=headers)
+    with span('base64_encode'):
+        encoded = base64.b64encode(image).decode('utf-8')
+    return JSONResponse({
+        "image": encoded,
+        "image_format": options['format'],
+        **payload
+    }, headers=headers)
+
+
+def render_unavailable(e) -> JSONResponse:
+    return JSONResponse({"error": str(e)}, status_code=503,
+                        headers={"Retry-After": str(e.retry_after)})
+
+
+async def load_last_state(user_id: str) -> Optional[LastState]:
+    """Async counterpart of app.load_last_state."""
+    state = await _store(user_state_store.get, user_id)
+    if state is not None:
+        return state
+
+    if flask_app.ingest_buffer is not None:
+        row = flask_app.ingest_buffer.latest_for_user(user_id)
+        if row is not None:
+            state = state_from_row(row)
+            await _store(user_state_store.set, user_id, state)
+            return state
+
+    async with _connection() as conn:
+        record = await conn.fetchrow(_pg(LATEST_STATE_SQL), user_id)
+    if record is None:
+        return None
+    state = LastState(*record)
+    await _store(user_state_store.set, user_id, state)
+    return state
+
+
+def _append_rows(rows: List[Tuple]) -> None:
+    for row in rows:
+        flask_app.ingest_buffer.append(row)
+
+
+async def write_final_rows(user_id: str, rows: List[Tuple]) -> None:
+    """Async counterpart of app.write_final_rows. Call with the user's lock held."""
+    if flask_app.ingest_buffer is not None:
+        # append() fsyncs, so keep it off the event loop
+        await asyncio.to_thread(_append_rows, rows)
+    else:
+        async with _connection() as conn:
+            try:
+                async with conn.transaction():
+                    stored = await conn.fetch(INSERT_FINAL_ROWS_SQL,
+                                              *(list(column) for column in zip(*rows)))
+                    keys = {(record[0], record[1]) for record in stored}
+                    # A retry that another worker already stored mustn't be counted twice
+                    written = [row for row in rows if (row[0], row[1]) in keys]
+                    await conn.executemany(UPSERT_SUMMARY_SQL, summarise_rows(written))
+            except Exception:
+                # We no longer know whether the rows landed
+                await _store(user_state_store.invalidate, user_id)
+                raise
+
+    await _store(user_state_store.set, user_id, state_from_row(rows[-1]))
+    for day in {row[1].date() for row in rows}:
+        render_cache.invalidate(user_id, day)
+
+
+async def store_samples(user_id: str, parsed: List[Tuple[int, Dict[str, Any]]],
+                        answered: Dict[int, Dict[str, Any]]) -> List[Tuple[int, Tuple]]:
+    """Async counterpart of app.store_samples. Call with the user's lock held."""
+    last_record = await load_last_state(user_id)
+    late = [(index, sample) for index, sample in parsed
+            if not sample['skip_db_update'] and index not in answered
+            and last_record is not None and sample['time'] < last_record.time]
+    if late:
+        # Rare, so it shares the psycopg2 implementation in a thread
+        merged = await asyncio.to_thread(write_late_samples, user_id, [s for _, s in late])
+        answered.update(late_responses(merged, late))
+        last_record = await load_last_state(user_id)
+
+    rows = []
+    for index, sample in parsed:
+        if sample['skip_db_update'] or index in answered:
+            continue
+        if last_record is not None and sample['time'] <= last_record.time:
+            answered[index] = location_response(sample, None, duplicate=True)
+            continue
+        row = build_final_row(user_id, sample, last_record)
+        last_record = state_from_row(row)
+        rows.append((index, row))
+    if rows:
+        await write_final_rows(user_id, [row for _, row in rows])
+    return rows
+
+
+async def sample_conditions(data: Dict[str, Any]) -> Optional[Conditions]:
+    """Async counterpart of app.sample_conditions; only a cache miss leaves
+    the event loop."""
+    position = weather_position(data)
+    if position is None:
+        return None
+    found, conditions = weather_cache.cached(*position)
+    if found:
+        return conditions
+    return await asyncio.to_thread(weather_cache.get, *position)
+
+
+async def record_location(user_id: str, location: Optional[Tuple[float, float, int]]) -> None:
+    """Async counterpart of app.record_location."""
+    if location is None:
+        return
+    location = rounded_location(location)
+    if recorded_locations.get(user_id) == location:
+        return
+    try:
+        async with _connection() as conn:
+            await conn.execute(_pg(USER_LOCATION_UPSERT_SQL), user_id, *location)
+    except Exception as e:
+        print(f"Error recording location: {str(e)}")
+        return
+    if len(recorded_locations) >= flask_app.USER_STATE_MAX_USERS:
+        recorded_locations.clear()
+    recorded_locations[user_id] = location
+
+
+@app.post('/submit-feedback')
+async def submit_feedback(request: Request):
+    data = await _json_body(request)
+    if not data:
+        return JSONResponse({"error": "Request must be JSON"}, status_code=400)
+
+    required_fields = ['user_id', 'correct_result', 'gps_accuracy', 'device_time']
+    if not all(field in data for field in required_fields):
+        return JSONResponse({"error": f"Missing required fields: {required_fields}"}, status_code=400)
+
+    try:
+        device_time = parse_device_time(data['device_time'])
+        async with _connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO app_accuracy (user_id, time, correct_result, gps_accuracy,
+                                          is_connected_to_wifi)
+                VALUES ($1, $2, $3, $4, $5)
+                """,
+                data['user_id'], device_time,
+                data['correct_result'], round(data['gps_accuracy'], 2),
+                data.get('is_connected_to_wifi')
+            )
+        return JSONResponse({"message": "Feedback submitted successfully"})
+    except Exception as e:
+        return JSONResponse({"error": f"Database error: {str(e)}"}, status_code=500)
+
+
+@app.api_route('/daily-visualisation', methods=['GET', 'POST'])
+async def daily_visualisation(request: Request):
+    try:
+        data = await _chart_request_data(request)
+        if not data or 'user_id' not in data or 'device_time' not in data:
+            return JSONResponse({"error": "user_id and device_time are required"}, status_code=400)
+
+        try:
+            options = parse_chart_options(data, DAILY_CHART_DPI, DAILY_CHART_WIDTH_INCHES)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        device_time = parse_device_time(data['device_time'])
+        user_id = data['user_id']
+        today = device_time.date()
+        sunrise_str, sunset_str = resolve_sun_times(data, today)
+        if not sunrise_str or not sunset_str:
+            return JSONResponse({"error": "sunrise and sunset (or latitude and longitude) are required"},
+                                status_code=400)
+
+        try:
+            sunrise_time = parse_clock(sunrise_str)
+            sunset_time = parse_clock(sunset_str)
+        except ValueError:
+            return JSONResponse({"error": "Invalid time format (expected HH:MM)"}, status_code=400)
+
+        start_of_day = datetime.combine(today, time(0, 0))
+        end_of_day = datetime.combine(today, time(23, 59, 59))
+        async with _connection() as conn:
+            total_result = await conn.fetchrow(
+                """SELECT total_time_outside_for_given_day
+                   FROM final_table
+                   WHERE user_id = $1 AND time BETWEEN $2 AND $3
+                   ORDER BY time DESC
+                   LIMIT 1""",
+                user_id, start_of_day, end_of_day
+            )
+            intervals = merge_intervals(await conn.fetch(
+                _pg(OUTDOOR_INTERVALS_SQL), float(MAX_TIME_BETWEEN_UPDATES), user_id,
+                start_of_day, datetime.combine(today, time(23, 59, 59, 999999))))
+        total_time_seconds = total_result[0] if total_result else 0
+
+        outdoor_segments = build_segments(
+            ((start.time(), end.time()) for start, end in intervals),
+            today, sunrise_time, sunset_time)
+        hour_markers = get_hour_markers(today, sunrise_time, sunset_time)
+        current_time = device_time.time()
+        formatted_time = format_time(total_time_seconds)
+
+        payload = daily_payload(formatted_time, sunrise_str, sunset_str, outdoor_segments,
+                                hour_markers, current_time)
+
+        cache_key = daily_cache_key(user_id, today, sunrise_str, sunset_str, sunrise_time,
+                                    sunset_time, formatted_time, outdoor_segments,
+                                    device_time, options)
+        headers = chart_validator(cache_key, options, payload, today)
+        if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        if options['mode'] == 'data':
+            return chart_response(None, options, payload, headers)
+
+        image = render_cache.get(cache_key)
+        if image is None:
+            image = await asyncio.to_thread(
+                render_pool.render_daily, today, sunrise_str, sunset_str,
+                sunrise_time, sunset_time, outdoor_segments, hour_markers,
+                current_time, formatted_time, fmt=options['format'], dpi=options['dpi'])
+            render_cache.put(cache_key, image)
+        return chart_response(image, options, payload, headers)
+
+    except RenderUnavailable as e:
+        return render_unavailable(e)
+    except Exception as e:
+        print(f"Visualization error: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.api_route('/weekly-time-outside-graph', methods=['GET', 'POST'])
+async def weekly_time_outside_graph(request: Request):
+    try:
+        data = await _chart_request_data(request)
+        if not data or 'user_id' not in data or 'device_time' not in data:
+            return JSONResponse({"error": "user_id and device_time are required"}, status_code=400)
+
+        try:
+            options = parse_chart_options(data, WEEKLY_CHART_DPI, WEEKLY_CHART_WIDTH_INCHES)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        chart_range = data.get('range', 'week')
+        if chart_range not in CHART_RANGE_DAYS:
+            return JSONResponse({"error": f"range must be one of {list(CHART_RANGE_DAYS)}"},
+                                status_code=400)
+
+        today = parse_device_time(data['device_time']).date()
+        start_date = chart_range_start(chart_range, today)
+        async with _connection() as conn:
+            summaries = summaries_by_day(await conn.fetch(
+                _pg(READ_DAILY_SUMMARY_SQL), data['user_id'], start_date, today))
+        day_names, minutes = chart_range_series(chart_range, today, start_date, summaries)
+
+        payload = {
+            "range": chart_range,
+            "days": day_names,
+            "minutes": minutes,
+            "seconds": [m * 60 for m in minutes]
+        }
+
+        cache_key = weekly_cache_key(data['user_id'], today, chart_range, minutes, options)
+        headers = chart_validator(cache_key, options, payload, today)
+        if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+            return Response(status_code=304, headers=headers)
+        if options['mode'] == 'data':
+            return chart_response(None, options, payload, headers)
+
+        image = render_cache.get(cache_key)
+        if image is None:
+            image = await asyncio.to_thread(render_pool.render_weekly, day_names, minutes,
+                                            fmt=options['format'], dpi=options['dpi'])
+            render_cache.put(cache_key, image)
+        return chart_response(image, options, payload, headers)
+
+    except RenderUnavailable as e:
+        return render_unavailable(e)
+    except Exception as e:
+        print(f"Error in weekly graph generation: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.post('/check-location')
+async def check_location(request: Request):
+    data = await _json_body(request)
+    if not data:
+        return JSONResponse({"error": "Request must be JSON"}, status_code=400)
+
+    required_fields = ['user_id', 'gps_accuracy', 'device_time']
+    if not all(field in data for field in required_fields):
+        return JSONResponse({"error": f"Missing required fields: {required_fields}"}, status_code=400)
+
+    try:
+        sample = parse_location_sample(data, gps_threshold(data['user_id']),
+                                       await sample_conditions(data))
+        rows, answered = [], {}
+
+        if not sample['skip_db_update']:
+            async with user_lock(data['user_id']):
+                rows = await store_samples(data['user_id'], [(0, sample)], answered)
+
+        await record_location(data['user_id'], sample['location'])
+        return JSONResponse(answered.get(0) or location_response(sample, rows[0][1] if rows else None))
+
+    except Exception as e:
+        print(f"Error in check_location: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.post('/check-location/batch')
+async def check_location_batch(request: Request):
+    """Same contract as app.check_location_batch."""
+    data = await _json_body(request)
+    if not data:
+        return JSONResponse({"error": "Request must be JSON"}, status_code=400)
+    if 'user_id' not in data or not isinstance(data.get('samples'), list):
+        return JSONResponse({"error": "user_id and a samples array are required"}, status_code=400)
+    if len(data['samples']) > MAX_BATCH_SAMPLES:
+        return JSONResponse({"error": f"At most {MAX_BATCH_SAMPLES} samples per batch"},
+                            status_code=400)
+
+    user_id = data['user_id']
+    threshold = gps_threshold(user_id)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(data['samples'])
+    parsed = []
+    for index, raw in enumerate(data['samples']):
+        try:
+            if not isinstance(raw, dict):
+                raise ValueError("sample must be an object")
+            missing = [f for f in ('gps_accuracy', 'device_time') if f not in raw]
+            if missing:
+                raise ValueError(f"Missing required fields: {missing}")
+            parsed.append((index, parse_location_sample(raw, threshold,
+                                                        await sample_conditions(raw))))
+        except (ValueError, TypeError) as e:
+            results[index] = {"error": str(e)}
+
+    parsed.sort(key=lambda item: item[1]['time'])
+
+    try:
+        rows = []
+        answered: Dict[int, Dict[str, Any]] = {}
+        if any(not sample['skip_db_update'] for _, sample in parsed):
+            async with user_lock(user_id):
+                rows = await store_samples(user_id, parsed, answered)
+
+        written = dict(rows)
+        for index, sample in parsed:
+            results[index] = answered.get(index) or location_response(sample, written.get(index))
+        located = [sample['location'] for _, sample in parsed if sample['location']]
+        if located:
+            await record_location(user_id, located[-1])
+
+        return JSONResponse({
+            "user_id": user_id,
+            "received": len(results),
+            "written": sum(1 for result in results if result and result.get('database_updated')),
+            "results": results
+        })
+
+    except Exception as e:
+        print(f"Error in check_location_batch: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def _export_chunks(options: Dict[str, Any]):
+    query, params = export_query(options['user_id'], options['start'], options['end'])
+    encoder = make_encoder(options['format'])
+    chunk_rows = flask_app.EXPORT_CHUNK_ROWS
+    try:
+        async with _connection() as conn, conn.transaction():
+            cursor = await conn.cursor(_pg(query), *params)
+            while True:
+                rows = await cursor.fetch(chunk_rows)
+                if not rows:
+                    break
+                # Encoding (Parquet especially) is CPU work; keep it off the loop
+                chunk = await asyncio.to_thread(encoder.encode, [tuple(row) for row in rows])
+                if chunk:
+                    yield chunk
+        tail = await asyncio.to_thread(encoder.close)
+        if tail:
+            yield tail
+    except Exception as e:
+        # Headers are already out, so all we can do is cut the file short
+        print(f"Error streaming export: {str(e)}")
+
+
+@app.get('/export')
+async def export_history(request: Request):
+    try:
+        options = parse_export_request(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    error = export_access_error(options, request.headers.get('X-Admin-Token'))
+    if error:
+        return JSONResponse({"error": error}, status_code=403)
+    return StreamingResponse(_export_chunks(options), media_type=EXPORT_FORMATS[options['format']],
+                             headers=export_headers(options))
+
+
+@app.get('/metrics')
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/db-pool-stats')
+async def db_pool_stats():
+    return {
+        "driver": "asyncpg",
+        "size": db_pool.get_size(),
+        "idle": db_pool.get_idle_size(),
+        "min_size": db_pool.get_min_size(),
+        "max_size": db_pool.get_max_size(),
+    }
+
+
+@app.get('/render-cache-stats')
+async def render_cache_stats():
+    return render_cache.stats()
+
+
+@app.get('/render-pool-stats')
+async def render_pool_stats():
+    return render_pool.stats()
+
+
+@app.get('/pregenerate-stats')
+async def pregenerate_stats():
+    return flask_app.pregenerate_stats()[0]
+
+
+@app.get('/ingest-stats')
+async def ingest_stats():
+    return flask_app.ingest_stats()[0]
+
+
+@app.get('/accuracy-analytics')
+async def accuracy_analytics(request: Request):
+    try:
+        days = parse_analytics_days(request.query_params.get('days'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        # One psycopg2 query plus numpy over the result; keep it off the loop
+        return await asyncio.to_thread(accuracy_report, days)
+    except Exception as e:
+        print(f"Error computing accuracy analytics: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.get('/gps-threshold-stats')
+async def gps_threshold_stats():
+    return flask_app.gps_threshold_stats()[0]
+
+
+@app.get('/weather-cache-stats')
+async def weather_cache_stats():
+    if weather_cache is None:
+        return {"provider": None}
+    return weather_cache.stats()
+
+
+@app.get('/user-state-stats')
+async def user_state_stats():
+    return await _store(user_state_store.stats)
@@ -0,0 +1,132 @@
+"""PNG encoding that only recompresses the rows that changed.
+
+Most of a daily chart is the static layer. BandedPng compresses a reference
+image once as horizontal bands, each a self-contained run of deflate data
+(a full flush resets the compressor between bands, and each band's first
+row is filtered without looking at the row above). A frame is encoded by
+comparing it with the reference band by band, compressing only the bands
+that differ, and splicing the rest in from the cache. The Adler-32 of the
+whole stream is combined from the per-band checksums, so unchanged bands
+cost a comparison and nothing else. The reference is compressed hard, once;
+changed bands use run-length matching, which is fast and suits the long
+zero runs the Up filter leaves in flat colour.
+
+The output is a standard 8-bit RGBA PNG that decodes to exactly the frame's
+pixels.
+"""
+import struct
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_ADLER_BASE = 65521
+_FILTER_SUB = 1
+_FILTER_UP = 2
+# An empty final deflate block (fixed Huffman, BFINAL set) to end the stream
+_FINAL_BLOCK = b'\x03\x00'
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)))
+
+
+def adler32_combine(first: int, second: int, second_length: int) -> int:
+    """Adler-32 of two byte strings joined, from their own checksums (zlib's
+    adler32_combine)."""
+    remainder = second_length % _ADLER_BASE
+    sum1 = first & 0xffff
+    sum2 = remainder * sum1 % _ADLER_BASE
+    sum1 += (second & 0xffff) + _ADLER_BASE - 1
+    sum2 += (first >> 16) + (second >> 16) + _ADLER_BASE - remainder
+    sum1 %= _ADLER_BASE
+    sum2 %= _ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def filter_rows(rows: np.ndarray) -> bytes:
+    """PNG scanlines for ``rows`` (height x width x 4 uint8): Sub for the
+    first row, so it doesn't depend on the row above, and Up for the rest."""
+    height, width, channels = rows.shape
+    stride = width * channels
+    flat = rows.reshape(height, stride)
+    out = np.empty((height, stride + 1), dtype=np.uint8)
+    out[0, 0] = _FILTER_SUB
+    out[0, 1:channels + 1] = flat[0, :channels]
+    np.subtract(flat[0, channels:], flat[0, :-channels], out=out[0, channels + 1:])
+    out[1:, 0] = _FILTER_UP
+    np.subtract(flat[1:], flat[:-1], out=out[1:, 1:])
+    return out.tobytes()
+
+
+class _Band:
+    __slots__ = ('data', 'adler', 'length')
+
+    def __init__(self, data: bytes, adler: int, length: int):
+        self.data = data
+        self.adler = adler
+        self.length = length
+
+
+class BandedPng:
+    """Encodes frames of one size as PNGs, reusing ``reference``'s compressed
+    bands wherever a frame matches it."""
+
+    def __init__(self, reference: np.ndarray, dpi: Optional[float] = None,
+                 software: Optional[str] = None, band_rows: int = 16):
+        if reference.ndim != 3 or reference.shape[2] != 4 or reference.dtype != np.uint8:
+            raise ValueError("reference must be a height x width x 4 uint8 array")
+        self.reference = np.array(reference, copy=True)
+        self.band_rows = band_rows
+        height, width = reference.shape[:2]
+
+        header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+        head = [PNG_SIGNATURE, _chunk(b'IHDR', header)]
+        if software:
+            head.append(_chunk(b'tEXt', b'Software\x00' + software.encode('latin-1')))
+        if dpi:
+            per_metre = int(round(dpi / 0.0254))
+            head.append(_chunk(b'pHYs', struct.pack('>IIB', per_metre, per_metre, 1)))
+        self._head = b''.join(head)
+        self._bands: List[_Band] = [self._compress(start) for start in self._starts()]
+        self.bands_reused = 0
+        self.bands_compressed = 0
+
+    def _starts(self) -> range:
+        return range(0, self.reference.shape[0], self.band_rows)
+
+    def _compress(self, start: int, frame: Optional[np.ndarray] = None) -> _Band:
+        if frame is None:
+            rows, level, strategy = self.reference, 9, zlib.Z_DEFAULT_STRATEGY
+        else:
+            rows, level, strategy = frame, 6, zlib.Z_RLE
+        raw = filter_rows(rows[start:start + self.band_rows])
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy)
+        data = compressor.compress(raw) + compressor.flush(zlib.Z_FULL_FLUSH)
+        return _Band(data, zlib.adler32(raw), len(raw))
+
+    def nbytes(self) -> int:
+        return self.reference.nbytes + sum(len(band.data) for band in self._bands)
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        """``frame`` (the reference's shape, RGBA uint8) as PNG bytes."""
+        if frame.shape != self.reference.shape:
+            raise ValueError("frame and reference differ in size")
+        parts: List[bytes] = [b'\x78\x9c']
+        adler = 1
+        reused = 0
+        for start, band in zip(self._starts(), self._bands):
+            end = start + self.band_rows
+            if not np.array_equal(frame[start:end], self.reference[start:end]):
+                band = self._compress(start, frame)
+            else:
+                reused += 1
+            parts.append(band.data)
+            adler = adler32_combine(adler, band.adler, band.length)
+        parts.append(_FINAL_BLOCK)
+        parts.append(struct.pack('>I', adler))
+        self.bands_reused += reused
+        self.bands_compressed += len(self._bands) - reused
+        return b''.join((self._head, _chunk(b'IDAT', b''.join(parts)), _chunk(b'IEND', b'')))
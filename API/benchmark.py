@@ -0,0 +1,535 @@
+"""Load and render benchmarks for the API against a local PostgreSQL.
+
+``python benchmark.py seed`` migrates a throwaway database and fills it with
+synthetic users and months of 5-minute daylight pings. ``python benchmark.py
+run`` then serves app.py on that database in-process (or targets a running
+server with ``--base-url``) and drives every route at a fixed concurrency,
+reporting throughput, p50/p90/p99 latency, payload sizes and, from /metrics,
+the render and query spans behind them. Results are written as JSON; pass
+``--baseline`` with an earlier result to fail on regressions.
+
+Both commands only touch users whose id starts with USER_PREFIX, but point
+``--dsn`` at a database you can afford to load, never production.
+"""
+import argparse
+import http.client
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import numpy as np
+import psycopg2
+
+from daily_summary import backfill as backfill_summaries
+from ingest_buffer import insert_final_rows
+from lux import CONDITION_TRANSMISSION, estimate_lux_array
+from solar import default_utc_offset, solar_elevation, sun_times
+
+DEFAULT_DSN = "postgresql://postgres@localhost:5432/solas_bench"
+USER_PREFIX = 'bench-'
+PING_INTERVAL = 300  # seconds, as sent by the app's background task
+MAX_TIME_BETWEEN_UPDATES = 600  # must match app.py
+LATITUDE, LONGITUDE = 53.35, -6.26  # Dublin
+WEATHER = [condition for condition in CONDITION_TRANSMISSION if condition != 'unknown']
+
+# A regression is a latency this much higher, or throughput this much lower,
+# than the baseline's
+DEFAULT_MAX_REGRESSION = 0.2
+
+
+def _user_ids(users: int) -> List[str]:
+    return [f"{USER_PREFIX}{index:04d}" for index in range(users)]
+
+
+def synthetic_rows(user_id: str, first_day: date, days: int,
+                   rng: random.Random) -> Iterator[Tuple]:
+    """final_table rows (FINAL_TABLE_COLUMNS order) for ``days`` days of
+    pings every PING_INTERVAL seconds between sunrise and sunset, with
+    running totals worked out the way /check-location does."""
+    utc_offset = default_utc_offset(LONGITUDE)
+    total = 0.0
+    for day_offset in range(days):
+        day = first_day + timedelta(days=day_offset)
+        sunrise, sunset = sun_times(LATITUDE, LONGITUDE, day, utc_offset)
+        if sunrise is None:
+            continue
+        start = datetime.combine(day, sunrise)
+        count = int((datetime.combine(day, sunset) - start).total_seconds() // PING_INTERVAL) + 1
+        moments = [start + timedelta(seconds=i * PING_INTERVAL + rng.randint(0, 20)) for i in range(count)]
+        available_hours = round(count * PING_INTERVAL / 3600, 2)
+
+        # Outdoor streaks of a few pings, more of them around midday
+        outside, flags = False, []
+        for i in range(count):
+            midday = 1 - abs(2 * i / max(count - 1, 1) - 1)
+            if rng.random() < (0.1 + 0.2 * midday if not outside else 0.3):
+                outside = not outside
+            flags.append(outside)
+
+        weather = [rng.choice(WEATHER)] * count
+        utc = np.array(moments, dtype='datetime64[s]') - np.timedelta64(utc_offset, 'm')
+        lux = estimate_lux_array(weather, solar_elevation(LATITUDE, LONGITUDE, utc))
+        day_total = 0.0
+        for i, moment in enumerate(moments):
+            time_outside = 0.0
+            if i and flags[i - 1]:
+                time_outside = min((moment - moments[i - 1]).total_seconds(), MAX_TIME_BETWEEN_UPDATES)
+            total += time_outside
+            day_total += time_outside
+            accuracy = rng.uniform(3, 9) if flags[i] else rng.uniform(12, 40)
+            yield (user_id, moment, flags[i], time_outside, total, day_total,
+                   available_hours, weather[i], round(rng.uniform(5, 20), 1),
+                   round(rng.uniform(0, 5), 1), round(accuracy, 2), int(lux[i]))
+
+
+def reset(cur, since: Optional[date] = None) -> None:
+    """Delete benchmark users' rows (from ``since`` onwards, if given)."""
+    pattern = USER_PREFIX + '%'
+    if since is None:
+        cur.execute("DELETE FROM final_table WHERE user_id LIKE %s", (pattern,))
+        cur.execute("DELETE FROM daily_summary WHERE user_id LIKE %s", (pattern,))
+        cur.execute("DELETE FROM app_accuracy WHERE user_id LIKE %s", (pattern,))
+        return
+    cur.execute("DELETE FROM final_table WHERE user_id LIKE %s AND time >= %s", (pattern, since))
+    cur.execute("DELETE FROM daily_summary WHERE user_id LIKE %s AND day >= %s", (pattern, since))
+
+
+def seed(conn, users: int, days: int, random_seed: int) -> int:
+    """Migrate, then replace the benchmark users' history with ``days`` days
+    ending yesterday. Returns the number of rows written."""
+    from schema import migrate
+
+    migrate(conn)
+    conn.autocommit = False
+    cur = conn.cursor()
+    reset(cur)
+    first_day = date.today() - timedelta(days=days)
+    rng = random.Random(random_seed)
+    written = 0
+    for user_id in _user_ids(users):
+        rows = list(synthetic_rows(user_id, first_day, days, rng))
+        insert_final_rows(cur, rows, page_size=1000)
+        written += len(rows)
+        conn.commit()
+        print(f"Seeded {user_id}: {len(rows)} rows")
+    backfill_summaries(cur, since=first_day)
+    cur.execute("ANALYZE final_table")
+    cur.execute("ANALYZE daily_summary")
+    conn.commit()
+    return written
+
+
+class Scenario:
+    """One route under load. ``body(worker, n)`` builds the n-th request a
+    worker sends; ``route`` is the label the API records spans under."""
+
+    def __init__(self, name: str, method: str, path: str,
+                 body: Optional[Callable[[int, int], Dict[str, Any]]] = None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.route = path.split('?')[0]
+
+
+def _device_time(moment: datetime) -> str:
+    return moment.strftime("%d-%m-%Y %H:%M:%S")
+
+
+def build_scenarios(users: int, days: int, concurrency: int) -> Dict[str, Scenario]:
+    user_ids = _user_ids(users)
+    today = date.today()
+    utc_offset = default_utc_offset(LONGITUDE)
+    location = {"latitude": LATITUDE, "longitude": LONGITUDE, "utc_offset": utc_offset}
+    # Live pings are today's, from local noon on, so the sun is always up
+    noon = datetime.combine(today, datetime.min.time()) + timedelta(hours=12)
+
+    def own_user(worker: int, n: int) -> Tuple[str, int]:
+        # Workers own disjoint users where they can, so a user's pings stay in order
+        owned = user_ids[worker % users::concurrency] or user_ids
+        return owned[n % len(owned)], n // len(owned)
+
+    def ping(worker: int, n: int) -> Dict[str, Any]:
+        user_id, k = own_user(worker, n)
+        accuracy = 5.0 if k % 6 < 3 else 25.0
+        return {"user_id": user_id, "gps_accuracy": accuracy, "is_connected_to_wifi": False,
+                "device_time": _device_time(noon + timedelta(seconds=5 * k + worker % 5)),
+                "weather": "Partly cloudy", "temperature": 14.0, "uv": 3.0, **location}
+
+    def batch(worker: int, n: int) -> Dict[str, Any]:
+        user_id, k = own_user(worker, n)
+        start = noon + timedelta(hours=4, seconds=12 * 60 * k)
+        samples = [{"gps_accuracy": 5.0 if i % 4 else 30.0, "device_time": _device_time(start + timedelta(seconds=60 * i)),
+                    "weather": "Sunny", "uv": 4.0, **location} for i in range(12)]
+        return {"user_id": user_id, "samples": samples}
+
+    def feedback(worker: int, n: int) -> Dict[str, Any]:
+        user_id, _ = own_user(worker, n)
+        return {"user_id": user_id, "correct_result": n % 5 != 0,
+                "gps_accuracy": 4.0 + n % 20, "device_time": _device_time(noon)}
+
+    def daily(worker: int, n: int) -> Dict[str, Any]:
+        # A different user-day each time, so most requests miss the render cache
+        rng = random.Random(worker * 1_000_003 + n)
+        day = today - timedelta(days=rng.randint(1, days))
+        return {"user_id": rng.choice(user_ids), "device_time": _device_time(datetime.combine(day, datetime.max.time())),
+                **location}
+
+    def daily_cached(worker: int, n: int) -> Dict[str, Any]:
+        yesterday = datetime.combine(today - timedelta(days=1), datetime.min.time()) + timedelta(hours=18)
+        return {"user_id": user_ids[0], "device_time": _device_time(yesterday), **location}
+
+    def weekly(chart_range: str) -> Callable[[int, int], Dict[str, Any]]:
+        def body(worker: int, n: int) -> Dict[str, Any]:
+            return {"user_id": user_ids[(worker + n) % users], "range": chart_range,
+                    "device_time": _device_time(noon)}
+        return body
+
+    scenarios = [
+        Scenario('check-location', 'POST', '/check-location', ping),
+        Scenario('check-location-batch', 'POST', '/check-location/batch', batch),
+        Scenario('submit-feedback', 'POST', '/submit-feedback', feedback),
+        Scenario('daily-visualisation', 'POST', '/daily-visualisation', daily),
+        Scenario('daily-visualisation-cached', 'POST', '/daily-visualisation', daily_cached),
+        Scenario('weekly-week', 'POST', '/weekly-time-outside-graph', weekly('week')),
+        Scenario('weekly-month', 'POST', '/weekly-time-outside-graph', weekly('month')),
+        Scenario('weekly-year', 'POST', '/weekly-time-outside-graph', weekly('year')),
+        Scenario('metrics', 'GET', '/metrics'),
+        Scenario('db-pool-stats', 'GET', '/db-pool-stats'),
+    ]
+    return {scenario.name: scenario for scenario in scenarios}
+
+
+_SPAN_LINE = re.compile(r'^solas_span_duration_seconds_(sum|count)\{route="([^"]*)",span="([^"]*)"\} (\S+)$')
+
+
+def read_spans(base_url: str) -> Dict[Tuple[str, str], List[float]]:
+    """(route, span) -> [sum, count] from the server's /metrics."""
+    status, body = _request(_connection(base_url), 'GET', '/metrics')
+    spans: Dict[Tuple[str, str], List[float]] = {}
+    if status != 200:
+        return spans
+    for line in body.decode('utf-8').splitlines():
+        match = _SPAN_LINE.match(line)
+        if match:
+            kind, route, name, value = match.groups()
+            spans.setdefault((route, name), [0.0, 0.0])[kind == 'count'] = float(value)
+    return spans
+
+
+def _connection(base_url: str) -> http.client.HTTPConnection:
+    parts = urlsplit(base_url)
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+
+def _request(conn: http.client.HTTPConnection, method: str, path: str,
+             body: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes]:
+    payload = json.dumps(body).encode('utf-8') if body is not None else None
+    headers = {'Content-Type': 'application/json'} if payload is not None else {}
+    try:
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    except (OSError, http.client.HTTPException):
+        # The server closed a kept-alive connection; reconnect once
+        conn.close()
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    array = np.asarray(values)
+    p50, p90, p99 = np.percentile(array, [50, 90, 99])
+    return {"mean": round(float(array.mean()), 3), "p50": round(float(p50), 3),
+            "p90": round(float(p90), 3), "p99": round(float(p99), 3),
+            "max": round(float(array.max()), 3)}
+
+
+def run_scenario(base_url: str, scenario: Scenario, concurrency: int,
+                 duration: float, warmup: int) -> Dict[str, Any]:
+    """Drive one scenario with ``concurrency`` closed-loop workers for
+    ``duration`` seconds, after ``warmup`` untimed requests per worker."""
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    sizes: List[List[int]] = [[] for _ in range(concurrency)]
+    statuses: List[Counter] = [Counter() for _ in range(concurrency)]
+    window = [0.0, 0.0]  # start, deadline
+    before: Dict[Tuple[str, str], List[float]] = {}
+
+    def open_window() -> None:
+        before.update(read_spans(base_url))
+        window[0] = time.perf_counter()
+        window[1] = window[0] + duration
+
+    # The timed window opens once every worker has finished warming up
+    start_line = threading.Barrier(concurrency, action=open_window)
+
+    def worker(index: int) -> None:
+        conn = _connection(base_url)
+        n = 0
+        for _ in range(warmup):
+            _request(conn, scenario.method, scenario.path, scenario.body(index, n) if scenario.body else None)
+            n += 1
+        start_line.wait()
+        while time.perf_counter() < window[1]:
+            body = scenario.body(index, n) if scenario.body else None
+            n += 1
+            started = time.perf_counter()
+            try:
+                status, payload = _request(conn, scenario.method, scenario.path, body)
+            except (OSError, http.client.HTTPException):
+                status, payload = 0, b''
+            latencies[index].append((time.perf_counter() - started) * 1000)
+            sizes[index].append(len(payload))
+            statuses[index][status] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Requests still in flight at the deadline are counted, so use the real end
+    elapsed = time.perf_counter() - window[0]
+    after = read_spans(base_url)
+
+    all_latencies = [value for values in latencies for value in values]
+    all_sizes = [value for values in sizes for value in values]
+    status_counts = sum(statuses, Counter())
+    spans = {}
+    for (route, name), (total, count) in sorted(after.items()):
+        previous = before.get((route, name), [0.0, 0.0])
+        if route != scenario.route or count <= previous[1]:
+            continue
+        calls = count - previous[1]
+        spans[name] = {"count": int(calls), "mean_ms": round((total - previous[0]) / calls * 1000, 3)}
+
+    return {
+        "route": scenario.route,
+        "method": scenario.method,
+        "requests": len(all_latencies),
+        "errors": sum(count for status, count in status_counts.items() if not 200 <= status < 300),
+        "status_counts": {str(status): count for status, count in sorted(status_counts.items())},
+        "throughput_rps": round(len(all_latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": _summary(all_latencies),
+        "payload_bytes": {"mean": int(np.mean(all_sizes)), "max": int(max(all_sizes))} if all_sizes else {},
+        "spans": spans,
+    }
+
+
+def serve_locally(dsn: str) -> Tuple[str, Callable[[], None]]:
+    """Start app.py on a random local port, using ``dsn`` instead of DB_CONFIG.
+    Returns the base URL and a function that stops it."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import app as api
+    from metrics import TimedCursor
+
+    class QuietHandler(WSGIRequestHandler):
+        # HTTP/1.1 so the benchmark's connections are kept alive, like a proxy's
+        protocol_version = "HTTP/1.1"
+
+        def log_request(self, *args, **kwargs) -> None:
+            pass
+
+    api.db_pool.db_config = {"dsn": dsn, "cursor_factory": TimedCursor}
+    server = make_server('127.0.0.1', 0, api.app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop() -> None:
+        server.shutdown()
+        api.render_pool.shutdown()
+        api.db_pool.closeall()
+
+    return f"http://127.0.0.1:{server.server_port}", stop
+
+
+# Run in a fresh interpreter per repeat, so nothing is already imported
+_STARTUP_PROBE = """
+import json, os, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+matplotlib_on_import = 'matplotlib' in sys.modules
+app.render_pool.warm_up()
+warmed = time.perf_counter()
+renders = []
+for _ in range(2):
+    render_started = time.perf_counter()
+    app.render_pool.render_weekly(['Mon', 'Tue', 'Wed'], [10.0, 50.0, 30.0])
+    renders.append(time.perf_counter() - render_started)
+app.render_pool.shutdown()
+print(json.dumps({"import_app": imported - started, "warm_up": warmed - imported,
+                  "first_render": renders[0], "second_render": renders[1],
+                  "matplotlib_on_import": matplotlib_on_import}))
+"""
+
+
+def measure_startup(repeats: int) -> Dict[str, Any]:
+    """Median seconds to import app.py, warm the render workers up and serve
+    the first and second chart, each from a fresh interpreter."""
+    import os
+
+    runs = []
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, '-c', _STARTUP_PROBE], capture_output=True,
+                                   text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    result: Dict[str, Any] = {key: round(float(np.median([run[key] for run in runs])), 4)
+                              for key in ('import_app', 'warm_up', 'first_render', 'second_render')}
+    result["matplotlib_on_import"] = any(run["matplotlib_on_import"] for run in runs)
+    result["repeats"] = repeats
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any],
+            max_regression: float = DEFAULT_MAX_REGRESSION) -> List[str]:
+    """Human-readable regressions of ``result`` against ``baseline``."""
+    problems = []
+    for name, current in result["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or not previous.get("requests") or not current.get("requests"):
+            continue
+        if current["errors"] > previous["errors"]:
+            problems.append(f"{name}: {current['errors']} errors (baseline {previous['errors']})")
+        for key in ('p50', 'p99'):
+            old, new = previous["latency_ms"].get(key), current["latency_ms"].get(key)
+            if old and new > old * (1 + max_regression):
+                problems.append(f"{name}: {key} {new:.1f} ms (baseline {old:.1f} ms)")
+        old, new = previous["throughput_rps"], current["throughput_rps"]
+        if old and new < old * (1 - max_regression):
+            problems.append(f"{name}: {new:.1f} req/s (baseline {old:.1f} req/s)")
+    return problems
+
+
+def _print_table(result: Dict[str, Any]) -> None:
+    print(f"{'scenario':<28} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7} {'bytes':>9}  render ms",
+          file=sys.stderr)
+    for name, stats in result["scenarios"].items():
+        latency = stats["latency_ms"]
+        render = stats["spans"].get("render", {}).get("mean_ms", '')
+        print(f"{name:<28} {stats['throughput_rps']:>8.1f} {latency.get('p50', 0):>9.1f} "
+              f"{latency.get('p99', 0):>9.1f} {stats['errors']:>7} "
+              f"{stats['payload_bytes'].get('mean', 0):>9}  {render}", file=sys.stderr)
+
+
+def run(args) -> int:
+    scenarios = build_scenarios(args.users, args.days, args.concurrency)
+    names = args.scenarios or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        print(f"Unknown scenario(s): {unknown}; choose from {list(scenarios)}", file=sys.stderr)
+        return 2
+
+    stop = None
+    base_url = args.base_url
+    if base_url is None:
+        # Start each run from the seeded history, without earlier runs' live pings
+        conn = psycopg2.connect(args.dsn)
+        try:
+            reset(conn.cursor(), since=date.today())
+            conn.commit()
+        finally:
+            conn.close()
+        base_url, stop = serve_locally(args.dsn)
+
+    result = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec='seconds'),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "target": args.base_url or "in-process",
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "users": args.users,
+            "days": args.days,
+        },
+        "scenarios": {},
+    }
+    try:
+        for name in names:
+            print(f"Running {name}...", file=sys.stderr)
+            result["scenarios"][name] = run_scenario(base_url, scenarios[name], args.concurrency,
+                                                     args.duration, args.warmup)
+    finally:
+        if stop is not None:
+            stop()
+
+    _print_table(result)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(result, json.load(f), args.max_regression)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Seed a benchmark database and load-test the API")
+    parser.add_argument('--dsn', default=DEFAULT_DSN, help="local PostgreSQL to seed and serve from")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--days', type=int, default=90, help="days of seeded history per user")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help="migrate and load synthetic history")
+    seed_parser.add_argument('--seed', type=int, default=42, help="random seed")
+
+    run_parser = subparsers.add_parser('run', help="load-test every route and write JSON")
+    run_parser.add_argument('--base-url', help="test a running server instead of serving in-process")
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--duration', type=float, default=15.0, help="seconds per scenario")
+    run_parser.add_argument('--warmup', type=int, default=3, help="untimed requests per worker")
+    run_parser.add_argument('--scenarios', nargs='+', help="default: all")
+    run_parser.add_argument('--output', help="write the JSON here instead of stdout")
+    run_parser.add_argument('--baseline', help="earlier JSON result to compare against")
+    run_parser.add_argument('--max-regression', type=float, default=DEFAULT_MAX_REGRESSION)
+
+    startup_parser = subparsers.add_parser('startup', help="time app import and render warm-up")
+    startup_parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        conn = psycopg2.connect(args.dsn)
+        try:
+            written = seed(conn, args.users, args.days, args.seed)
+            print(f"Wrote {written} rows for {args.users} users")
+        finally:
+            conn.close()
+    elif args.command == 'startup':
+        print(json.dumps({"commit": _git_commit(), **measure_startup(args.repeats)}, indent=2))
+    else:
+        sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
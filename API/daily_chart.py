@@ -0,0 +1,368 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import date, time
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.image as mimage
+import numpy as np
+from matplotlib import rcParams, style
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties, findfont, get_font
+from matplotlib.patches import Arc
+
+from banded_png import BandedPng
+from metrics import span
+from segments import Segment, time_to_daylight_angle
+
+RADIUS = 25
+CENTER = (0, 0)
+ARC_WIDTH = 100
+MARKER_LENGTH = 2.5
+
+# Extra PIL options per raster format; WebP stays lossless because the chart
+# is flat colour and text, which lossy compression smears
+RASTER_SAVE_OPTIONS = {
+    'webp': {'lossless': True, 'method': 4},
+}
+
+# style.context() swaps the global rcParams, so only one static layer is built at a time
+style_lock = threading.Lock()
+# Set by warm_up(); figures in this style are drawn without swapping rcParams
+_process_style: Optional[str] = None
+
+
+def warm_up(style_name: str = 'dark_background') -> None:
+    """Get this process ready to render: apply ``style_name`` once for good
+    and load the fonts the charts use, so the first request doesn't pay for
+    it. Only for processes where nothing else uses matplotlib, such as the
+    render workers."""
+    global _process_style
+    with style_lock:
+        style.use(style_name)
+        _process_style = style_name
+    for weight in ('normal', 'bold'):
+        get_font(findfont(FontProperties(weight=weight)))
+    # Lay out some text so the glyph and text-extent caches start warm
+    fig = Figure(figsize=(1, 1), dpi=72)
+    FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, "0123456789:h min ✓", fontweight='bold')
+    fig.canvas.draw()
+
+
+@contextmanager
+def _swapped_style(style_name: str):
+    with style_lock, style.context(style_name):
+        yield
+
+
+def chart_style(style_name: str):
+    """Context to draw a figure in ``style_name``; free once warm_up() applied it."""
+    if style_name == _process_style:
+        return nullcontext()
+    return _swapped_style(style_name)
+
+
+def _build_static_figure(sunrise_str: str, sunset_str: str, hour_markers: List[time],
+                         angle: Callable[[time], float], dpi: int):
+    """Create the figure with every artist that doesn't depend on the user.
+
+    Returns ``(fig, ax, marker_lines, texts)``; the lines and texts are the
+    static artists that have to be drawn on top of the outdoor segments.
+    """
+    fig = Figure(figsize=(20, 16), facecolor='#1a1a1a', dpi=dpi)
+    fig.patch.set_edgecolor('#FFA500')
+    fig.patch.set_linewidth(5)
+    ax = fig.subplots()
+    ax.set_xlim(RADIUS+7, -RADIUS-7)
+
+    # Base daylight arc
+    ax.add_patch(Arc(CENTER, 2*RADIUS, 2*RADIUS, angle=0,
+                     theta1=0, theta2=180, color='#3a3a3a', lw=ARC_WIDTH))
+
+    # Everything drawn after the segments, in the original draw order
+    marker_lines = []
+    texts = []
+    for marker_time in hour_markers:
+        rad_angle = np.radians(angle(marker_time))
+
+        x_outer = RADIUS * np.cos(rad_angle)
+        y_outer = RADIUS * np.sin(rad_angle)
+
+        x_inner = (RADIUS - MARKER_LENGTH) * np.cos(rad_angle)
+        y_inner = (RADIUS - MARKER_LENGTH) * np.sin(rad_angle)
+
+        marker_lines.extend(ax.plot([x_outer, x_inner], [y_outer, y_inner],
+                                    color='white', linewidth=2, alpha=0.7))
+
+        if marker_time.hour % 2 == 0:
+            label_radius = RADIUS - MARKER_LENGTH - 1.5
+            texts.append(ax.text(label_radius * np.cos(rad_angle),
+                                 label_radius * np.sin(rad_angle),
+                                 f"{marker_time.hour}:00",
+                                 color='white', ha='center', va='center',
+                                 fontsize=14, alpha=0.8))
+
+    # Sunrise/sunset labels
+    texts.append(ax.text(RADIUS+2.8, -1.3, sunrise_str,
+                         color='white', ha='left', va='center',
+                         fontsize=28, fontweight='bold'))
+    texts.append(ax.text(-RADIUS-2.8, -1.3, sunset_str,
+                         color='white', ha='right', va='center',
+                         fontsize=28, fontweight='bold'))
+
+    texts.append(ax.text(0, 8, "RECOMMENDED EXPOSURE\n45 MINUTES",
+                         color='white', ha='center', va='center',
+                         fontsize=30, fontweight='bold', alpha=0.9,
+                         linespacing=1.5))
+
+    ax.set_ylim(-2, RADIUS+3)
+    ax.axis('off')
+    ax.set_aspect('equal')
+    ax.set_title('Daylight Exposure', color='#FFA500', pad=20,
+                 fontsize=44, fontweight='bold', y=1.05)
+    return fig, ax, marker_lines, texts
+
+
+def _add_segment(ax, segment: Segment) -> Arc:
+    outdoor_arc = Arc(CENTER, 2*RADIUS, 2*RADIUS, angle=0,
+                      theta1=segment.theta1, theta2=segment.theta2,
+                      color='#FFA500', lw=ARC_WIDTH)
+    ax.add_patch(outdoor_arc)
+    return outdoor_arc
+
+
+def _add_current_time(ax, angle: Callable[[time], float], current_time: time):
+    rad_angle = np.radians(angle(current_time))
+    dot, = ax.plot(RADIUS * np.cos(rad_angle), RADIUS * np.sin(rad_angle), 'o',
+                   color='white', markersize=17, alpha=0.6)
+    return dot
+
+
+def _add_total(ax, formatted_time: str):
+    return ax.text(0, 0, formatted_time,
+                   color='#FFA500', ha='center', va='center',
+                   fontsize=60, fontweight='bold',
+                   bbox=dict(facecolor='#1a1a1a88', edgecolor='#FFA500',
+                             boxstyle='round,pad=0.8', linewidth=5))
+
+
+def _crop_figure(fig, ax, bbox) -> None:
+    """Shrink ``fig`` to ``bbox`` (inches) and move ``ax`` to keep its place
+    in it, as savefig(bbox_inches='tight') does for the length of a save.
+
+    savefig does this with matplotlib._tight_bbox, which is private and free
+    to change in any minor release, so it's redone here with public calls.
+    """
+    width, height = fig.get_size_inches()
+    position = ax.get_position()  # after the equal aspect was applied
+    fig.set_size_inches(bbox.width, bbox.height)
+    ax.set_position([(position.x0 * width - bbox.x0) / bbox.width,
+                     (position.y0 * height - bbox.y0) / bbox.height,
+                     position.width * width / bbox.width,
+                     position.height * height / bbox.height])
+
+
+class StaticLayer:
+    """A daily chart figure with everything that doesn't depend on the user drawn.
+
+    The figure is laid out once, cropped exactly the way
+    ``savefig(bbox_inches='tight')`` would crop it, and the pixels for the
+    figure background plus the grey base arc are kept as a blit background.
+    The remaining static artists (hour markers, labels, headings) are cheap
+    to re-stroke, and must be, because the orange segments sit underneath
+    them. PNGs are encoded against the fully drawn static layer, so only
+    the rows the user's artists touch are compressed per request.
+    """
+
+    def __init__(self, today: date, sunrise_str: str, sunset_str: str,
+                 sunrise_time: time, sunset_time: time, hour_markers: List[time],
+                 style_name: str, dpi: int):
+        self.lock = threading.Lock()
+        self.today = today
+        self.sunrise_time = sunrise_time
+        self.sunset_time = sunset_time
+
+        with chart_style(style_name):
+            fig, ax, marker_lines, texts = _build_static_figure(
+                sunrise_str, sunset_str, hour_markers, self.angle, dpi)
+            canvas = FigureCanvasAgg(fig)
+
+            # Crop to the same box savefig(bbox_inches='tight') would use.
+            # The per-request artists all fall inside the base arc, so they
+            # can't widen it.
+            renderer = canvas.get_renderer()
+            fig.draw_without_rendering()
+            pad = rcParams['savefig.pad_inches']
+            bbox = fig.get_tightbbox(renderer).padded(pad, pad)
+            _crop_figure(fig, ax, bbox)
+
+        self.fig = fig
+        self.canvas = canvas
+        self.ax = ax
+        self.marker_lines = marker_lines
+        self.texts = texts
+
+        for artist in marker_lines + texts + [ax.title]:
+            artist.set_visible(False)
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(fig.bbox)
+        for artist in marker_lines + texts + [ax.title]:
+            artist.set_visible(True)
+        canvas.draw()
+        self.png = BandedPng(np.asarray(canvas.buffer_rgba()), dpi=fig.dpi,
+                             software=f"Matplotlib version{matplotlib.__version__}, "
+                                      "https://matplotlib.org/")
+
+    def angle(self, t: time) -> float:
+        return time_to_daylight_angle(t, self.today, self.sunrise_time, self.sunset_time)
+
+    def nbytes(self) -> int:
+        width, height = self.canvas.get_width_height()
+        # Canvas buffer plus the saved background, both RGBA, and the PNG reference
+        return 2 * 4 * int(width) * int(height) + self.png.nbytes()
+
+    def render(self, outdoor_segments: List[Segment], current_time: time,
+               formatted_time: str, fmt: str = 'png') -> bytes:
+        """Composite the per-user layer over the background and encode it."""
+        ax = self.ax
+        dynamic = []
+        with self.lock:
+            try:
+                with span('figure_draw'):
+                    self.canvas.restore_region(self.background)
+
+                    for segment in outdoor_segments:
+                        outdoor_arc = _add_segment(ax, segment)
+                        dynamic.append(outdoor_arc)
+                        ax.draw_artist(outdoor_arc)
+
+                    for line in self.marker_lines:
+                        ax.draw_artist(line)
+
+                    # Current time indicator
+                    dot = _add_current_time(ax, self.angle, current_time)
+                    dynamic.append(dot)
+                    ax.draw_artist(dot)
+
+                    for text in self.texts:
+                        ax.draw_artist(text)
+
+                    total = _add_total(ax, formatted_time)
+                    dynamic.append(total)
+                    ax.draw_artist(total)
+                    ax.draw_artist(ax.title)
+
+                with span('savefig'):
+                    if fmt == 'png':
+                        return self.png.encode(np.asarray(self.canvas.buffer_rgba()))
+                    buf = BytesIO()
+                    mimage.imsave(buf, self.canvas.buffer_rgba(), format=fmt,
+                                  origin='upper', dpi=self.fig.dpi,
+                                  pil_kwargs=RASTER_SAVE_OPTIONS.get(fmt))
+                    return buf.getvalue()
+            finally:
+                for artist in dynamic:
+                    artist.remove()
+
+
+class DailyChartRenderer:
+    """Renders the daily daylight arc, reusing static layers across requests.
+
+    Static layers are keyed by (sunrise, sunset, style, dpi) and evicted
+    least-recently-used once ``max_bytes`` of canvas memory is held.
+    """
+
+    def __init__(self, style_name: str = 'dark_background', dpi: int = 250,
+                 max_layers: int = 8, max_bytes: int = 512 * 1024 * 1024):
+        self.style_name = style_name
+        self.default_dpi = dpi
+        self.max_layers = max_layers
+        self.max_bytes = max_bytes
+        self._layers: "OrderedDict[Tuple, StaticLayer]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._builds = 0
+        self._reuses = 0
+
+    def _static_layer(self, today: date, sunrise_str: str, sunset_str: str,
+                      sunrise_time: time, sunset_time: time,
+                      hour_markers: List[time], dpi: int) -> StaticLayer:
+        key = (sunrise_str, sunset_str, self.style_name, dpi)
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is not None:
+                self._layers.move_to_end(key)
+                self._reuses += 1
+                return layer
+
+        with span('figure_build'):
+            layer = StaticLayer(today, sunrise_str, sunset_str, sunrise_time, sunset_time,
+                                hour_markers, self.style_name, dpi)
+        with self._lock:
+            if key in self._layers:
+                # Another request built the same layer first; keep theirs
+                self._reuses += 1
+                return self._layers[key]
+            self._layers[key] = layer
+            self._bytes += layer.nbytes()
+            self._builds += 1
+            while len(self._layers) > 1 and (len(self._layers) > self.max_layers or
+                                             self._bytes > self.max_bytes):
+                _, old = self._layers.popitem(last=False)
+                self._bytes -= old.nbytes()
+            return layer
+
+    def render(self, today: date, sunrise_str: str, sunset_str: str,
+               sunrise_time: time, sunset_time: time,
+               outdoor_segments: List[Segment],
+               hour_markers: List[time], current_time: time,
+               formatted_time: str, fmt: str = 'png', dpi: Optional[int] = None) -> bytes:
+        """Draw the daylight arc and return it encoded as ``fmt`` (png, webp or svg)."""
+        dpi = dpi or self.default_dpi
+        if fmt == 'svg':
+            return self._render_vector(sunrise_str, sunset_str, sunrise_time, sunset_time,
+                                       outdoor_segments, hour_markers, current_time,
+                                       formatted_time, today)
+        layer = self._static_layer(today, sunrise_str, sunset_str,
+                                   sunrise_time, sunset_time, hour_markers, dpi)
+        return layer.render(outdoor_segments, current_time, formatted_time, fmt)
+
+    def _render_vector(self, sunrise_str: str, sunset_str: str,
+                       sunrise_time: time, sunset_time: time,
+                       outdoor_segments: List[Segment],
+                       hour_markers: List[time], current_time: time,
+                       formatted_time: str, today: date) -> bytes:
+        # Vector output can't be blitted, so the whole figure is built each time
+        def angle(t: time) -> float:
+            return time_to_daylight_angle(t, today, sunrise_time, sunset_time)
+
+        with chart_style(self.style_name):
+            with span('figure_build'):
+                fig, ax, _, _ = _build_static_figure(sunrise_str, sunset_str,
+                                                     hour_markers, angle, 72)
+                FigureCanvasSVG(fig)
+                for segment in outdoor_segments:
+                    _add_segment(ax, segment)
+                _add_current_time(ax, angle, current_time)
+                _add_total(ax, formatted_time)
+
+            buf = BytesIO()
+            with span('savefig'):
+                fig.savefig(buf, format='svg', bbox_inches='tight',
+                            facecolor=fig.get_facecolor(), edgecolor=fig.get_edgecolor())
+        return buf.getvalue()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "static_layers": len(self._layers),
+                "static_layer_bytes": self._bytes,
+                "static_layer_builds": self._builds,
+                "static_layer_reuses": self._reuses,
+            }
@@ -0,0 +1,176 @@
+"""One row per (user_id, day) summarising that day's final_table pings.
+
+The table is kept up to date at insert time by ``upsert_daily_summary`` so
+the weekly/monthly/yearly charts read one row per day instead of every ping.
+``python daily_summary.py backfill`` rebuilds it from final_table for
+history written before it existed (or to repair it).
+"""
+import argparse
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+SUMMARY_COLUMNS = (
+    'user_id', 'day', 'outside_seconds', 'available_hours',
+    'lux_sum', 'sample_count', 'last_time',
+)
+
+
+def summarise_rows(rows: Sequence[Sequence[Any]]) -> List[Tuple]:
+    """Fold final_table rows (FINAL_TABLE_COLUMNS order) into one partial
+    summary per (user_id, day), in SUMMARY_COLUMNS order."""
+    summaries: Dict[Tuple[str, date], List[Any]] = {}
+    for row in rows:
+        user_id, moment = row[0], row[1]
+        key = (user_id, moment.date())
+        lux = row[11] or 0
+        summary = summaries.get(key)
+        if summary is None:
+            summaries[key] = [user_id, key[1], row[5], row[6], lux, 1, moment]
+            continue
+        summary[4] += lux
+        summary[5] += 1
+        if moment >= summary[6]:
+            # The day's running total and daylight come from its latest ping
+            summary[2], summary[3], summary[6] = row[5], row[6], moment
+    return [tuple(summary) for summary in summaries.values()]
+
+
+# ``{values}`` is the VALUES placeholder for the driver in use: ``%s`` for
+# execute_values, or one ``($1, ..., $7)`` row for asyncpg's executemany
+DAILY_SUMMARY_UPSERT_SQL = f"""
+    INSERT INTO daily_summary ({', '.join(SUMMARY_COLUMNS)}) VALUES {{values}}
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        outside_seconds = CASE WHEN EXCLUDED.last_time >= daily_summary.last_time
+                               THEN EXCLUDED.outside_seconds
+                               ELSE daily_summary.outside_seconds END,
+        available_hours = CASE WHEN EXCLUDED.last_time >= daily_summary.last_time
+                               THEN EXCLUDED.available_hours
+                               ELSE daily_summary.available_hours END,
+        lux_sum = daily_summary.lux_sum + EXCLUDED.lux_sum,
+        sample_count = daily_summary.sample_count + EXCLUDED.sample_count,
+        last_time = GREATEST(daily_summary.last_time, EXCLUDED.last_time)
+"""
+
+READ_DAILY_SUMMARY_SQL = """
+    SELECT day, outside_seconds, available_hours, lux_sum, sample_count
+    FROM daily_summary
+    WHERE user_id = %s AND day BETWEEN %s AND %s
+"""
+
+
+def upsert_daily_summary(cur, rows: Sequence[Sequence[Any]]) -> None:
+    """Merge newly inserted final_table rows into daily_summary.
+
+    Run in the same transaction as the insert so the two never disagree.
+    """
+    summaries = summarise_rows(rows)
+    if not summaries:
+        return
+    execute_values(cur, DAILY_SUMMARY_UPSERT_SQL.format(values='%s'), summaries)
+
+
+def backfill(cur, user_id: Optional[str] = None, since: Optional[date] = None) -> int:
+    """Recompute daily_summary from final_table, optionally for one user
+    and/or from ``since`` onwards. Returns the number of days written."""
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append("user_id = %s")
+        params.append(user_id)
+    if since is not None:
+        conditions.append("time >= %s")
+        params.append(datetime.combine(since, datetime.min.time()))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cur.execute(
+        f"""
+        INSERT INTO daily_summary ({', '.join(SUMMARY_COLUMNS)})
+        SELECT user_id, time::date,
+               (array_agg(total_time_outside_for_given_day ORDER BY time DESC))[1],
+               (array_agg(total_available_hours ORDER BY time DESC))[1],
+               COALESCE(SUM(lux), 0), COUNT(*), MAX(time)
+        FROM final_table
+        {where}
+        GROUP BY user_id, time::date
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            outside_seconds = EXCLUDED.outside_seconds,
+            available_hours = EXCLUDED.available_hours,
+            lux_sum = EXCLUDED.lux_sum,
+            sample_count = EXCLUDED.sample_count,
+            last_time = EXCLUDED.last_time
+        """,
+        params
+    )
+    return cur.rowcount
+
+
+def summaries_by_day(records: Iterable[Sequence[Any]]) -> Dict[date, Dict[str, Any]]:
+    """Key READ_DAILY_SUMMARY_SQL results by day."""
+    return {
+        day: {
+            "outside_seconds": float(outside_seconds or 0),
+            "available_hours": float(available_hours or 0),
+            "mean_lux": float(lux_sum) / sample_count if sample_count else 0.0,
+            "sample_count": sample_count,
+        }
+        for day, outside_seconds, available_hours, lux_sum, sample_count in records
+    }
+
+
+def read_daily_summary(cur, user_id: str, start: date, end: date) -> Dict[date, Dict[str, Any]]:
+    """Summaries for ``start``..``end`` inclusive, keyed by day. Days without
+    pings are simply absent."""
+    cur.execute(READ_DAILY_SUMMARY_SQL, (user_id, start, end))
+    return summaries_by_day(cur.fetchall())
+
+
+def read_daily_summaries(cur, ranges: Dict[str, Tuple[date, date]]) -> Dict[str, Dict[date, Dict[str, Any]]]:
+    """read_daily_summary for many users at once: ``ranges`` maps each
+    user_id to its (start, end) days. Users without summaries map to {}."""
+    if not ranges:
+        return {}
+    users = list(ranges)
+    cur.execute(
+        """
+        SELECT s.user_id, s.day, s.outside_seconds, s.available_hours, s.lux_sum, s.sample_count
+        FROM unnest(%s::text[], %s::date[], %s::date[]) AS t (user_id, start_day, end_day)
+        JOIN daily_summary s
+          ON s.user_id = t.user_id AND s.day BETWEEN t.start_day AND t.end_day
+        """,
+        (users, [ranges[u][0] for u in users], [ranges[u][1] for u in users])
+    )
+    records: Dict[str, List[Tuple]] = {user_id: [] for user_id in users}
+    for user_id, *record in cur.fetchall():
+        records[user_id].append(record)
+    return {user_id: summaries_by_day(found) for user_id, found in records.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintain the daily_summary table")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help="rebuild summaries from final_table")
+    backfill_parser.add_argument('--user', help="only this user_id")
+    backfill_parser.add_argument('--since', type=date.fromisoformat,
+                                 help="only days from this date (YYYY-MM-DD)")
+    backfill_parser.add_argument('--days', type=int,
+                                 help="only the last N days (ignored if --since is given)")
+    args = parser.parse_args()
+
+    since = args.since
+    if since is None and args.days is not None:
+        since = date.today() - timedelta(days=args.days)
+
+    from app import DB_CONFIG
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        cur = conn.cursor()
+        written = backfill(cur, args.user, since)
+        conn.commit()
+        print(f"Wrote {written} daily summaries")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import threading
+import time
+from typing import Dict, Any, List, Tuple
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of psycopg2 connections.
+
+    Connections are handed out LIFO so the hot ones get reused and the cold
+    ones age out. A connection that has been idle for longer than
+    ``health_check_after`` seconds is pinged with ``SELECT 1`` before it is
+    handed out, and one idle for longer than ``max_idle`` seconds (or older
+    than ``max_lifetime``) is closed instead of reused.
+    """
+
+    def __init__(self, db_config: Dict[str, Any], min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, max_idle: float = 300.0,
+                 max_lifetime: float = 3600.0, health_check_after: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: need 0 <= min_size <= max_size and max_size >= 1")
+        self.db_config = db_config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        # Each idle entry is (connection, created_at, returned_at)
+        self._idle: List[Tuple[Any, float, float]] = []
+        self._created_at: Dict[int, float] = {}
+        self._in_use = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._failed_health_checks = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _connect(self):
+        return psycopg2.connect(**self.db_config)
+
+    def _forget(self, conn) -> None:
+        # Called with self._cond held; the caller closes conn once it's released
+        self._created_at.pop(id(conn), None)
+        self._discarded += 1
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, returned_at: float, now: float) -> bool:
+        if conn.closed:
+            return False
+        if now - returned_at < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _expired(self, created_at: float, returned_at: float, now: float) -> bool:
+        return now - returned_at > self.max_idle or now - created_at > self.max_lifetime
+
+    def _reap_idle(self, now: float) -> List[Any]:
+        # Called with self._cond held. Oldest idle connections sit at the
+        # front; keep at least min_size open. Returns the ones to close.
+        keep = []
+        reaped = []
+        size = len(self._idle) + self._in_use
+        for conn, created_at, returned_at in self._idle:
+            if size > self.min_size and self._expired(created_at, returned_at, now):
+                self._forget(conn)
+                reaped.append(conn)
+                size -= 1
+            else:
+                keep.append((conn, created_at, returned_at))
+        self._idle = keep
+        return reaped
+
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds for one."""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            candidate = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    now = time.monotonic()
+                    # Either way the slot is reserved before the lock is
+                    # released, so we never exceed max_size
+                    if self._idle:
+                        candidate = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._in_use < self.max_size:
+                        self._in_use += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"Timed out after {self.timeout}s waiting for a database connection")
+                    self._cond.wait(remaining)
+            if candidate is None:
+                break
+
+            # The health check and close happen off the lock, so a slow or
+            # dead server doesn't stall other checkouts and returns
+            conn, created_at, returned_at = candidate
+            expired = self._expired(created_at, returned_at, now)
+            if not expired and self._is_healthy(conn, returned_at, now):
+                with self._cond:
+                    return self._checked_out(conn, start)
+            with self._cond:
+                self._in_use -= 1
+                if not expired:
+                    self._failed_health_checks += 1
+                self._forget(conn)
+                self._cond.notify()
+            self._close(conn)
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+            self._created_at[id(conn)] = time.monotonic()
+            return self._checked_out(conn, start)
+
+    def _checked_out(self, conn, start: float):
+        wait = time.monotonic() - start
+        self._checkouts += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        """Return a connection to the pool, rolling back any open transaction."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            now = time.monotonic()
+            created_at = self._created_at.get(id(conn), now)
+            to_close = []
+            if discard or conn.closed or self._closed or \
+                    now - created_at > self.max_lifetime:
+                self._forget(conn)
+                to_close.append(conn)
+            else:
+                self._idle.append((conn, created_at, now))
+            to_close.extend(self._reap_idle(now))
+            self._cond.notify()
+        for stale in to_close:
+            self._close(stale)
+
+    def closeall(self) -> None:
+        with self._cond:
+            self._closed = True
+            to_close = [conn for conn, _, _ in self._idle]
+            for conn in to_close:
+                self._forget(conn)
+            self._idle = []
+            self._cond.notify_all()
+        for conn in to_close:
+            self._close(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": len(self._idle) + self._in_use,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "connections_created": self._created,
+                "connections_discarded": self._discarded,
+                "failed_health_checks": self._failed_health_checks,
+                "total_wait_seconds": round(self._total_wait, 6),
+                "avg_wait_seconds": round(self._total_wait / self._checkouts, 6) if self._checkouts else 0.0,
+                "max_wait_seconds": round(self._max_wait, 6),
+            }
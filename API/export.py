@@ -0,0 +1,207 @@
+"""Streaming export of final_table as CSV or Parquet.
+
+Rows are read through a server-side (named) cursor ``chunk_rows`` at a time
+and each chunk is encoded and handed to the response before the next one
+is fetched, so memory stays flat however long the history is. The
+encoders only turn lists of rows into bytes; app.py and asgi.py drive them
+from their own database drivers.
+"""
+import csv
+from datetime import date, timedelta
+from io import StringIO
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for format=parquet
+    pa = pq = None
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# (column, name in the file); same order as the table
+EXPORT_COLUMNS = (
+    ('user_id', 'user_id'),
+    ('time', 'time'),
+    ('"outside?"', 'outside'),
+    ('time_outside', 'time_outside'),
+    ('total_time_outside', 'total_time_outside'),
+    ('total_time_outside_for_given_day', 'total_time_outside_for_given_day'),
+    ('total_available_hours', 'total_available_hours'),
+    ('weather', 'weather'),
+    ('temperature', 'temperature'),
+    ('uv', 'uv'),
+    ('gps_accuracy', 'gps_accuracy'),
+    ('lux', 'lux'),
+)
+EXPORT_HEADER = [name for _, name in EXPORT_COLUMNS]
+
+
+def parse_export_request(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate the export query parameters.
+
+    ``format`` is csv (default) or parquet; ``start`` and ``end`` are
+    YYYY-MM-DD days, both inclusive and both optional. Raises ValueError.
+    """
+    fmt = str(args.get('format', 'csv')).lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {list(EXPORT_FORMATS)}")
+    if fmt == 'parquet' and pq is None:
+        raise ValueError("parquet export needs pyarrow installed on the server")
+
+    days = {}
+    for name in ('start', 'end'):
+        value = args.get(name)
+        try:
+            days[name] = date.fromisoformat(value) if value else None
+        except ValueError:
+            raise ValueError(f"{name} must be a date (YYYY-MM-DD)")
+    if days['start'] and days['end'] and days['start'] > days['end']:
+        raise ValueError("start must not be after end")
+
+    return {"user_id": args.get('user_id') or None, "format": fmt, **days}
+
+
+def export_query(user_id: Optional[str], start: Optional[date],
+                 end: Optional[date]) -> Tuple[str, List[Any]]:
+    """SELECT for the export, with %s placeholders, and its parameters.
+
+    Ordered by (user_id, time) so the user_id/time index serves it and rows
+    start flowing without a sort.
+    """
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append("user_id = %s")
+        params.append(user_id)
+    if start is not None:
+        conditions.append("time >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("time < %s")
+        params.append(end + timedelta(days=1))
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = (f"SELECT {', '.join(column for column, _ in EXPORT_COLUMNS)} "
+             f"FROM final_table{where} ORDER BY user_id, time")
+    return query, params
+
+
+def export_filename(options: Dict[str, Any]) -> str:
+    parts = ['solas', options['user_id'] or 'all']
+    if options['start'] or options['end']:
+        parts.append(f"{options['start'] or 'start'}_{options['end'] or 'end'}")
+    name = '-'.join(parts)
+    # Keep the Content-Disposition header plain whatever the user id holds
+    name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+    return f"{name}.{options['format']}"
+
+
+class CsvEncoder:
+    def __init__(self):
+        self._buf = StringIO()
+        self._writer = csv.writer(self._buf)
+        self._header_written = False
+
+    def _drain(self) -> bytes:
+        data = self._buf.getvalue().encode('utf-8')
+        self._buf.seek(0)
+        self._buf.truncate()
+        return data
+
+    def encode(self, rows: Sequence[Sequence[Any]]) -> bytes:
+        if not self._header_written:
+            self._writer.writerow(EXPORT_HEADER)
+            self._header_written = True
+        self._writer.writerows(rows)
+        return self._drain()
+
+    def close(self) -> bytes:
+        # An empty export is still a valid file with a header
+        return self.encode([]) if not self._header_written else b''
+
+
+class _ChunkSink:
+    """Write-only file that hands back what was written since the last drain."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _arrow_schema():
+    types = [pa.string(), pa.timestamp('us'), pa.bool_()] + [pa.float64()] * 4 + \
+        [pa.string()] + [pa.float64()] * 3 + [pa.int32()]
+    return pa.schema(list(zip(EXPORT_HEADER, types)))
+
+
+class ParquetEncoder:
+    """Writes one Parquet row group per chunk of rows."""
+
+    def __init__(self):
+        self._schema = _arrow_schema()
+        self._sink = _ChunkSink()
+        self._writer = pq.ParquetWriter(self._sink, self._schema, compression='zstd')
+
+    def encode(self, rows: Sequence[Sequence[Any]]) -> bytes:
+        if rows:
+            columns = list(zip(*rows))
+            table = pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+                schema=self._schema,
+            )
+            self._writer.write_table(table)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+def make_encoder(fmt: str):
+    return ParquetEncoder() if fmt == 'parquet' else CsvEncoder()
+
+
+def stream_export(conn, options: Dict[str, Any], chunk_rows: int) -> Iterator[bytes]:
+    """Encoded chunks of the export, read through a named cursor on ``conn``.
+
+    The cursor lives in the connection's open transaction; the caller
+    releases ``conn``, which rolls it back.
+    """
+    query, params = export_query(options['user_id'], options['start'], options['end'])
+    encoder = make_encoder(options['format'])
+    with conn.cursor(name='final_table_export') as cur:
+        cur.itersize = chunk_rows
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            chunk = encoder.encode(rows)
+            if chunk:
+                yield chunk
+    tail = encoder.close()
+    if tail:
+        yield tail
@@ -0,0 +1,144 @@
+"""ETags, conditional requests and response compression.
+
+Chart ETags are weak and derived from what the response is built from (the
+render cache key and the JSON payload), not from its bytes, so a matching
+If-None-Match is answered with a 304 before anything is rendered or
+encoded. Responses are compressed with brotli when the client accepts it
+and the package is installed, otherwise gzip.
+"""
+import gzip
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = frozenset({
+    'application/json', 'text/plain', 'text/csv', 'image/svg+xml',
+})
+
+
+def chart_etag(*parts: Any) -> str:
+    digest = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of ``etag`` against an If-None-Match header."""
+    if not if_none_match:
+        return False
+    tag = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+def _accepted(accept_encoding: str) -> Dict[str, float]:
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    return accepted
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The best encoding we can produce that the client accepts, or None."""
+    if not accept_encoding:
+        return None
+    accepted = _accepted(accept_encoding)
+    ours: List[str] = (['br'] if brotli is not None else []) + ['gzip']
+    best, best_q = None, 0.0
+    for encoding in ours:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        # Ties go to the earlier (smaller) encoding
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def should_compress(mimetype: Optional[str], size: int, min_bytes: int) -> bool:
+    return size >= min_bytes and (mimetype or '').split(';')[0].strip() in COMPRESSIBLE_TYPES
+
+
+def compress(body: bytes, encoding: str, gzip_level: int = 6, brotli_quality: int = 5) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+def add_vary(existing: Optional[str]) -> str:
+    if not existing:
+        return 'Accept-Encoding'
+    if 'accept-encoding' in existing.lower():
+        return existing
+    return f"{existing}, Accept-Encoding"
+
+
+class CompressionMiddleware:
+    """ASGI counterpart of app.compress_response.
+
+    Only bodies sent in one piece are compressed; streamed ones (the export)
+    pass through untouched.
+    """
+
+    def __init__(self, app, min_bytes: int = 1024, gzip_level: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        request_headers = dict(scope.get('headers') or [])
+        encoding = choose_encoding(request_headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Dict[str, Any] = {}
+
+        async def send_compressed(message):
+            if message['type'] == 'http.response.start':
+                # Hold on to it until we know whether the body comes in one piece
+                start.update(message)
+                return
+            if message['type'] != 'http.response.body' or not start:
+                await send(message)
+                return
+            headers: List[Tuple[bytes, bytes]] = list(start.get('headers', []))
+            names = {name.lower(): value for name, value in headers}
+            body = message.get('body', b'')
+            if not message.get('more_body') and b'content-encoding' not in names and \
+                    should_compress(names.get(b'content-type', b'').decode('latin-1'),
+                                    len(body), self.min_bytes):
+                body = compress(body, encoding, self.gzip_level, self.brotli_quality)
+                vary = add_vary(names.get(b'vary', b'').decode('latin-1') or None)
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in (b'content-length', b'vary')]
+                headers += [(b'content-encoding', encoding.encode('latin-1')),
+                            (b'content-length', str(len(body)).encode('latin-1')),
+                            (b'vary', vary.encode('latin-1'))]
+                message = {**message, 'body': body}
+            await send({**start, 'headers': headers})
+            start.clear()
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
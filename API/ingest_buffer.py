@@ -0,0 +1,420 @@
+import fcntl
+import glob
+import json
+import os
+import shutil
+import threading
+import uuid
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from daily_summary import upsert_daily_summary
+from db import PoolTimeout
+
+# Column order of every row handed to the buffer
+FINAL_TABLE_COLUMNS = (
+    'user_id', 'time', '"outside?"',
+    'time_outside', 'total_time_outside', 'total_time_outside_for_given_day',
+    'total_available_hours', 'weather', 'temperature', 'uv', 'gps_accuracy', 'lux',
+)
+TIME_INDEX = 1
+# Rows that could not be stored, one JSON object per line, under wal_dir
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+
+def insert_final_rows(cur, rows: Sequence[Sequence[Any]], page_size: int = 500) -> List[Sequence[Any]]:
+    """Insert many final_table rows in one statement per ``page_size`` rows.
+
+    A row whose (user_id, time) is already stored is a retried ping and is
+    skipped. Returns the rows that were actually inserted.
+    """
+    if not rows:
+        return []
+    inserted = execute_values(
+        cur,
+        f"INSERT INTO final_table ({', '.join(FINAL_TABLE_COLUMNS)}) VALUES %s "
+        "ON CONFLICT (user_id, time) DO NOTHING RETURNING user_id, time",
+        rows,
+        page_size=page_size,
+        fetch=True,
+    )
+    keys = set(map(tuple, inserted))
+    written = []
+    for row in rows:
+        key = (row[0], row[TIME_INDEX])
+        if key in keys:
+            # A ping repeated within ``rows`` is only inserted once
+            keys.discard(key)
+            written.append(row)
+    return written
+
+
+def _encode_row(row: Sequence[Any]) -> str:
+    row = list(row)
+    row[TIME_INDEX] = row[TIME_INDEX].isoformat()
+    # default=float covers NUMERIC totals that come back from the DB as Decimal
+    return json.dumps(row, default=float)
+
+
+def _is_transient(error: Exception) -> bool:
+    # Lost connections, timeouts and deadlocks say nothing about the rows, so
+    # the batch is retried as it is; anything else may be caused by a row
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout))
+
+
+def _decode_row(line: str) -> Tuple:
+    row = json.loads(line)
+    row[TIME_INDEX] = datetime.fromisoformat(row[TIME_INDEX])
+    return tuple(row)
+
+
+class IngestBuffer:
+    """Write-ahead buffer that batches final_table inserts.
+
+    ``append`` writes the row to a local log segment (fsynced by default)
+    and returns; at that point the ping is durable and can be acknowledged.
+    A background thread flushes everything pending with ``execute_values``
+    whenever ``max_batch`` rows are waiting or ``max_delay`` seconds have
+    passed, then deletes the log segment those rows came from. Rows are
+    inserted in append order, so each user's pings keep their order.
+
+    A batch that fails is retried with exponential backoff. If it still fails
+    after ``max_retries`` attempts with an error that isn't a connection
+    problem, it is split in half and each half flushed on its own, down to
+    single rows; a row that can't be stored on its own is appended to
+    ``dead-letter.jsonl`` in ``wal_dir`` with the error, so one bad row
+    doesn't hold up everything queued behind it.
+
+    If the process dies after a batch is committed but before its segment is
+    deleted, the batch is replayed on the next start; rows that were already
+    committed are skipped by their (user_id, time) key, so nothing is
+    counted twice.
+
+    Every process logs to its own ``worker-*`` directory under ``wal_dir``
+    and holds an flock on the ``owner.lock`` file in it for as long as it
+    runs. On start a buffer only recovers directories whose lock it can take,
+    i.e. whose owner has exited, and keeps holding that lock until their
+    rows are flushed, so no two processes ever replay the same log.
+    """
+
+    def __init__(self, get_conn: Callable[[], Any], release_conn: Callable[[Any], None],
+                 wal_dir: str, max_batch: int = 500, max_delay: float = 1.0,
+                 fsync: bool = True, retry_delay: float = 2.0, max_retry_delay: float = 60.0,
+                 max_retries: int = 4):
+        self.get_conn = get_conn
+        self.release_conn = release_conn
+        self.wal_dir = wal_dir
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+        self.dead_letter_path = os.path.join(wal_dir, DEAD_LETTER_FILE)
+
+        os.makedirs(wal_dir, exist_ok=True)
+        self.log_dir = os.path.join(wal_dir, f'worker-{os.getpid()}-{uuid.uuid4().hex[:8]}')
+        os.makedirs(self.log_dir)
+        self._owner_lock = self._lock_dir(self.log_dir)
+        # Directories of exited processes we're replaying, with their locks
+        self._adopted: List[Tuple[str, int]] = []
+        self._cond = threading.Condition()
+        self._pending: List[Tuple] = []
+        # Latest buffered row per user, so callers can see rows not yet in the DB
+        self._latest: Dict[str, Tuple] = {}
+        self._segment_seq = 0
+        self._segment = None
+        self._segment_path = None
+        self._recovered_paths: List[str] = []
+        self._closed = False
+        self._flush_requested = False
+        # Rows ever queued, and how many of those are committed; batches are
+        # flushed in order, so the second catching up with the first means
+        # everything queued by then is in the DB
+        self._queued = 0
+        self._committed = 0
+
+        self._appended = 0
+        self._batches = 0
+        self._rows_flushed = 0
+        self._flush_failures = 0
+        self._dead_lettered = 0
+        self._last_batch_size = 0
+        self._max_batch_size = 0
+        self._total_flush_time = 0.0
+        self._last_flush_time = 0.0
+        self._max_flush_time = 0.0
+
+        self._recover()
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, name='ingest-flusher', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _lock_dir(path: str, blocking: bool = True, name: str = 'owner.lock') -> Optional[int]:
+        """An fd holding the exclusive flock on ``path``/``name``, or None if
+        another live process holds it."""
+        fd = os.open(os.path.join(path, name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _orphaned_dirs(self) -> List[Tuple[str, int]]:
+        orphans = []
+        for path in sorted(glob.glob(os.path.join(self.wal_dir, 'worker-*'))):
+            if path == self.log_dir:
+                continue
+            try:
+                fd = self._lock_dir(path, blocking=False)
+            except FileNotFoundError:
+                # Removed by whoever recovered it while we were looking
+                continue
+            if fd is not None:
+                orphans.append((path, fd))
+        return orphans
+
+    def _recover(self) -> None:
+        # Segments written directly into wal_dir predate per-process
+        # directories; the first buffer to start takes them over
+        recover_lock = self._lock_dir(self.wal_dir, name='recover.lock')
+        try:
+            for path in sorted(glob.glob(os.path.join(self.wal_dir, 'segment-*.log'))):
+                os.rename(path, os.path.join(self.log_dir, 'recovered-' + os.path.basename(path)))
+            self._adopted = self._orphaned_dirs()
+        finally:
+            os.close(recover_lock)
+
+        # Rows left behind by exited processes go first, in their original order
+        paths = sorted(glob.glob(os.path.join(self.log_dir, 'recovered-segment-*.log')))
+        for path, _ in self._adopted:
+            # Including what that process had itself recovered, which sorts first
+            paths += sorted(glob.glob(os.path.join(path, '*segment-*.log')))
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        row = _decode_row(line)
+                    except ValueError:
+                        # A torn final line from a crash mid-write
+                        print(f"Skipping unreadable ingest log line in {path}")
+                        continue
+                    self._pending.append(row)
+                    self._latest[row[0]] = row
+                    self._queued += 1
+        self._recovered_paths = paths
+        if not self._pending:
+            for path in paths:
+                os.remove(path)
+            self._recovered_paths = []
+            self._release_adopted()
+
+    def _release_adopted(self) -> None:
+        # Their rows are committed, so the directories can go
+        for path, fd in self._adopted:
+            shutil.rmtree(path, ignore_errors=True)
+            os.close(fd)
+        self._adopted = []
+
+    def _open_segment(self) -> None:
+        self._segment_seq += 1
+        self._segment_path = os.path.join(self.log_dir, f'segment-{self._segment_seq:012d}.log')
+        self._segment = open(self._segment_path, 'a', encoding='utf-8')
+
+    def append(self, row: Sequence[Any]) -> None:
+        """Durably buffer one final_table row (in FINAL_TABLE_COLUMNS order)."""
+        row = tuple(row)
+        line = _encode_row(row) + '\n'
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Ingest buffer is closed")
+            self._segment.write(line)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+            self._pending.append(row)
+            self._latest[row[0]] = row
+            self._appended += 1
+            self._queued += 1
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def latest_for_user(self, user_id: str) -> Optional[Tuple]:
+        """The newest row for ``user_id`` that may not have reached the DB yet."""
+        with self._cond:
+            return self._latest.get(user_id)
+
+    def wait_until_flushed(self, timeout: Optional[float] = None) -> bool:
+        """Flush now and block until every row queued so far is committed.
+
+        For callers that need to read what they've written from the DB.
+        Returns False if that didn't happen within ``timeout`` seconds.
+        """
+        with self._cond:
+            target = self._queued
+            if self._committed >= target:
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._committed >= target, timeout)
+
+    def _take_batch(self) -> Tuple[List[Tuple], List[str]]:
+        # Called with the lock held: hand every pending row to the flusher and
+        # start a new segment so appends can carry on during the insert
+        batch = self._pending
+        self._pending = []
+        self._flush_requested = False
+        paths = self._recovered_paths + [self._segment_path]
+        self._recovered_paths = []
+        self._segment.close()
+        self._open_segment()
+        return batch, paths
+
+    def _flush(self, batch: List[Tuple]) -> None:
+        started = time.monotonic()
+        conn = self.get_conn()
+        try:
+            cur = conn.cursor()
+            # Only rows that weren't already stored count towards the summary
+            written = insert_final_rows(cur, batch, page_size=self.max_batch)
+            upsert_daily_summary(cur, written)
+            conn.commit()
+        finally:
+            self.release_conn(conn)
+        elapsed = time.monotonic() - started
+        with self._cond:
+            self._batches += 1
+            self._rows_flushed += len(batch)
+            self._last_batch_size = len(batch)
+            self._max_batch_size = max(self._max_batch_size, len(batch))
+            self._last_flush_time = elapsed
+            self._total_flush_time += elapsed
+            self._max_flush_time = max(self._max_flush_time, elapsed)
+            self._settle(batch)
+
+    def _settle(self, rows: List[Tuple]) -> None:
+        # Called with the lock held once rows are committed or dead-lettered
+        self._committed += len(rows)
+        for row in rows:
+            if self._latest.get(row[0]) is row:
+                del self._latest[row[0]]
+        self._cond.notify_all()
+
+    def _try_flush(self, batch: List[Tuple], retries: int) -> Optional[Exception]:
+        """Flush ``batch``, retrying with backoff. Connection errors are
+        retried until they clear; other errors up to ``retries`` times.
+        Returns the last error if the batch could not be flushed."""
+        attempt = 0
+        failures = 0
+        while True:
+            try:
+                self._flush(batch)
+                return None
+            except Exception as e:
+                with self._cond:
+                    self._flush_failures += 1
+                print(f"Error flushing ingest batch of {len(batch)} rows: {str(e)}")
+                if not _is_transient(e):
+                    failures += 1
+                    if failures > retries:
+                        return e
+            time.sleep(min(self.retry_delay * 2 ** min(attempt, 16), self.max_retry_delay))
+            attempt += 1
+
+    def _flush_isolating(self, batch: List[Tuple], retries: int) -> None:
+        error = self._try_flush(batch, retries)
+        if error is None:
+            return
+        if len(batch) == 1:
+            self._dead_letter(batch[0], error)
+            return
+        # Keep halving until the rows that fail are on their own. The failure
+        # has already been retried, so the halves get a single attempt each;
+        # flushing them in turn keeps every user's rows in order.
+        middle = len(batch) // 2
+        self._flush_isolating(batch[:middle], 0)
+        self._flush_isolating(batch[middle:], 0)
+
+    def _dead_letter(self, row: Tuple, error: Exception) -> None:
+        record = json.dumps({
+            "failed_at": datetime.now().isoformat(),
+            "error": str(error),
+            "row": json.loads(_encode_row(row)),
+        })
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(record + '\n')
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        print(f"Moved unstorable ingest row for user {row[0]} at {row[TIME_INDEX]} to {self.dead_letter_path}")
+        with self._cond:
+            self._dead_lettered += 1
+            self._settle([row])
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                # Flush when a batch fills up, or every max_delay with whatever is waiting
+                self._cond.wait_for(
+                    lambda: len(self._pending) >= self.max_batch or self._flush_requested
+                    or self._closed,
+                    timeout=self.max_delay)
+                if not self._pending:
+                    if self._closed:
+                        return
+                    # Nothing left to take; a batch in flight covers the request
+                    self._flush_requested = False
+                    continue
+                batch, paths = self._take_batch()
+
+            self._flush_isolating(batch, self.max_retries)
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if self._adopted:
+                self._release_adopted()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Stop accepting rows and flush whatever is still pending."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            self._segment.close()
+            logs = glob.glob(os.path.join(self.log_dir, '*.log'))
+            if not self._pending and not self._adopted and \
+                    all(os.path.getsize(path) == 0 for path in logs):
+                # Nothing left to replay
+                shutil.rmtree(self.log_dir, ignore_errors=True)
+            os.close(self._owner_lock)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "pending_rows": len(self._pending),
+                "appended_rows": self._appended,
+                "flushed_rows": self._rows_flushed,
+                "batches": self._batches,
+                "flush_failures": self._flush_failures,
+                "dead_lettered_rows": self._dead_lettered,
+                "last_batch_size": self._last_batch_size,
+                "max_batch_size": self._max_batch_size,
+                "avg_batch_size": round(self._rows_flushed / self._batches, 2) if self._batches else 0.0,
+                "last_flush_seconds": round(self._last_flush_time, 6),
+                "avg_flush_seconds": round(self._total_flush_time / self._batches, 6) if self._batches else 0.0,
+                "max_flush_seconds": round(self._max_flush_time, 6),
+            }
@@ -0,0 +1,144 @@
+"""Merging pings that arrive after a later one from the same user was stored.
+
+Every final_table row carries running totals built on the row before it, so
+a late (delayed, retried or reordered) ping can't simply be appended. For
+each day that gets late pings we read the row just before the earliest one
+and the rest of that day, rebuild the chain with the new pings slotted in,
+insert them and rewrite only the rows whose totals changed. Days after it
+keep their own time_outside and day totals; only total_time_outside moves,
+by the same amount for every later row, which is one UPDATE.
+
+A ping whose (user_id, time) is already stored is a retry and is skipped.
+"""
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from psycopg2.extras import execute_values
+
+from daily_summary import upsert_daily_summary
+from ingest_buffer import insert_final_rows
+from user_state import LastState
+
+STATE_COLUMNS = 'time, "outside?", time_outside, total_time_outside, total_time_outside_for_given_day'
+
+PREVIOUS_ROW_SQL = f"""
+    SELECT {STATE_COLUMNS}
+    FROM final_table
+    WHERE user_id = %s AND time < %s
+    ORDER BY time DESC
+    LIMIT 1
+"""
+
+DAY_TAIL_SQL = f"""
+    SELECT {STATE_COLUMNS}
+    FROM final_table
+    WHERE user_id = %s AND time >= %s AND time < %s
+    ORDER BY time
+"""
+
+UPDATE_TOTALS_SQL = """
+    UPDATE final_table f SET
+        time_outside = v.time_outside,
+        total_time_outside = v.total_time_outside,
+        total_time_outside_for_given_day = v.total_time_outside_for_given_day
+    FROM (VALUES %s) AS v (user_id, time, time_outside, total_time_outside,
+                           total_time_outside_for_given_day)
+    WHERE f.user_id = v.user_id AND f.time = v.time
+"""
+
+SHIFT_TOTALS_SQL = """
+    UPDATE final_table SET total_time_outside = total_time_outside + %s
+    WHERE user_id = %s AND time >= %s
+"""
+
+SET_DAY_OUTSIDE_SQL = """
+    UPDATE daily_summary SET outside_seconds = %s
+    WHERE user_id = %s AND day = %s
+"""
+
+# build(sample, previous state) -> final_table row, as app.build_final_row
+BuildRow = Callable[[Dict[str, Any], Optional[LastState]], Tuple]
+# advance(previous state, time, outside) -> (time_outside, total, day total),
+# as app.advance_running_totals
+Advance = Callable[[Optional[LastState], datetime, bool], Tuple[float, float, float]]
+
+
+class MergeResult:
+    def __init__(self):
+        self.rows: Dict[datetime, Tuple] = {}  # inserted rows by time
+        self.duplicates = 0
+        self.rows_rewritten = 0
+        self.days: List[date] = []
+
+
+def _merge_day(cur, user_id: str, day: date, samples: List[Dict[str, Any]],
+               build: BuildRow, advance: Advance, result: MergeResult) -> None:
+    first = samples[0]['time']
+    cur.execute(PREVIOUS_ROW_SQL, (user_id, first))
+    found = cur.fetchone()
+    previous = LastState(*found) if found else None
+    next_day = datetime.combine(day + timedelta(days=1), datetime.min.time())
+    cur.execute(DAY_TAIL_SQL, (user_id, first, next_day))
+    tail = [LastState(*found) for found in cur.fetchall()]
+
+    stored = {state.time for state in tail}
+    fresh = []
+    for sample in samples:
+        if sample['time'] in stored:
+            result.duplicates += 1
+        else:
+            stored.add(sample['time'])
+            fresh.append(sample)
+    if not fresh:
+        return
+
+    old_total = tail[-1].total_time_outside if tail else \
+        (previous.total_time_outside if previous else 0)
+
+    # Walk the day from the first late ping, new and stored rows interleaved
+    merged = sorted([(s['time'], 0, s) for s in fresh] + [(t.time, 1, t) for t in tail],
+                    key=lambda item: item[0])
+    state, inserted, rewritten = previous, [], []
+    for moment, is_stored, item in merged:
+        if not is_stored:
+            row = build(item, state)
+            inserted.append(row)
+            state = LastState(*row[1:6])
+            continue
+        totals = advance(state, moment, item.outside)
+        if totals != tuple(item[2:]):
+            rewritten.append((user_id, moment, *totals))
+        state = LastState(moment, item.outside, *totals)
+
+    written = insert_final_rows(cur, inserted)
+    # Anything not written was stored by a concurrent request since the read
+    result.duplicates += len(inserted) - len(written)
+    if rewritten:
+        execute_values(cur, UPDATE_TOTALS_SQL, rewritten)
+    upsert_daily_summary(cur, written)
+    # The day's latest row may be an old one whose total just changed
+    cur.execute(SET_DAY_OUTSIDE_SQL, (state.total_time_outside_for_given_day, user_id, day))
+
+    shift = state.total_time_outside - old_total
+    if shift:
+        cur.execute(SHIFT_TOTALS_SQL, (shift, user_id, next_day))
+
+    result.rows.update((row[1], row) for row in written)
+    result.rows_rewritten += len(rewritten)
+    result.days.append(day)
+
+
+def merge_late_samples(cur, user_id: str, samples: Sequence[Dict[str, Any]],
+                       build: BuildRow, advance: Advance) -> MergeResult:
+    """Insert parsed pings that are older than the user's latest stored row.
+
+    Runs in the caller's transaction; days are handled oldest first so each
+    one starts from totals already shifted by the days before it.
+    """
+    by_day: Dict[date, List[Dict[str, Any]]] = {}
+    for sample in sorted(samples, key=lambda s: s['time']):
+        by_day.setdefault(sample['time'].date(), []).append(sample)
+    result = MergeResult()
+    for day in sorted(by_day):
+        _merge_day(cur, user_id, day, by_day[day], build, advance, result)
+    return result
@@ -0,0 +1,266 @@
+"""Outdoor illuminance (lux) estimated from sun elevation, weather and UV index.
+
+Clear-sky global horizontal illuminance follows the sun's elevation
+(Kasten-Young air mass with Meinel's attenuation, plus ~10% diffuse light,
+and a log-linear fall-off through civil twilight). It is scaled by a
+cloud transmission factor looked up from the exact weather condition text.
+When a UV index is reported it refines that factor, since UV tracks cloud
+cover. Without an elevation the app's original per-condition values are
+used, so pings with no position get the lux they always did.
+
+``python lux.py backfill`` recomputes final_table.lux in bulk.
+"""
+import argparse
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+SOLAR_ILLUMINANCE = 128000  # lux, outside the atmosphere, sun overhead
+DIFFUSE_FRACTION = 0.1
+CIVIL_TWILIGHT = -6.0  # degrees; darker than this counts as night
+TWILIGHT_HORIZON_LUX = 400  # roughly, with the sun on the horizon
+CLEAR_SKY_UV_AT_ZENITH = 12.5
+MIN_UV_FOR_CLOUD_ESTIMATE = 1.0  # below this the UV reading says little about cloud
+UV_WEIGHT = 0.5  # share of the cloud factor taken from UV when it's usable
+
+# Fraction of clear-sky light that gets through, by weather condition. Keys
+# are the condition texts WeatherAPI returns, compared lower-cased
+CONDITION_TRANSMISSION = {
+    'sunny': 1.0,
+    'clear': 1.0,
+    'mostly sunny': 0.85,
+    'partly cloudy': 0.6,
+    'cloudy': 0.35,
+    'overcast': 0.2,
+    'mist': 0.4,
+    'fog': 0.15,
+    'freezing fog': 0.15,
+    'patchy rain possible': 0.35,
+    'patchy rain nearby': 0.35,
+    'patchy light drizzle': 0.3,
+    'light drizzle': 0.25,
+    'patchy light rain': 0.3,
+    'light rain': 0.25,
+    'light rain shower': 0.3,
+    'moderate rain at times': 0.18,
+    'moderate rain': 0.15,
+    'moderate or heavy rain shower': 0.12,
+    'heavy rain at times': 0.1,
+    'heavy rain': 0.08,
+    'torrential rain shower': 0.05,
+    'thundery outbreaks possible': 0.2,
+    'patchy light rain with thunder': 0.1,
+    'moderate or heavy rain with thunder': 0.05,
+    'thunderstorm': 0.05,
+    'patchy snow possible': 0.4,
+    'light snow': 0.35,
+    'moderate snow': 0.25,
+    'heavy snow': 0.15,
+    'blizzard': 0.1,
+    'light sleet': 0.25,
+    'moderate or heavy sleet': 0.15,
+    'rain': 0.15,
+    'snow': 0.3,
+    'unknown': 0.5,
+}
+
+# Fallback for texts not in the table, most specific first
+_KEYWORD_TRANSMISSION = sorted(
+    ((condition, factor) for condition, factor in CONDITION_TRANSMISSION.items()
+     if condition != 'unknown'),
+    key=lambda item: -len(item[0]))
+
+
+# Lux by weather from before the sun's position was used, matched the same
+# way: the first entry whose text appears in the condition wins
+LEGACY_WEATHER_LUX = (
+    ('clear', 100000),
+    ('sunny', 100000),
+    ('mostly sunny', 80000),
+    ('partly cloudy', 50000),
+    ('cloudy', 25000),
+    ('overcast', 10000),
+    ('light rain', 15000),
+    ('rain', 8000),
+    ('heavy rain', 5000),
+    ('thunderstorm', 3000),
+    ('snow', 15000),
+    ('fog', 10000),
+)
+LEGACY_UNKNOWN_LUX = 25000
+
+
+@lru_cache(maxsize=1024)
+def legacy_lux(weather: Optional[str]) -> int:
+    """Lux for a ping whose sun elevation isn't known."""
+    condition = (weather or 'unknown').lower().strip()
+    for keyword, lux in LEGACY_WEATHER_LUX:
+        if keyword in condition:
+            return lux
+    return LEGACY_UNKNOWN_LUX
+
+
+@lru_cache(maxsize=1024)
+def condition_transmission(weather: Optional[str]) -> float:
+    """Cloud transmission factor for a weather condition text."""
+    condition = (weather or 'unknown').lower().strip()
+    factor = CONDITION_TRANSMISSION.get(condition)
+    if factor is not None:
+        return factor
+    for keyword, factor in _KEYWORD_TRANSMISSION:
+        if keyword in condition:
+            return factor
+    return CONDITION_TRANSMISSION['unknown']
+
+
+def clear_sky_lux(elevation) -> np.ndarray:
+    """Clear-sky global horizontal illuminance for sun elevations in degrees."""
+    elevation = np.asarray(elevation, dtype=float)
+    up = np.maximum(elevation, 0.0)
+    sin_up = np.sin(np.radians(up))
+    air_mass = 1 / (sin_up + 0.50572 * (up + 6.07995) ** -1.6364)
+    direct = SOLAR_ILLUMINANCE * 0.7 ** (air_mass ** 0.678)
+    daylight = direct * sin_up * (1 + DIFFUSE_FRACTION)
+    twilight = TWILIGHT_HORIZON_LUX * 10 ** (elevation * 0.4)
+    lux = np.where(elevation > 0, np.maximum(daylight, TWILIGHT_HORIZON_LUX), twilight)
+    return np.where(elevation < CIVIL_TWILIGHT, 0.0, lux)
+
+
+def _cloud_factor(transmission: np.ndarray, elevation: Optional[np.ndarray], uv) -> np.ndarray:
+    if uv is None or elevation is None:
+        return transmission
+    uv = np.asarray(uv, dtype=float)
+    clear_uv = CLEAR_SKY_UV_AT_ZENITH * np.sin(np.radians(np.maximum(elevation, 0))) ** 2.42
+    usable = ~np.isnan(uv) & (clear_uv >= MIN_UV_FOR_CLOUD_ESTIMATE)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv_factor = np.clip(uv / clear_uv, 0.05, 1.0)
+    return np.where(usable, (1 - UV_WEIGHT) * transmission + UV_WEIGHT * uv_factor, transmission)
+
+
+def estimate_lux_array(conditions: Sequence[Optional[str]], elevation=None, uv=None) -> np.ndarray:
+    """Vectorised estimate_lux over equal-length sequences (uv may hold NaN)."""
+    conditions = np.asarray(conditions, dtype=object)
+    # Look each distinct condition up once
+    unique, inverse = np.unique(conditions.astype(str), return_inverse=True)
+    unique = [None if c == 'None' else c for c in unique]
+    if elevation is None:
+        return np.array([legacy_lux(c) for c in unique], dtype=int)[inverse].reshape(conditions.shape)
+    factors = np.array([condition_transmission(c) for c in unique])
+    transmission = factors[inverse].reshape(conditions.shape)
+    elevation = np.asarray(elevation, dtype=float)
+    lux = clear_sky_lux(elevation) * _cloud_factor(transmission, elevation, uv)
+    return np.rint(lux).astype(int)
+
+
+def estimate_lux(weather: Optional[str], elevation: Optional[float] = None,
+                 uv: Optional[float] = None) -> int:
+    """Estimated lux for one ping. ``elevation`` is the sun's, in degrees."""
+    if elevation is None:
+        return legacy_lux(weather)
+    transmission = condition_transmission(weather)
+    factor = _cloud_factor(np.float64(transmission), np.float64(elevation),
+                           np.nan if uv is None else uv)
+    return int(round(float(clear_sky_lux(elevation) * factor)))
+
+
+def backfill(conn, since: Optional[date] = None, user_id: Optional[str] = None,
+             location: Optional[Tuple[float, float, int]] = None, batch_size: int = 50000) -> int:
+    """Recompute final_table.lux for rows from ``since``, optionally for one user.
+
+    final_table doesn't store positions, so each user's last known one in
+    user_location is used and users without one are left alone. A
+    (latitude, longitude, utc_offset) ``location`` overrides it, which needs
+    ``user_id``. Returns rows updated.
+    """
+    from psycopg2.extras import execute_values
+    from solar import solar_elevation
+
+    if location is not None and user_id is None:
+        raise ValueError("a location applies to one user; pass user_id too")
+    start = datetime.combine(since or date.min, datetime.min.time())
+    if location is not None:
+        query = ("SELECT user_id, time, weather, uv, %s, %s, %s FROM final_table "
+                 "WHERE user_id = %s AND time >= %s")
+        params = (*location, user_id, start)
+    else:
+        query = ("SELECT f.user_id, f.time, f.weather, f.uv, l.latitude, l.longitude, l.utc_offset "
+                 "FROM final_table f JOIN user_location l ON l.user_id = f.user_id "
+                 "WHERE f.time >= %s")
+        params = (start,)
+        if user_id is not None:
+            query += " AND f.user_id = %s"
+            params += (user_id,)
+
+    # Server-side cursor held across commits, so each batch commits on its own
+    read = conn.cursor(name='lux_backfill', withhold=True)
+    read.execute(query, params)
+    conn.commit()
+    write = conn.cursor()
+    updated = 0
+    while True:
+        rows = read.fetchmany(batch_size)
+        if not rows:
+            break
+        times = np.array([row[1] for row in rows], dtype='datetime64[s]')
+        offsets = np.array([int(row[6]) for row in rows], dtype='timedelta64[m]')
+        elevation = solar_elevation([row[4] for row in rows], [row[5] for row in rows],
+                                    times - offsets)
+        uv = np.array([np.nan if row[3] is None else float(row[3]) for row in rows])
+        lux = estimate_lux_array([row[2] for row in rows], elevation, uv)
+        execute_values(
+            write,
+            """UPDATE final_table AS f SET lux = v.lux
+               FROM (VALUES %s) AS v (user_id, time, lux)
+               WHERE f.user_id = v.user_id AND f.time = v.time""",
+            [(row[0], row[1], int(value)) for row, value in zip(rows, lux)],
+            page_size=1000,
+        )
+        conn.commit()
+        updated += len(rows)
+        print(f"Updated {updated} rows")
+    read.close()
+    return updated
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Recompute final_table.lux")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help="recompute stored lux values")
+    backfill_parser.add_argument('--user', help="only this user's rows")
+    backfill_parser.add_argument('--latitude', type=float,
+                                 help="use this position instead of user_location (needs --user)")
+    backfill_parser.add_argument('--longitude', type=float)
+    backfill_parser.add_argument('--utc-offset', type=int, default=None,
+                                 help="minutes east of UTC (default: from longitude)")
+    backfill_parser.add_argument('--since', type=date.fromisoformat, help="YYYY-MM-DD")
+    backfill_parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+    if (args.latitude is None) != (args.longitude is None):
+        parser.error("--latitude and --longitude go together")
+    if args.latitude is not None and args.user is None:
+        parser.error("--latitude/--longitude need --user; users' own positions are used otherwise")
+
+    import psycopg2
+    from app import DB_CONFIG
+    from daily_summary import backfill as backfill_summaries
+    from solar import default_utc_offset
+
+    location = None
+    if args.latitude is not None:
+        utc_offset = args.utc_offset if args.utc_offset is not None else default_utc_offset(args.longitude)
+        location = (args.latitude, args.longitude, utc_offset)
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        updated = backfill(conn, args.since, args.user, location, args.batch_size)
+        # daily_summary keeps a lux sum per day, so bring it back in line
+        backfill_summaries(conn.cursor(), user_id=args.user, since=args.since)
+        conn.commit()
+        print(f"Recomputed lux for {updated} rows")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Request latency histograms, sub-span timings and a slow-request profiler.
+
+Routes are timed by hooks in app.py and exposed on /metrics in the
+Prometheus text format. Code on the request path wraps interesting steps in
+``span(name)``; each span is recorded against the route being served.
+Chart renders happen in worker processes, so their spans are collected with
+``capture_spans`` there and replayed here by the render pool.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import psycopg2.extensions
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+current_route: ContextVar[str] = ContextVar('current_route', default='none')
+# Set inside capture_spans(); spans go to this list instead of the registry
+_captured: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar('captured_spans', default=None)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values."""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str],
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            # Per-bucket counts, then sum and count
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            base = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative:g}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {series[-1]:g}')
+            lines.append(f'{self.name}_sum{{{base}}} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{base}}} {series[-1]:g}')
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_seconds = Histogram('solas_request_duration_seconds',
+                            "Time to serve a request, by route, method and status",
+                            ('route', 'method', 'status'))
+span_seconds = Histogram('solas_span_duration_seconds',
+                         "Time spent in a step of a request, by route and span",
+                         ('route', 'span'))
+
+
+def record_span(name: str, seconds: float) -> None:
+    captured = _captured.get()
+    if captured is not None:
+        captured.append((name, seconds))
+    else:
+        span_seconds.observe((current_route.get(), name), seconds)
+
+
+def record_spans(spans: Sequence[Tuple[str, float]]) -> None:
+    """Record spans captured elsewhere (e.g. in a render worker)."""
+    for name, seconds in spans:
+        record_span(name, seconds)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+@contextmanager
+def capture_spans() -> Iterator[List[Tuple[str, float]]]:
+    spans: List[Tuple[str, float]] = []
+    token = _captured.set(spans)
+    try:
+        yield spans
+    finally:
+        _captured.reset(token)
+
+
+_QUERY_VERB = re.compile(r'^\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT|UPDATE|DELETE)\b', re.I | re.S)
+_QUERY_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+("?[\w.]+"?)', re.I)
+
+
+def query_label(query) -> str:
+    """A short, low-cardinality name for a SQL statement, e.g. "select final_table"."""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = str(query)
+    verb = _QUERY_VERB.match(query)
+    table = _QUERY_TABLE.search(query)
+    return ' '.join(part for part in (
+        verb.group(1).lower() if verb else 'other',
+        table.group(1).strip('"') if table else None) if part)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor that records each statement as a ``db_query:<label>`` span."""
+
+    def execute(self, query, vars=None):
+        with span(f"db_query:{query_label(query)}"):
+            return super().execute(query, vars)
+
+
+def render_prometheus() -> str:
+    return '\n'.join(request_seconds.render() + span_seconds.render()) + '\n'
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of in-flight request threads and, for any request
+    slower than ``threshold`` seconds, writes them out in the collapsed
+    ("folded") format that flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, out_dir: str, threshold: float = 1.0, interval: float = 0.005,
+                 max_samples: int = 20000):
+        self.out_dir = out_dir
+        self.threshold = threshold
+        self.interval = interval
+        self.max_samples = max_samples
+        os.makedirs(out_dir, exist_ok=True)
+        self._active: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._dumped = 0
+        self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                thread_ids = list(self._active)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                with self._lock:
+                    samples = self._active.get(thread_id)
+                    if samples is not None and sum(samples.values()) < self.max_samples:
+                        samples[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def stop(self, route: str, elapsed: float) -> Optional[str]:
+        """Finish the current thread's request; returns the dump path if it was slow."""
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or elapsed < self.threshold:
+            return None
+        name = re.sub(r'[^\w-]+', '_', route).strip('_') or 'root'
+        path = os.path.join(self.out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{int(elapsed * 1000)}ms.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        with self._lock:
+            self._dumped += 1
+        return path
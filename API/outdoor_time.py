@@ -0,0 +1,141 @@
+"""Outdoor intervals for a user-day, computed in one pass over ordered pings.
+
+A ping that follows an outdoor ping on the same day closes an outdoor
+interval ending at that ping, reaching back to the previous ping but never
+more than ``max_gap`` seconds (the same cap used for time_outside). Touching
+or overlapping intervals are merged, so summing them never double-counts.
+"""
+import argparse
+import time as timer
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+Interval = Tuple[datetime, datetime]
+
+# LAG pairs each ping with the one before it in a single ordered scan of the
+# (user_id, time) index; only pings whose predecessor was outside open an interval
+OUTDOOR_INTERVALS_SQL = """
+    SELECT GREATEST(prev_time, time - make_interval(secs => %s)), time
+    FROM (
+        SELECT time,
+               LAG(time) OVER w AS prev_time,
+               LAG("outside?") OVER w AS prev_outside
+        FROM final_table
+        WHERE user_id = %s AND time BETWEEN %s AND %s
+        WINDOW w AS (ORDER BY time)
+    ) pings
+    WHERE prev_outside AND time > prev_time
+    ORDER BY time
+"""
+
+# The same, for many (user_id, day) pairs at once: one scan per user-day
+# through the index, partitioned by user
+BATCH_OUTDOOR_INTERVALS_SQL = """
+    SELECT user_id, GREATEST(prev_time, time - make_interval(secs => %s)), time
+    FROM (
+        SELECT f.user_id, f.time,
+               LAG(f.time) OVER w AS prev_time,
+               LAG(f."outside?") OVER w AS prev_outside
+        FROM unnest(%s::text[], %s::date[]) AS t (user_id, day)
+        JOIN final_table f
+          ON f.user_id = t.user_id AND f.time >= t.day AND f.time < t.day + 1
+        WINDOW w AS (PARTITION BY f.user_id ORDER BY f.time)
+    ) pings
+    WHERE prev_outside AND time > prev_time
+    ORDER BY user_id, time
+"""
+
+
+def merge_intervals(intervals: Iterable[Interval]) -> List[Interval]:
+    """Coalesce touching or overlapping intervals. Input must be sorted by start."""
+    merged: List[Interval] = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _raw_intervals(pings: Iterable[Tuple[datetime, bool]], max_gap: float,
+                   until: Optional[datetime]) -> Iterator[Interval]:
+    cap = timedelta(seconds=max_gap)
+    prev_time, prev_outside = None, False
+    for moment, outside in pings:
+        if prev_outside and moment > prev_time and moment.date() == prev_time.date():
+            yield max(prev_time, moment - cap), moment
+        prev_time, prev_outside = moment, outside
+    # Still outside at the last ping: count up to ``until``, capped like any gap
+    if until is not None and prev_outside and until > prev_time and until.date() == prev_time.date():
+        yield prev_time, min(until, prev_time + cap)
+
+
+def outdoor_intervals(pings: Iterable[Tuple[datetime, bool]], max_gap: float = 600,
+                      until: Optional[datetime] = None) -> List[Interval]:
+    """Merged outdoor intervals from ``(time, outside)`` pings sorted by time.
+
+    With ``until`` (e.g. now), an outdoor streak still open at the last ping
+    is counted up to that moment.
+    """
+    return merge_intervals(_raw_intervals(pings, max_gap, until))
+
+
+def total_seconds(intervals: Iterable[Interval]) -> float:
+    return sum((end - start).total_seconds() for start, end in intervals)
+
+
+def fetch_outdoor_intervals(cur, user_id: str, day: date, max_gap: float = 600,
+                            until: Optional[datetime] = None) -> List[Interval]:
+    """Merged outdoor intervals for one user-day, straight from final_table."""
+    start_of_day = datetime.combine(day, time(0, 0))
+    end_of_day = datetime.combine(day, time(23, 59, 59, 999999))
+    cur.execute(OUTDOOR_INTERVALS_SQL, (max_gap, user_id, start_of_day, end_of_day))
+    intervals = merge_intervals(cur)
+    if until is not None:
+        cur.execute(
+            """SELECT time, "outside?" FROM final_table
+               WHERE user_id = %s AND time BETWEEN %s AND %s
+               ORDER BY time DESC LIMIT 1""",
+            (user_id, start_of_day, min(until, end_of_day))
+        )
+        last = cur.fetchone()
+        if last is not None:
+            tail = list(_raw_intervals([last], max_gap, until))
+            intervals = merge_intervals(intervals + tail)
+    return intervals
+
+
+def fetch_outdoor_intervals_batch(cur, user_days: Dict[str, date],
+                                  max_gap: float = 600) -> Dict[str, List[Interval]]:
+    """Merged outdoor intervals for each user's day in ``user_days``, in one
+    query. Users without any are left out."""
+    if not user_days:
+        return {}
+    users = list(user_days)
+    cur.execute(BATCH_OUTDOOR_INTERVALS_SQL, (max_gap, users, [user_days[u] for u in users]))
+    intervals: Dict[str, List[Interval]] = {}
+    for user_id, start, end in cur.fetchall():
+        intervals.setdefault(user_id, []).append((start, end))
+    return {user_id: merge_intervals(found) for user_id, found in intervals.items()}
+
+
+def _benchmark(sizes: List[int], max_gap: float) -> None:
+    # Pings spread over one day, alternating outdoor/indoor streaks of 50
+    day = datetime(2024, 6, 1)
+    print(f"{'rows':>8} {'seconds':>10} {'us/row':>8} {'intervals':>10}")
+    for size in sizes:
+        step = 86399.0 / size
+        pings = [(day + timedelta(seconds=i * step), (i // 50) % 2 == 0) for i in range(size)]
+        started = timer.perf_counter()
+        intervals = outdoor_intervals(pings, max_gap)
+        elapsed = timer.perf_counter() - started
+        print(f"{size:>8} {elapsed:>10.4f} {elapsed / size * 1e6:>8.3f} {len(intervals):>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time outdoor_intervals on synthetic pings")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--max-gap', type=float, default=600)
+    args = parser.parse_args()
+    _benchmark(args.sizes, args.max_gap)
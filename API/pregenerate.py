@@ -0,0 +1,265 @@
+"""Pre-renders active users' charts into the render cache ahead of the bursts.
+
+Users open the app in bursts (mornings, after sunset), and each open asks
+for a fresh daily and weekly chart. A scheduled job, run at the start of
+every RENDER_CACHE_TIME_BUCKET, picks the users seen in the last
+PREGENERATE_ACTIVE_DAYS days whose local time is inside one of
+PREGENERATE_WINDOWS or past their sunset. It reads everything their charts
+need with a handful of set-based queries and renders whatever isn't cached
+yet on the render pool, so at peak the request itself is a cache lookup.
+
+After sunset daily_cache_key stops changing, so the evening chart is
+rendered once per user. The render cache belongs to the process, so each
+process that serves charts runs its own schedule (app.start_pregeneration).
+``python pregenerate.py`` runs a single pass and prints what it did.
+"""
+import threading
+import time as timer
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from app import (
+    DAILY_CHART_DPI, DAILY_CHART_WIDTH_INCHES, MAX_TIME_BETWEEN_UPDATES,
+    PREGENERATE_ACTIVE_DAYS, PREGENERATE_CONCURRENCY, PREGENERATE_WINDOWS,
+    RENDER_CACHE_TIME_BUCKET, WEEKLY_CHART_DPI, WEEKLY_CHART_WIDTH_INCHES,
+    chart_range_series, chart_range_start, daily_cache_key, format_time, get_db_connection,
+    get_hour_markers, parse_chart_options, parse_clock, release_db_connection, render_cache,
+    render_pool, resolve_sun_times, weekly_cache_key,
+)
+from daily_summary import read_daily_summaries
+from metrics import current_route
+from outdoor_time import fetch_outdoor_intervals_batch
+from render_pool import RenderUnavailable
+from segments import build_segments
+
+ACTIVE_USERS_SQL = """
+    SELECT l.user_id, l.latitude, l.longitude, l.utc_offset
+    FROM user_location l
+    WHERE EXISTS (SELECT 1 FROM daily_summary s WHERE s.user_id = l.user_id AND s.day >= %s)
+"""
+
+# The latest row of each (user_id, day), one index probe per pair
+DAY_TOTALS_SQL = """
+    SELECT t.user_id, last.total_time_outside_for_given_day
+    FROM unnest(%s::text[], %s::date[]) AS t (user_id, day)
+    CROSS JOIN LATERAL (
+        SELECT f.total_time_outside_for_given_day
+        FROM final_table f
+        WHERE f.user_id = t.user_id AND f.time >= t.day AND f.time < t.day + 1
+        ORDER BY f.time DESC
+        LIMIT 1
+    ) last
+"""
+
+# What the app asks for when it doesn't pass any chart options
+DAILY_OPTIONS = parse_chart_options({}, DAILY_CHART_DPI, DAILY_CHART_WIDTH_INCHES)
+WEEKLY_OPTIONS = parse_chart_options({}, WEEKLY_CHART_DPI, WEEKLY_CHART_WIDTH_INCHES)
+WEEKLY_RANGE = 'week'
+
+
+class UserPlan(NamedTuple):
+    user_id: str
+    now: datetime  # the user's local time
+    sunrise_str: str
+    sunset_str: str
+    sunrise_time: time
+    sunset_time: time
+
+
+# (cache key, render function, args, kwargs)
+RenderTask = Tuple[Tuple, Any, Tuple, Dict[str, Any]]
+
+
+def parse_windows(windows: Iterable[Tuple[str, str]]) -> List[Tuple[time, time]]:
+    return [(parse_clock(start), parse_clock(end)) for start, end in windows]
+
+
+def read_day_totals(cur, user_days: Dict[str, date]) -> Dict[str, float]:
+    """total_time_outside_for_given_day of each user's latest row on their day."""
+    if not user_days:
+        return {}
+    users = list(user_days)
+    cur.execute(DAY_TOTALS_SQL, (users, [user_days[u] for u in users]))
+    return {user_id: total for user_id, total in cur.fetchall()}
+
+
+class Pregenerator:
+    """Scheduled chart pre-rendering; see the module docstring.
+
+    At most ``concurrency`` renders are in flight at once, which should stay
+    below the render pool's max_pending so live requests still get a slot.
+    If the pool is saturated anyway the rest of the pass is skipped.
+    """
+
+    def __init__(self, windows: Sequence[Tuple[str, str]], active_days: int = 7,
+                 concurrency: int = 1, interval: int = 300):
+        self.windows = parse_windows(windows)
+        self.active_days = active_days
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self._scheduler = None
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        self._last_run: Optional[datetime] = None
+        self._last_run_seconds = 0.0
+
+    def due(self, local_now: datetime, sunset_time: time) -> bool:
+        now = local_now.time()
+        return now >= sunset_time or any(start <= now < end for start, end in self.windows)
+
+    def plan(self, users: Iterable[Tuple[str, float, float, int]], now_utc: datetime) -> List[UserPlan]:
+        """The users whose charts are due at ``now_utc``, with their sun times."""
+        plans = []
+        for user_id, latitude, longitude, utc_offset in users:
+            local_now = now_utc + timedelta(minutes=utc_offset)
+            location = {"latitude": latitude, "longitude": longitude, "utc_offset": utc_offset}
+            sunrise_str, sunset_str = resolve_sun_times(location, local_now.date())
+            sunrise_time, sunset_time = parse_clock(sunrise_str), parse_clock(sunset_str)
+            if self.due(local_now, sunset_time):
+                plans.append(UserPlan(user_id, local_now, sunrise_str, sunset_str,
+                                      sunrise_time, sunset_time))
+        return plans
+
+    def _daily_task(self, plan: UserPlan, total: Optional[float],
+                    intervals: List[Tuple[datetime, datetime]]) -> Optional[RenderTask]:
+        # Mirrors app.daily_visualisation
+        today = plan.now.date()
+        total = total or 0
+        segments = build_segments(((start.time(), end.time()) for start, end in intervals),
+                                  today, plan.sunrise_time, plan.sunset_time)
+        key = daily_cache_key(plan.user_id, today, plan.sunrise_str, plan.sunset_str,
+                              plan.sunrise_time, plan.sunset_time, format_time(total), segments,
+                              plan.now, DAILY_OPTIONS)
+        if render_cache.contains(key):
+            return None
+        args = (today, plan.sunrise_str, plan.sunset_str, plan.sunrise_time, plan.sunset_time,
+                segments, get_hour_markers(today, plan.sunrise_time, plan.sunset_time),
+                plan.now.time(), format_time(total))
+        return key, render_pool.render_daily, args, {"fmt": DAILY_OPTIONS['format'],
+                                                     "dpi": DAILY_OPTIONS['dpi']}
+
+    def _weekly_task(self, plan: UserPlan, summaries: Dict[date, Dict[str, Any]]) -> Optional[RenderTask]:
+        # Mirrors app.weekly_time_outside_graph
+        today = plan.now.date()
+        start_date = chart_range_start(WEEKLY_RANGE, today)
+        day_names, minutes = chart_range_series(WEEKLY_RANGE, today, start_date, summaries)
+        key = weekly_cache_key(plan.user_id, today, WEEKLY_RANGE, minutes, WEEKLY_OPTIONS)
+        if render_cache.contains(key):
+            return None
+        return key, render_pool.render_weekly, (day_names, minutes), {"fmt": WEEKLY_OPTIONS['format'],
+                                                                      "dpi": WEEKLY_OPTIONS['dpi']}
+
+    def _render_all(self, tasks: List[RenderTask]) -> Counter:
+        busy = threading.Event()
+
+        def render(task: RenderTask) -> str:
+            key, fn, args, kwargs = task
+            if busy.is_set():
+                return 'skipped_busy'
+            current_route.set('pregenerate')
+            try:
+                image = fn(*args, **kwargs)
+            except RenderUnavailable:
+                # Requests come first; try again next pass
+                busy.set()
+                return 'skipped_busy'
+            except Exception as e:
+                print(f"Pre-generation render failed: {str(e)}")
+                return 'failed'
+            render_cache.put(key, image)
+            return 'rendered'
+
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix='pregenerate') as pool:
+            return Counter(pool.map(render, tasks))
+
+    def run_once(self, now_utc: Optional[datetime] = None) -> Dict[str, int]:
+        """One pass: find the due users, batch-read their data, render what's missing."""
+        started = timer.perf_counter()
+        now_utc = now_utc or datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(ACTIVE_USERS_SQL, (now_utc.date() - timedelta(days=self.active_days),))
+            plans = self.plan(cur.fetchall(), now_utc)
+            user_days = {plan.user_id: plan.now.date() for plan in plans}
+            day_totals = read_day_totals(cur, user_days)
+            intervals = fetch_outdoor_intervals_batch(cur, user_days, MAX_TIME_BETWEEN_UPDATES)
+            summaries = read_daily_summaries(cur, {
+                user_id: (chart_range_start(WEEKLY_RANGE, day), day) for user_id, day in user_days.items()
+            })
+        finally:
+            release_db_connection(conn)
+
+        tasks = []
+        for plan in plans:
+            for task in (self._daily_task(plan, day_totals.get(plan.user_id), intervals.get(plan.user_id, [])),
+                         self._weekly_task(plan, summaries.get(plan.user_id, {}))):
+                if task is not None:
+                    tasks.append(task)
+        counts = self._render_all(tasks)
+        counts['users_due'] = len(plans)
+        counts['already_cached'] = 2 * len(plans) - len(tasks)
+
+        with self._lock:
+            self._counts.update(counts)
+            self._counts['runs'] += 1
+            self._last_run = now_utc
+            self._last_run_seconds = timer.perf_counter() - started
+        return dict(counts)
+
+    def _run_scheduled(self) -> None:
+        try:
+            self.run_once()
+        except Exception as e:
+            print(f"Chart pre-generation failed: {str(e)}")
+
+    def start(self) -> None:
+        """Run a pass at the start of every cache time bucket, in the background."""
+        from apscheduler.schedulers.background import BackgroundScheduler
+
+        with self._lock:
+            if self._scheduler is not None:
+                return
+            # Aligned to the bucket boundaries, so each render is good for a whole bucket
+            first_run = datetime.fromtimestamp((timer.time() // self.interval + 1) * self.interval)
+            scheduler = BackgroundScheduler(daemon=True)
+            scheduler.add_job(self._run_scheduled, 'interval', seconds=self.interval,
+                              next_run_time=first_run, max_instances=1, coalesce=True,
+                              misfire_grace_time=self.interval // 2)
+            scheduler.start()
+            self._scheduler = scheduler
+
+    def shutdown(self) -> None:
+        with self._lock:
+            scheduler, self._scheduler = self._scheduler, None
+        if scheduler is not None:
+            scheduler.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "scheduled": self._scheduler is not None,
+                "windows": [f"{start:%H:%M}-{end:%H:%M}" for start, end in self.windows],
+                "runs": self._counts['runs'],
+                "users_due": self._counts['users_due'],
+                "rendered": self._counts['rendered'],
+                "already_cached": self._counts['already_cached'],
+                "skipped_busy": self._counts['skipped_busy'],
+                "failed": self._counts['failed'],
+                "last_run": self._last_run.isoformat() if self._last_run else None,
+                "last_run_seconds": round(self._last_run_seconds, 3),
+            }
+
+
+pregenerator = Pregenerator(PREGENERATE_WINDOWS, PREGENERATE_ACTIVE_DAYS,
+                            PREGENERATE_CONCURRENCY, RENDER_CACHE_TIME_BUCKET)
+
+
+if __name__ == '__main__':
+    try:
+        print(pregenerator.run_once())
+    finally:
+        render_pool.shutdown()
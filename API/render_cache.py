@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Any, Hashable, Optional, Tuple
+
+
+class RenderCache:
+    """Size-bounded LRU cache of rendered chart images.
+
+    Keys are tuples whose first two items are ``(user_id, date)`` so that
+    every entry for a user's day can be dropped at once when new data for
+    that day is ingested. Entries are evicted least-recently-used first once
+    either ``max_entries`` or ``max_bytes`` is exceeded.
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._sizes: Dict[Tuple, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def contains(self, key: Tuple) -> bool:
+        """Whether ``key`` is cached, without counting a hit or miss or
+        refreshing its place in the LRU order."""
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: Tuple, value: Any, size: Optional[int] = None) -> None:
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._sizes.pop(key)
+                del self._entries[key]
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(old_key)
+                self._evictions += 1
+
+    def invalidate(self, user_id: Hashable, day: date) -> int:
+        """Drop every cached render for ``user_id`` on ``day``; returns the count removed."""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == user_id and key[1] == day]
+            for key in stale:
+                del self._entries[key]
+                self._bytes -= self._sizes.pop(key)
+            self._invalidations += len(stale)
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+
+def time_bucket(moment: datetime, bucket_seconds: int) -> datetime:
+    """Round ``moment`` down to the start of its ``bucket_seconds`` window."""
+    seconds_into_day = moment.hour * 3600 + moment.minute * 60 + moment.second
+    bucket_start = seconds_into_day - seconds_into_day % bucket_seconds
+    return datetime.combine(moment.date(), time(0, 0)) + timedelta(seconds=bucket_start)
@@ -0,0 +1,285 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Tuple
+
+from metrics import capture_spans, record_span, record_spans
+
+if TYPE_CHECKING:
+    from daily_chart import DailyChartRenderer
+
+# Per-process renderer; in a worker it's set up by _init_worker, and in the
+# inline (workers=0) mode by RenderPool itself on first use
+_daily_renderer: Optional["DailyChartRenderer"] = None
+
+
+class RenderUnavailable(Exception):
+    """Base of the errors after which the client should retry in ``retry_after`` seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RenderPoolSaturated(RenderUnavailable):
+    """Raised when the pool already has ``max_pending`` renders queued or running."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Chart renderer is busy, try again shortly", retry_after)
+
+
+class RenderTimeout(RenderUnavailable):
+    """Raised when a render doesn't finish within the pool's timeout."""
+
+    def __init__(self, timeout: float, retry_after: int):
+        super().__init__(f"Chart render timed out after {timeout}s", retry_after)
+
+
+class RenderInterrupted(RenderUnavailable):
+    """Raised when a render was lost because its worker died or the pool was
+    recycled after another render timed out."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Chart renderer restarted, try again shortly", retry_after)
+
+
+def _init_worker(daily_dpi: int, max_static_layers: int, started=None) -> None:
+    # Tell the pool which process this is before the slow part, so it can be
+    # killed if the pool is recycled while it is still warming up
+    if started is not None:
+        started.put(os.getpid())
+    # matplotlib is only imported here, so processes that never render (and
+    # the app itself, when renders go to workers) don't load it at all
+    global _daily_renderer
+    from daily_chart import DailyChartRenderer, warm_up
+    renderer = DailyChartRenderer(dpi=daily_dpi, max_layers=max_static_layers)
+    warm_up(renderer.style_name)
+    _daily_renderer = renderer
+
+
+def _ready() -> None:
+    # Submitted by RenderPool.warm_up; a worker only takes tasks once its
+    # initializer has finished
+    pass
+
+
+# Workers hand back the spans timed while rendering along with the image,
+# so they can be recorded against the request in the parent process
+def _render_daily(*args, **kwargs) -> Tuple[bytes, List[Tuple[str, float]]]:
+    with capture_spans() as spans:
+        image = _daily_renderer.render(*args, **kwargs)
+    return image, spans
+
+
+def _render_weekly(*args, **kwargs) -> Tuple[bytes, List[Tuple[str, float]]]:
+    from weekly_chart import render_weekly_chart
+    with capture_spans() as spans:
+        image = render_weekly_chart(*args, **kwargs)
+    return image, spans
+
+
+class RenderPool:
+    """Runs chart renders on a dedicated pool of worker processes.
+
+    Rendering is CPU-bound and holds the GIL, so doing it on the request
+    thread stalls ingestion served by the same worker. At most
+    ``max_pending`` renders may be queued or running at once; beyond that
+    a new render fails fast with RenderPoolSaturated so the route can answer
+    503 instead of piling up work. A render that overruns ``timeout`` can't
+    be stopped on its own, so every worker process is killed and the pool
+    is rebuilt; the other renders in flight at the time fail with
+    RenderInterrupted, which is retryable like the other RenderUnavailable
+    errors.
+
+    With ``workers=0`` renders run inline on the calling thread, which is
+    handy for local development.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 8, timeout: float = 30.0,
+                 retry_after: int = 5, daily_dpi: int = 250, max_static_layers: int = 8):
+        self.workers = workers
+        self.max_pending = max(max_pending, workers, 1)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._initargs = (daily_dpi, max_static_layers)
+
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Where the current executor's workers report their PIDs as they start
+        self._started = None
+        self._inline_lock = threading.Lock()
+        self._inline_ready = False
+
+        self._in_flight = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._failures = 0
+        self._restarts = 0
+
+    def _ensure_inline(self) -> None:
+        with self._inline_lock:
+            if not self._inline_ready:
+                _init_worker(*self._initargs)
+                self._inline_ready = True
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Started lazily so importing the app (or the dev reloader) doesn't spawn workers
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context('spawn')
+                self._started = context.SimpleQueue()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context,
+                    initializer=_init_worker, initargs=self._initargs + (self._started,))
+            return self._executor
+
+    def _worker_pids(self) -> Set[int]:
+        # Called with self._lock held
+        pids = set()
+        if self._started is not None:
+            while not self._started.empty():
+                pids.add(self._started.get())
+        return pids
+
+    def _restart(self, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is not executor:
+                return
+            pids = self._worker_pids()
+            self._executor = None
+            self._started = None
+            self._restarts += 1
+        # ProcessPoolExecutor has no public way to stop a running task, so
+        # kill the workers it started; their futures fail with BrokenProcessPool
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, _future=None) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _run(self, fn: Callable[..., Tuple[bytes, List]], *args, **kwargs) -> bytes:
+        started = time.perf_counter()
+        image, spans = self._call(fn, *args, **kwargs)
+        record_spans(spans)
+        # Includes queueing and the trip to the worker, unlike the spans above
+        record_span('render', time.perf_counter() - started)
+        return image
+
+    def _call(self, fn: Callable[..., Tuple[bytes, List]], *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise RenderPoolSaturated(self.retry_after)
+        with self._lock:
+            self._submitted += 1
+            self._in_flight += 1
+
+        if self.workers == 0:
+            try:
+                self._ensure_inline()
+                result = fn(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self._failures += 1
+                raise
+            finally:
+                self._release()
+            with self._lock:
+                self._completed += 1
+            return result
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            with self._lock:
+                self._failures += 1
+            self._release()
+            self._restart(executor)
+            raise RenderInterrupted(self.retry_after)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+            self._release()
+            raise
+        # The slot is held until the worker is actually done, not just until
+        # this request gives up waiting
+        future.add_done_callback(self._release)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._timeouts += 1
+            self._restart(executor)
+            raise RenderTimeout(self.timeout, self.retry_after)
+        except BrokenProcessPool:
+            with self._lock:
+                self._failures += 1
+            # A worker died (e.g. OOM-killed), or another request's timeout
+            # recycled the pool; start afresh for the next request
+            self._restart(executor)
+            raise RenderInterrupted(self.retry_after)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+            raise
+        with self._lock:
+            self._completed += 1
+        return result
+
+    def render_daily(self, *args, **kwargs) -> bytes:
+        """Same arguments as DailyChartRenderer.render."""
+        return self._run(_render_daily, *args, **kwargs)
+
+    def render_weekly(self, *args, **kwargs) -> bytes:
+        """Same arguments as render_weekly_chart."""
+        return self._run(_render_weekly, *args, **kwargs)
+
+    def warm_up(self) -> None:
+        """Start the worker processes and let them import matplotlib and load
+        fonts now rather than on the first chart request. Blocks until done,
+        so call it from a startup hook or a background thread."""
+        if self.workers == 0:
+            self._ensure_inline()
+            return
+        executor = self._get_executor()
+        # One task per worker makes the executor start all of them
+        for future in [executor.submit(_ready) for _ in range(self.workers)]:
+            future.result(timeout=self.timeout)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._started = None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "in_flight": self._in_flight,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timeouts": self._timeouts,
+                "failures": self._failures,
+                "restarts": self._restarts,
+            }
+        if self.workers == 0 and _daily_renderer is not None:
+            stats.update(_daily_renderer.stats())
+        return stats
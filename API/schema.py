@@ -0,0 +1,367 @@
+"""Versioned schema and migration runner for the Solas database.
+
+Run ``python schema.py migrate`` to bring a database up to date; it is safe
+to run repeatedly (for example from a monthly cron job, which also keeps the
+monthly final_table partitions created ahead of time) and while the API is
+serving traffic. ``python schema.py status`` lists applied migrations.
+"""
+import argparse
+from datetime import date
+from typing import Callable, Dict, List, Tuple
+
+import psycopg2
+from psycopg2 import errors, sql
+
+from daily_summary import backfill
+
+# Arbitrary key for pg_advisory_lock so only one runner migrates at a time
+MIGRATION_LOCK_KEY = 7_402_118_315
+PARTITION_MONTHS_AHEAD = 3
+
+
+def _month_start(day: date, offset: int = 0) -> date:
+    month_index = day.year * 12 + (day.month - 1) + offset
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _relkind(cur, table: str):
+    cur.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+        (table,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _drop_if_invalid(cur, index: str) -> None:
+    # A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which
+    # IF NOT EXISTS would then happily skip
+    cur.execute(
+        """SELECT 1 FROM pg_index
+           WHERE indexrelid = to_regclass(%s) AND NOT indisvalid""",
+        (index,)
+    )
+    if cur.fetchone() and _relkind(cur, index) == 'i':
+        cur.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(index)))
+
+
+def _partitions(cur, parent: str) -> List[str]:
+    cur.execute(
+        """SELECT c.relname FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = to_regclass(%s)
+           ORDER BY c.relname""",
+        (parent,)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def ensure_partitioned_index(cur, table: str, index: str, columns: str,
+                             unique: bool = False) -> None:
+    """Build an index on a partitioned table without blocking writes.
+
+    The parent index is created ON ONLY the parent (which is instant), each
+    partition's index is built CONCURRENTLY and then attached. Partitions
+    created later inherit the index automatically.
+    """
+    create = "CREATE UNIQUE INDEX" if unique else "CREATE INDEX"
+    cur.execute(sql.SQL(create + " IF NOT EXISTS {} ON ONLY {} " + columns).format(
+        sql.Identifier(index), sql.Identifier(table)))
+    attached = set(_partitions(cur, index))
+    for partition in _partitions(cur, table):
+        child_index = f"{partition}_{index[len(table) + 1:]}" if index.startswith(table + '_') \
+            else f"{partition}_{index}"
+        if child_index in attached:
+            continue
+        _drop_if_invalid(cur, child_index)
+        cur.execute(sql.SQL(create + " CONCURRENTLY IF NOT EXISTS {} ON {} " + columns).format(
+            sql.Identifier(child_index), sql.Identifier(partition)))
+        cur.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+            sql.Identifier(index), sql.Identifier(child_index)))
+
+
+def ensure_partitions(cur, months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Create monthly final_table partitions from this month to ``months_ahead`` out.
+
+    Months already covered (for example by final_table_history) are skipped.
+    Returns the names of the partitions created.
+    """
+    if _relkind(cur, 'final_table') != 'p':
+        return []
+    created = []
+    this_month = _month_start(date.today())
+    for offset in range(months_ahead + 1):
+        start = _month_start(this_month, offset)
+        end = _month_start(this_month, offset + 1)
+        name = f"final_table_y{start.year}m{start.month:02d}"
+        if _relkind(cur, name) is not None:
+            continue
+        try:
+            cur.execute(sql.SQL(
+                "CREATE TABLE {} PARTITION OF final_table FOR VALUES FROM (%s) TO (%s)"
+            ).format(sql.Identifier(name)), (start, end))
+            created.append(name)
+        except errors.InvalidObjectDefinition:
+            # Overlaps an existing partition, i.e. the month is already covered
+            pass
+    return created
+
+
+def _create_tables(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS final_table (
+            user_id TEXT NOT NULL,
+            time TIMESTAMP NOT NULL,
+            "outside?" BOOLEAN NOT NULL,
+            time_outside DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_time_outside DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_time_outside_for_given_day DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_available_hours DOUBLE PRECISION,
+            weather TEXT,
+            temperature DOUBLE PRECISION,
+            uv DOUBLE PRECISION,
+            gps_accuracy DOUBLE PRECISION,
+            lux INTEGER
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_accuracy (
+            user_id TEXT NOT NULL,
+            time TIMESTAMP NOT NULL,
+            correct_result BOOLEAN NOT NULL,
+            gps_accuracy DOUBLE PRECISION
+        )
+        """
+    )
+
+
+def _partition_final_table(cur) -> None:
+    """Turn a plain final_table into one range-partitioned by month on time.
+
+    Existing rows are not copied: the old table is renamed to
+    final_table_history and attached as the partition for everything before
+    next month. A validated CHECK constraint lets ATTACH skip its scan, so
+    the only exclusive lock is the brief one around the rename.
+    """
+    if _relkind(cur, 'final_table') == 'p':
+        return
+    cutoff = _month_start(date.today(), 1)
+
+    # Left behind if an earlier run stopped before the swap, possibly with
+    # a cutoff from an earlier month
+    cur.execute("ALTER TABLE final_table DROP CONSTRAINT IF EXISTS final_table_history_range")
+    cur.execute(
+        """ALTER TABLE final_table ADD CONSTRAINT final_table_history_range
+           CHECK (time IS NOT NULL AND time < %s) NOT VALID""",
+        (cutoff,)
+    )
+    # Validation only takes a SHARE UPDATE EXCLUSIVE lock, so writes continue
+    cur.execute("ALTER TABLE final_table VALIDATE CONSTRAINT final_table_history_range")
+
+    cur.execute("BEGIN")
+    try:
+        cur.execute("LOCK TABLE final_table IN ACCESS EXCLUSIVE MODE")
+        cur.execute("ALTER TABLE final_table RENAME TO final_table_history")
+        cur.execute(
+            """CREATE TABLE final_table (LIKE final_table_history INCLUDING DEFAULTS)
+               PARTITION BY RANGE (time)"""
+        )
+        cur.execute(
+            """ALTER TABLE final_table ATTACH PARTITION final_table_history
+               FOR VALUES FROM (MINVALUE) TO (%s)""",
+            (cutoff,)
+        )
+        cur.execute("ALTER TABLE final_table_history DROP CONSTRAINT final_table_history_range")
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+    ensure_partitions(cur)
+
+
+def _create_indexes(cur) -> None:
+    ensure_partitioned_index(cur, 'final_table', 'final_table_user_time_idx',
+                             '(user_id, time DESC)')
+    _drop_if_invalid(cur, 'app_accuracy_user_time_idx')
+    cur.execute(
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS app_accuracy_user_time_idx
+           ON app_accuracy (user_id, time DESC)"""
+    )
+
+
+def _create_daily_summary(cur) -> None:
+    # Populated by daily_summary.upsert_daily_summary on insert; run
+    # ``python daily_summary.py backfill`` once for existing history
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_summary (
+            user_id TEXT NOT NULL,
+            day DATE NOT NULL,
+            outside_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+            available_hours DOUBLE PRECISION,
+            lux_sum BIGINT NOT NULL DEFAULT 0,
+            sample_count INTEGER NOT NULL DEFAULT 0,
+            last_time TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, day)
+        )
+        """
+    )
+
+
+def _create_user_location(cur) -> None:
+    # Each user's last known position, rounded to solar.LOCATION_DECIMALS;
+    # lets scheduled jobs work out sunrise/sunset without a request
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_location (
+            user_id TEXT PRIMARY KEY,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            utc_offset INTEGER NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """
+    )
+
+
+def _create_gps_thresholds(cur) -> None:
+    # Feedback sent on Wi-Fi says nothing about the GPS threshold, so it's
+    # kept apart; NULL for feedback from app versions that didn't send it
+    cur.execute("ALTER TABLE app_accuracy ADD COLUMN IF NOT EXISTS is_connected_to_wifi BOOLEAN")
+    # Written by ``python accuracy.py tune``; user_id '*' is the global one
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS gps_accuracy_thresholds (
+            user_id TEXT PRIMARY KEY,
+            threshold DOUBLE PRECISION NOT NULL,
+            samples INTEGER NOT NULL,
+            precision DOUBLE PRECISION,
+            recall DOUBLE PRECISION,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+        """
+    )
+
+
+def _unique_user_time(cur) -> None:
+    """One row per (user_id, time), so a retried ping can't be stored twice.
+
+    Duplicates already there are removed first, keeping one of each, and the
+    affected users' daily summaries rebuilt. The unique index replaces the
+    plain (user_id, time DESC) one, which it covers.
+    """
+    cur.execute(
+        """
+        DELETE FROM final_table f
+        USING (
+            SELECT tableoid, ctid,
+                   row_number() OVER (PARTITION BY user_id, time ORDER BY ctid) AS copy
+            FROM final_table
+        ) d
+        WHERE f.tableoid = d.tableoid AND f.ctid = d.ctid AND d.copy > 1
+        RETURNING f.user_id, f.time::date
+        """
+    )
+    affected: Dict[str, date] = {}
+    for user_id, day in cur.fetchall():
+        affected[user_id] = min(day, affected.get(user_id, day))
+    if affected:
+        print(f"Removed duplicate pings for {len(affected)} user(s)")
+        for user_id, since in affected.items():
+            backfill(cur, user_id, since)
+
+    ensure_partitioned_index(cur, 'final_table', 'final_table_user_time_key',
+                             '(user_id, time DESC)', unique=True)
+    cur.execute("DROP INDEX IF EXISTS final_table_user_time_idx")
+
+
+# (version, description, migration). Append only; never edit an applied one.
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "create final_table and app_accuracy", _create_tables),
+    (2, "partition final_table by month", _partition_final_table),
+    (3, "add (user_id, time DESC) indexes", _create_indexes),
+    (4, "create daily_summary", _create_daily_summary),
+    (5, "create user_location", _create_user_location),
+    (6, "add app_accuracy wifi flag and gps_accuracy_thresholds", _create_gps_thresholds),
+    (7, "make final_table (user_id, time) unique", _unique_user_time),
+]
+
+
+def migrate(conn, months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[int]:
+    """Apply pending migrations and top up partitions. Returns the versions applied.
+
+    The connection is switched to autocommit because CREATE INDEX
+    CONCURRENTLY can't run inside a transaction; every migration is written
+    to be safely re-run if it's interrupted part-way.
+    """
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                   version INTEGER PRIMARY KEY,
+                   description TEXT NOT NULL,
+                   applied_at TIMESTAMP NOT NULL DEFAULT now()
+               )"""
+        )
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cur.fetchall()}
+
+        applied = []
+        for version, description, migration in MIGRATIONS:
+            if version in done:
+                continue
+            print(f"Applying migration {version}: {description}")
+            migration(cur)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            applied.append(version)
+
+        for name in ensure_partitions(cur, months_ahead):
+            print(f"Created partition {name}")
+        return applied
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+
+
+def status(conn) -> List[Tuple[int, str, bool]]:
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_migrations')")
+    done = set()
+    if cur.fetchone()[0] is not None:
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cur.fetchall()}
+    return [(version, description, version in done) for version, description, _ in MIGRATIONS]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Solas database schema migrations")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="apply pending migrations")
+    migrate_parser.add_argument('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD,
+                                help="how many future monthly partitions to keep created")
+    subparsers.add_parser('status', help="list migrations and whether they're applied")
+    args = parser.parse_args()
+
+    from app import DB_CONFIG
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        if args.command == 'migrate':
+            applied = migrate(conn, args.months_ahead)
+            print(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+        else:
+            for version, description, applied in status(conn):
+                print(f"{version:>4}  {'applied' if applied else 'pending':<8} {description}")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
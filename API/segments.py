@@ -0,0 +1,42 @@
+"""Outdoor segments for the daily chart: merged, clipped to daylight, with angles.
+
+The daylight arc runs from 0 degrees at sunrise to 180 at sunset.
+"""
+from datetime import date, datetime, time
+from typing import Iterable, List, NamedTuple, Tuple
+
+from outdoor_time import merge_intervals
+
+
+class Segment(NamedTuple):
+    start: time
+    end: time
+    theta1: float
+    theta2: float
+
+
+def time_to_daylight_angle(t: time, today: date, sunrise_time: time, sunset_time: time) -> float:
+    if t <= sunrise_time: return 0
+    if t >= sunset_time: return 180
+    daylight_duration = (datetime.combine(today, sunset_time) -
+                         datetime.combine(today, sunrise_time)).total_seconds()
+    seconds = (datetime.combine(today, t) -
+               datetime.combine(today, sunrise_time)).total_seconds()
+    return 180 * (seconds / daylight_duration)
+
+
+def build_segments(intervals: Iterable[Tuple[time, time]], today: date,
+                   sunrise_time: time, sunset_time: time) -> List[Segment]:
+    """Coalesce touching or overlapping ``(start, end)`` intervals, clip them
+    to sunrise..sunset and work out each one's arc angles."""
+    clipped = []
+    for start, end in sorted(intervals):
+        start, end = max(start, sunrise_time), min(end, sunset_time)
+        if start < end:
+            clipped.append((start, end))
+    return [
+        Segment(start, end,
+                time_to_daylight_angle(start, today, sunrise_time, sunset_time),
+                time_to_daylight_angle(end, today, sunrise_time, sunset_time))
+        for start, end in merge_intervals(clipped)
+    ]
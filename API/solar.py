@@ -0,0 +1,127 @@
+"""Sun position, sunrise and sunset from latitude/longitude and date.
+
+Uses NOAA's low-precision solar equations (good to about a minute for
+sunrise/sunset between the polar circles). The array functions take NumPy
+arrays so historical rows can be processed in bulk; the scalar helpers used
+per request are cached by location rounded to LOCATION_DECIMALS
+(about 1 km) and date.
+"""
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Apparent sunrise/sunset: the sun's upper limb on the horizon, with refraction
+SUNRISE_ELEVATION = -0.833
+LOCATION_DECIMALS = 2
+MINUTES_PER_DAY = 1440
+
+_UNIX_EPOCH_JD = 2440587.5
+
+
+def _julian_day(moments_utc) -> np.ndarray:
+    moments = np.asarray(moments_utc, dtype='datetime64[s]')
+    return (moments - np.datetime64('1970-01-01T00:00:00')) / np.timedelta64(1, 'D') + _UNIX_EPOCH_JD
+
+
+def solar_terms(julian_day) -> Tuple[np.ndarray, np.ndarray]:
+    """Solar declination (degrees) and equation of time (minutes)."""
+    jc = (np.asarray(julian_day, dtype=float) - 2451545.0) / 36525.0
+    mean_long = np.radians((280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360)
+    mean_anom = np.radians(357.52911 + jc * (35999.05029 - 0.0001537 * jc))
+    ecc = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+
+    center = (np.sin(mean_anom) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) +
+              np.sin(2 * mean_anom) * (0.019993 - 0.000101 * jc) +
+              np.sin(3 * mean_anom) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * jc)
+    apparent_long = np.radians(np.degrees(mean_long) + center - 0.00569 - 0.00478 * np.sin(omega))
+    mean_obliquity = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+
+    declination = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(apparent_long)))
+    y = np.tan(obliquity / 2) ** 2
+    equation_of_time = 4 * np.degrees(
+        y * np.sin(2 * mean_long)
+        - 2 * ecc * np.sin(mean_anom)
+        + 4 * ecc * y * np.sin(mean_anom) * np.cos(2 * mean_long)
+        - 0.5 * y * y * np.sin(4 * mean_long)
+        - 1.25 * ecc * ecc * np.sin(2 * mean_anom))
+    return declination, equation_of_time
+
+
+def solar_elevation(latitude, longitude, moments_utc) -> np.ndarray:
+    """Sun elevation in degrees above the horizon (no refraction), elementwise."""
+    moments = np.asarray(moments_utc, dtype='datetime64[s]')
+    declination, equation_of_time = solar_terms(_julian_day(moments))
+    minutes = (moments - moments.astype('datetime64[D]')) / np.timedelta64(1, 'm')
+    true_solar_time = (minutes + equation_of_time + 4 * np.asarray(longitude, dtype=float)) % MINUTES_PER_DAY
+    hour_angle = np.radians(true_solar_time / 4 - 180)
+
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    decl = np.radians(declination)
+    cos_zenith = np.sin(lat) * np.sin(decl) + np.cos(lat) * np.cos(decl) * np.cos(hour_angle)
+    return 90 - np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+
+def sunrise_sunset_minutes(latitude, longitude, days, utc_offset_minutes=0) -> Tuple[np.ndarray, np.ndarray]:
+    """Local sunrise and sunset as minutes after midnight, elementwise.
+
+    Where the sun never sets both are 0 and MINUTES_PER_DAY; where it never
+    rises both are NaN.
+    """
+    days = np.asarray(days, dtype='datetime64[D]')
+    offset = np.asarray(utc_offset_minutes, dtype=float)
+    lon = np.asarray(longitude, dtype=float)
+    # Evaluate at local noon, which is close enough to either event
+    noon_utc = days + np.timedelta64(720, 'm') - (offset * 60).astype('timedelta64[s]')
+    declination, equation_of_time = solar_terms(_julian_day(noon_utc))
+
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    decl = np.radians(declination)
+    cos_hour_angle = (np.cos(np.radians(90 - SUNRISE_ELEVATION)) / (np.cos(lat) * np.cos(decl))
+                      - np.tan(lat) * np.tan(decl))
+    hour_angle = np.degrees(np.arccos(np.clip(cos_hour_angle, -1, 1)))
+
+    solar_noon = 720 - 4 * lon - equation_of_time + offset
+    sunrise = solar_noon - 4 * hour_angle
+    sunset = solar_noon + 4 * hour_angle
+    sunrise = np.where(cos_hour_angle < -1, 0.0, np.where(cos_hour_angle > 1, np.nan, sunrise))
+    sunset = np.where(cos_hour_angle < -1, float(MINUTES_PER_DAY),
+                      np.where(cos_hour_angle > 1, np.nan, sunset))
+    return sunrise, sunset
+
+
+def default_utc_offset(longitude: float) -> int:
+    """Rough UTC offset in minutes from longitude, for clients that don't send one."""
+    return int(round(longitude / 15)) * 60
+
+
+def _clock(minutes: float) -> time:
+    minutes = int(round(min(max(minutes, 0), MINUTES_PER_DAY - 1)))
+    return time(minutes // 60, minutes % 60)
+
+
+@lru_cache(maxsize=4096)
+def _sun_times(latitude: float, longitude: float, day: date,
+               utc_offset_minutes: int) -> Tuple[Optional[time], Optional[time]]:
+    sunrise, sunset = sunrise_sunset_minutes(latitude, longitude, np.datetime64(day, 'D'),
+                                             utc_offset_minutes)
+    if np.isnan(sunrise):
+        return None, None
+    return _clock(float(sunrise)), _clock(float(sunset))
+
+
+def sun_times(latitude: float, longitude: float, day: date,
+              utc_offset_minutes: int) -> Tuple[Optional[time], Optional[time]]:
+    """Local (sunrise, sunset) to the minute, or (None, None) in polar night."""
+    return _sun_times(round(latitude, LOCATION_DECIMALS), round(longitude, LOCATION_DECIMALS),
+                      day, int(utc_offset_minutes))
+
+
+def sun_elevation(latitude: float, longitude: float, moment: datetime,
+                  utc_offset_minutes: int) -> float:
+    """Sun elevation in degrees at local ``moment``."""
+    moment_utc = moment - timedelta(minutes=utc_offset_minutes)
+    return float(solar_elevation(latitude, longitude, np.datetime64(moment_utc, 's')))
@@ -0,0 +1,41 @@
+import zlib
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from banded_png import BandedPng, adler32_combine
+
+
+def decode(png: bytes) -> np.ndarray:
+    return np.asarray(Image.open(BytesIO(png)))
+
+
+def test_adler32_combine_matches_zlib():
+    first, second = b'daylight' * 1000, b'\x00\xff' * 70001
+    combined = adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+    assert combined == zlib.adler32(first + second)
+    assert adler32_combine(1, zlib.adler32(second), len(second)) == zlib.adler32(second)
+
+
+def test_frames_decode_to_their_own_pixels():
+    rng = np.random.default_rng(0)
+    reference = np.zeros((100, 37, 4), dtype=np.uint8)
+    reference[..., 3] = 255
+    reference[20:60, 5:30, :3] = (255, 165, 0)
+    png = BandedPng(reference, dpi=250, band_rows=16)
+
+    assert np.array_equal(decode(png.encode(reference)), reference)
+    assert (png.bands_reused, png.bands_compressed) == (7, 0)
+
+    frame = reference.copy()
+    frame[40:45] = rng.integers(0, 256, size=(5, 37, 4), dtype=np.uint8)
+    assert np.array_equal(decode(png.encode(frame)), frame)
+    # Rows 40-44 sit in one 16-row band
+    assert (png.bands_reused, png.bands_compressed) == (13, 1)
+
+
+def test_header_carries_dpi():
+    reference = np.full((4, 4, 4), 255, dtype=np.uint8)
+    image = Image.open(BytesIO(BandedPng(reference, dpi=254).encode(reference)))
+    assert round(image.info['dpi'][0]) == 254
@@ -0,0 +1,86 @@
+"""/check-location/batch ordering and duplicate handling."""
+import pytest
+
+import app
+from late_samples import MergeResult
+
+
+def sample(clock):
+    return {"gps_accuracy": 5, "device_time": f"01-06-2025 {clock}:00",
+            "sunrise": "05:00", "sunset": "21:30", "weather": "Sunny"}
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    """final_table rows written for user 'u', in write order."""
+    rows = []
+
+    def load_last_state(user_id):
+        return app.state_from_row(rows[-1]) if rows else None
+
+    def write_late_samples(user_id, samples):
+        # Merging into earlier rows is covered by test_late_samples; these
+        # tests only send pings that are new or already stored
+        times = {row[1] for row in rows}
+        assert all(sample['time'] in times for sample in samples)
+        merged = MergeResult()
+        merged.duplicates = len(samples)
+        return merged
+
+    monkeypatch.setattr(app, 'load_last_state', load_last_state)
+    monkeypatch.setattr(app, 'write_final_rows', lambda user_id, new: rows.extend(new))
+    monkeypatch.setattr(app, 'write_late_samples', write_late_samples)
+    return rows
+
+
+def post_batch(samples):
+    response = app.app.test_client().post('/check-location/batch',
+                                          json={"user_id": "u", "samples": samples})
+    assert response.status_code == 200
+    return response.json
+
+
+def test_samples_are_stored_oldest_first_and_answered_in_request_order(stored):
+    body = post_batch([sample("12:10"), sample("12:00"), sample("12:05")])
+
+    assert [row[1].strftime('%H:%M') for row in stored] == ['12:00', '12:05', '12:10']
+    assert body["received"] == 3 and body["written"] == 3
+    totals = [result["total_time_outside_for_given_day"] for result in body["results"]]
+    # Request order was 12:10, 12:00, 12:05; the running total follows time order
+    assert totals == [600, 0, 300]
+
+
+def test_repeated_sample_in_a_batch_is_stored_once(stored):
+    body = post_batch([sample("12:00"), sample("12:05"), sample("12:05")])
+
+    assert len(stored) == 2
+    assert body["written"] == 2
+    assert [result["duplicate"] for result in body["results"]] == [False, False, True]
+    assert body["results"][2]["database_updated"] is False
+
+
+def test_retried_batch_is_all_duplicates(stored):
+    samples = [sample("12:00"), sample("12:05")]
+    post_batch(samples)
+    body = post_batch(samples)
+
+    assert len(stored) == 2
+    assert body["written"] == 0
+    assert all(result["duplicate"] for result in body["results"])
+
+
+def test_invalid_sample_is_answered_in_place(stored):
+    body = post_batch([sample("12:00"), {"gps_accuracy": 5}, "not a sample", sample("12:05")])
+
+    assert len(stored) == 2
+    results = body["results"]
+    assert "device_time" in results[1]["error"]
+    assert results[2] == {"error": "sample must be an object"}
+    assert results[3]["database_updated"] is True
+
+
+def test_oversized_batch_is_rejected(stored):
+    response = app.app.test_client().post('/check-location/batch', json={
+        "user_id": "u", "samples": [sample("12:00")] * (app.MAX_BATCH_SAMPLES + 1)})
+    assert response.status_code == 400
+    assert stored == []
@@ -0,0 +1,69 @@
+"""Cache-Control and 304s on /weekly-time-outside-graph."""
+from datetime import date, timedelta
+
+import pytest
+
+import app
+
+
+class FakeCursor:
+    def __init__(self, summaries):
+        self.summaries = summaries
+        self._result = []
+
+    def execute(self, sql, params=()):
+        _, start, end = params
+        self._result = [(day, outside, 12.0, 0, 1) for day, outside in self.summaries.items()
+                        if start <= day <= end]
+
+    def fetchall(self):
+        return self._result
+
+    def close(self):
+        pass
+
+
+class FakeConn:
+    closed = 0
+
+    def __init__(self, summaries):
+        self.summaries = summaries
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self.summaries)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_transaction_status(self):
+        return 0
+
+
+@pytest.fixture
+def client(monkeypatch):
+    today = date.today()
+    summaries = {today - timedelta(days=days): 600.0 * days for days in range(40)}
+    monkeypatch.setattr(app.db_pool, '_connect', lambda: FakeConn(summaries))
+    return app.app.test_client()
+
+
+def weekly(client, day, **headers):
+    return client.get('/weekly-time-outside-graph', headers=headers, query_string={
+        'user_id': 'u', 'device_time': day.strftime('%d-%m-%Y 12:00:00'), 'mode': 'data'})
+
+
+def test_current_range_is_revalidated(client):
+    response = weekly(client, date.today())
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == app.CHART_CACHE_CONTROL
+    assert weekly(client, date.today(), **{'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_settled_past_range_is_immutable(client):
+    settled = date.today() - timedelta(days=app.CHART_IMMUTABLE_AFTER_DAYS)
+    assert weekly(client, settled).headers['Cache-Control'] == app.CHART_IMMUTABLE_CACHE_CONTROL
+    recent = settled + timedelta(days=1)
+    assert weekly(client, recent).headers['Cache-Control'] == app.CHART_CACHE_CONTROL
@@ -0,0 +1,168 @@
+"""ConnectionPool checkout, health checks and idle reaping."""
+import threading
+
+import pytest
+
+import db
+from db import ConnectionPool, PoolTimeout
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        self.conn.pings += 1
+        if self.conn.broken:
+            raise Exception("server closed the connection unexpectedly")
+
+
+class FakeConn:
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = 0
+        self.broken = False
+        self.pings = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return 0
+
+    def close(self):
+        # Closing a socket can block, so it must happen off the pool's lock
+        assert self.pool._cond.acquire(blocking=False), "closed under the pool lock"
+        self.pool._cond.release()
+        self.closed = 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(db, 'time', clock)
+    return clock
+
+
+def make_pool(**kwargs):
+    pool = ConnectionPool({}, **kwargs)
+    pool._connect = lambda: FakeConn(pool)
+    return pool
+
+
+def test_connections_are_reused_last_in_first_out(clock):
+    pool = make_pool(max_size=3)
+    first, second = pool.getconn(), pool.getconn()
+    pool.putconn(first)
+    pool.putconn(second)
+    assert pool.getconn() is second
+    assert pool.getconn() is first
+    assert pool.stats()['connections_created'] == 2
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted():
+    pool = make_pool(max_size=1, timeout=0.01)
+    held = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()['timeouts'] == 1
+    pool.putconn(held)
+    assert pool.getconn() is held
+
+
+def test_waiting_checkout_gets_a_returned_connection():
+    pool = make_pool(max_size=1, timeout=5)
+    held = pool.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn()))
+    waiter.start()
+    pool.putconn(held)
+    waiter.join(5)
+    assert got == [held]
+
+
+def test_unhealthy_idle_connection_is_replaced(clock):
+    pool = make_pool(max_size=2, health_check_after=30)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    clock.now += 31
+    conn.broken = True
+    replacement = pool.getconn()
+    assert replacement is not conn
+    assert conn.pings == 1 and conn.closed
+    stats = pool.stats()
+    assert stats['failed_health_checks'] == 1
+    assert stats['connections_discarded'] == 1
+    assert stats['in_use'] == 1
+
+
+def test_recently_used_connection_is_not_pinged(clock):
+    pool = make_pool(health_check_after=30)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    clock.now += 5
+    assert pool.getconn() is conn
+    assert conn.pings == 0
+
+
+def test_idle_connections_are_reaped_on_return(clock):
+    pool = make_pool(min_size=1, max_size=3, max_idle=300)
+    conns = [pool.getconn() for _ in range(3)]
+    for conn in conns[:2]:
+        pool.putconn(conn)
+    clock.now += 301
+    # Returning the last one reaps the two that sat idle too long
+    pool.putconn(conns[2])
+    stats = pool.stats()
+    assert stats['idle'] == 1
+    assert stats['connections_discarded'] == 2
+    assert conns[0].closed and conns[1].closed and not conns[2].closed
+
+
+def test_reaping_keeps_min_size_open(clock):
+    pool = make_pool(min_size=2, max_size=3, max_idle=300)
+    conns = [pool.getconn() for _ in range(3)]
+    for conn in conns[:2]:
+        pool.putconn(conn)
+    clock.now += 301
+    pool.putconn(conns[2])
+    # The oldest goes first; one stale connection stays to make up min_size
+    assert pool.stats()['idle'] == 2
+    assert conns[0].closed and not conns[1].closed
+
+
+def test_connection_past_its_lifetime_is_closed_on_return(clock):
+    pool = make_pool(max_lifetime=3600)
+    conn = pool.getconn()
+    clock.now += 3601
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.stats()['size'] == 0
+
+
+def test_closeall_closes_idle_connections(clock):
+    pool = make_pool(max_size=2)
+    conns = [pool.getconn(), pool.getconn()]
+    for conn in conns:
+        pool.putconn(conn)
+    pool.closeall()
+    assert all(conn.closed for conn in conns)
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
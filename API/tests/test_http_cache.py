@@ -0,0 +1,27 @@
+"""Chart ETags and If-None-Match handling."""
+import pytest
+
+from http_cache import chart_etag, etag_matches
+
+
+def test_etag_is_weak_and_depends_on_every_part():
+    etag = chart_etag(1, ('u', 'daily'), {'minutes': [1, 2]})
+    assert etag.startswith('W/"') and etag.endswith('"')
+    assert etag == chart_etag(1, ('u', 'daily'), {'minutes': [1, 2]})
+    assert etag != chart_etag(1, ('u', 'daily'), {'minutes': [1, 3]})
+    assert etag != chart_etag(2, ('u', 'daily'), {'minutes': [1, 2]})
+
+
+@pytest.mark.parametrize('header', [
+    'W/"abc"',
+    '"abc"',
+    '"other", W/"abc"',
+    '*',
+])
+def test_matching_if_none_match(header):
+    assert etag_matches(header, 'W/"abc"')
+
+
+@pytest.mark.parametrize('header', [None, '', '"other"', 'W/"abcd"'])
+def test_non_matching_if_none_match(header):
+    assert not etag_matches(header, 'W/"abc"')
@@ -0,0 +1,87 @@
+"""IngestBuffer's handling of batches that fail to flush."""
+import json
+import os
+from datetime import datetime
+
+import psycopg2
+import pytest
+
+import ingest_buffer
+from ingest_buffer import DEAD_LETTER_FILE, IngestBuffer
+
+
+def make_row(user_id, minute):
+    return (user_id, datetime(2025, 6, 1, 10, minute), True, 0, 0, 0, 0, 'Clear', 20.0, 3.0, 5.0, 0.0)
+
+
+class FakeConn:
+    def cursor(self):
+        return None
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def buffer(tmp_path):
+    # Nothing is flushed until a test asks, so its rows make up one batch
+    buf = IngestBuffer(FakeConn, lambda conn: None, str(tmp_path), max_batch=100,
+                       max_delay=60, fsync=False, retry_delay=0, max_retries=2)
+    yield buf
+    buf.close(timeout=5)
+
+
+def test_bad_row_is_dead_lettered_and_the_rest_flushed(monkeypatch, tmp_path, buffer):
+    rows, attempts = [], []
+
+    def insert_final_rows(cur, batch, page_size=500):
+        attempts.append(len(batch))
+        if any(row[0] == 'bad' for row in batch):
+            raise psycopg2.DataError("value out of range")
+        rows.extend(batch)
+        return batch
+
+    monkeypatch.setattr(ingest_buffer, 'insert_final_rows', insert_final_rows)
+    monkeypatch.setattr(ingest_buffer, 'upsert_daily_summary', lambda cur, written: None)
+
+    queued = [make_row('a', minute) for minute in range(5)]
+    queued.insert(3, make_row('bad', 30))
+    for row in queued:
+        buffer.append(row)
+    assert buffer.wait_until_flushed(5)
+
+    assert rows == [row for row in queued if row[0] != 'bad']
+    # The whole batch is tried max_retries + 1 times before it is split
+    assert attempts[:3] == [6, 6, 6]
+    with open(os.path.join(str(tmp_path), DEAD_LETTER_FILE), encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert [record['row'][:2] for record in records] == [['bad', '2025-06-01T10:30:00']]
+    assert records[0]['error'] == "value out of range"
+    stats = buffer.stats()
+    assert stats['dead_lettered_rows'] == 1
+    assert stats['pending_rows'] == 0
+    assert buffer.latest_for_user('bad') is None
+
+
+def test_connection_errors_are_retried_without_dead_lettering(monkeypatch, tmp_path, buffer):
+    rows = []
+    failures = iter([psycopg2.OperationalError("server closed the connection")] * 5)
+
+    def insert_final_rows(cur, batch, page_size=500):
+        error = next(failures, None)
+        if error is not None:
+            raise error
+        rows.extend(batch)
+        return batch
+
+    monkeypatch.setattr(ingest_buffer, 'insert_final_rows', insert_final_rows)
+    monkeypatch.setattr(ingest_buffer, 'upsert_daily_summary', lambda cur, written: None)
+
+    queued = [make_row('a', minute) for minute in range(3)]
+    for row in queued:
+        buffer.append(row)
+    assert buffer.wait_until_flushed(5)
+
+    assert rows == queued
+    assert not os.path.exists(os.path.join(str(tmp_path), DEAD_LETTER_FILE))
+    assert buffer.stats()['flush_failures'] == 5
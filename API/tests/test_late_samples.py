@@ -0,0 +1,197 @@
+"""merge_late_samples against an in-memory final_table and daily_summary."""
+from datetime import datetime
+
+import pytest
+
+import app
+import daily_summary
+import late_samples
+from late_samples import merge_late_samples
+
+USER = 'u'
+
+
+class FakeCursor:
+    """Answers the statements late_samples and daily_summary run."""
+
+    def __init__(self):
+        self.final_table = {}  # time -> row (list, FINAL_TABLE_COLUMNS order)
+        self.daily_summary = {}  # day -> dict of SUMMARY_COLUMNS
+        self._result = []
+
+    def execute(self, sql, params):
+        self._result = []
+        if sql is late_samples.PREVIOUS_ROW_SQL:
+            before = [t for t in self.final_table if t < params[1]]
+            if before:
+                self._result = [tuple(self.final_table[max(before)][1:6])]
+        elif sql is late_samples.DAY_TAIL_SQL:
+            self._result = [tuple(self.final_table[t][1:6]) for t in sorted(self.final_table)
+                            if params[1] <= t < params[2]]
+        elif sql is late_samples.SHIFT_TOTALS_SQL:
+            shift, _, since = params
+            for moment, row in self.final_table.items():
+                if moment >= since:
+                    row[4] += shift
+        elif sql is late_samples.SET_DAY_OUTSIDE_SQL:
+            outside, _, day = params
+            if day in self.daily_summary:
+                self.daily_summary[day]['outside_seconds'] = outside
+        else:
+            raise AssertionError(f"unexpected statement: {sql}")
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+    def execute_values(self, sql, rows, page_size=100, fetch=False):
+        if sql.lstrip().startswith('INSERT INTO final_table'):
+            inserted = []
+            for row in rows:
+                if row[1] not in self.final_table:
+                    self.final_table[row[1]] = list(row)
+                    inserted.append((row[0], row[1]))
+            return inserted
+        if sql is late_samples.UPDATE_TOTALS_SQL:
+            for _, moment, *totals in rows:
+                self.final_table[moment][3:6] = totals
+            return None
+        if sql.lstrip().startswith('INSERT INTO daily_summary'):
+            for summary in rows:
+                values = dict(zip(daily_summary.SUMMARY_COLUMNS, summary))
+                stored = self.daily_summary.get(values['day'])
+                if stored is None:
+                    self.daily_summary[values['day']] = values
+                    continue
+                if values['last_time'] >= stored['last_time']:
+                    stored['outside_seconds'] = values['outside_seconds']
+                    stored['available_hours'] = values['available_hours']
+                stored['lux_sum'] += values['lux_sum']
+                stored['sample_count'] += values['sample_count']
+                stored['last_time'] = max(stored['last_time'], values['last_time'])
+            return None
+        raise AssertionError(f"unexpected statement: {sql}")
+
+    def totals(self, moment):
+        return tuple(self.final_table[moment][3:6])
+
+
+@pytest.fixture
+def cur(monkeypatch):
+    cur = FakeCursor()
+    execute_values = lambda cur, sql, rows, **kwargs: cur.execute_values(sql, rows, **kwargs)
+    monkeypatch.setattr(late_samples, 'execute_values', execute_values)
+    monkeypatch.setattr(daily_summary, 'execute_values', execute_values)
+    monkeypatch.setattr('ingest_buffer.execute_values', execute_values)
+    return cur
+
+
+def sample(moment, outside=True):
+    return {"time": moment, "is_outside": outside, "sunrise": "05:00", "sunset": "21:00",
+            "weather": "Sunny", "temperature": None, "uv": None, "gps_accuracy": 5.0,
+            "lux": 1000}
+
+
+def build(sample, previous):
+    return app.build_final_row(USER, sample, previous)
+
+
+def store(cur, *moments):
+    """Append pings in order, as /check-location does."""
+    previous = None
+    if cur.final_table:
+        previous = app.state_from_row(cur.final_table[max(cur.final_table)])
+    rows = []
+    for moment in moments:
+        row = build(sample(moment), previous)
+        previous = app.state_from_row(row)
+        rows.append(row)
+    cur.execute_values('INSERT INTO final_table', rows)
+    daily_summary.upsert_daily_summary(cur, rows)
+
+
+def merge(cur, *moments):
+    return merge_late_samples(cur, USER, [sample(m) for m in moments], build,
+                              app.advance_running_totals)
+
+
+def test_out_of_order_ping_rewrites_the_rest_of_its_day(cur):
+    store(cur, datetime(2025, 6, 1, 10, 0), datetime(2025, 6, 1, 10, 20),
+          datetime(2025, 6, 1, 10, 25), datetime(2025, 6, 2, 9, 0))
+    # A 20-minute gap only counts for MAX_TIME_BETWEEN_UPDATES
+    assert cur.totals(datetime(2025, 6, 1, 10, 20)) == (600, 600, 600)
+    assert cur.totals(datetime(2025, 6, 2, 9, 0)) == (0, 900, 0)
+
+    result = merge(cur, datetime(2025, 6, 1, 10, 10))
+
+    assert list(result.rows) == [datetime(2025, 6, 1, 10, 10)]
+    assert result.rows_rewritten == 2
+    assert result.duplicates == 0
+    assert result.days == [datetime(2025, 6, 1).date()]
+    assert cur.totals(datetime(2025, 6, 1, 10, 0)) == (0, 0, 0)
+    assert cur.totals(datetime(2025, 6, 1, 10, 10)) == (600, 600, 600)
+    assert cur.totals(datetime(2025, 6, 1, 10, 20)) == (600, 1200, 1200)
+    assert cur.totals(datetime(2025, 6, 1, 10, 25)) == (300, 1500, 1500)
+    # Later days keep their own day totals; the running total carries the
+    # 600 s the merged day gained
+    assert cur.totals(datetime(2025, 6, 2, 9, 0)) == (0, 1500, 0)
+
+    day = cur.daily_summary[datetime(2025, 6, 1).date()]
+    assert day['outside_seconds'] == 1500
+    assert day['sample_count'] == 4
+    assert day['lux_sum'] == 4000
+    assert day['last_time'] == datetime(2025, 6, 1, 10, 25)
+
+
+def test_duplicate_ping_is_skipped(cur):
+    store(cur, datetime(2025, 6, 1, 10, 0), datetime(2025, 6, 1, 10, 10))
+    before = dict(cur.daily_summary[datetime(2025, 6, 1).date()])
+
+    result = merge(cur, datetime(2025, 6, 1, 10, 0))
+
+    assert result.duplicates == 1
+    assert result.rows == {}
+    assert result.rows_rewritten == 0
+    assert result.days == []
+    assert cur.totals(datetime(2025, 6, 1, 10, 0)) == (0, 0, 0)
+    assert cur.totals(datetime(2025, 6, 1, 10, 10)) == (600, 600, 600)
+    assert cur.daily_summary[datetime(2025, 6, 1).date()] == before
+
+    # Alongside a fresh late ping, only the fresh one is merged
+    result = merge(cur, datetime(2025, 6, 1, 10, 0), datetime(2025, 6, 1, 10, 5))
+
+    assert result.duplicates == 1
+    assert list(result.rows) == [datetime(2025, 6, 1, 10, 5)]
+    assert len(cur.final_table) == 3
+    assert cur.totals(datetime(2025, 6, 1, 10, 10)) == (300, 600, 600)
+    day = cur.daily_summary[datetime(2025, 6, 1).date()]
+    assert day['outside_seconds'] == 600
+    assert day['sample_count'] == 3
+
+
+def test_pings_either_side_of_midnight(cur):
+    store(cur, datetime(2025, 6, 1, 23, 45), datetime(2025, 6, 1, 23, 50),
+          datetime(2025, 6, 2, 0, 5), datetime(2025, 6, 2, 0, 10))
+    assert cur.totals(datetime(2025, 6, 2, 0, 5)) == (0, 300, 0)
+
+    result = merge(cur, datetime(2025, 6, 2, 0, 0), datetime(2025, 6, 1, 23, 55))
+
+    assert sorted(result.rows) == [datetime(2025, 6, 1, 23, 55), datetime(2025, 6, 2, 0, 0)]
+    assert result.days == [datetime(2025, 6, 1).date(), datetime(2025, 6, 2).date()]
+    assert result.rows_rewritten == 2
+    assert cur.totals(datetime(2025, 6, 1, 23, 55)) == (300, 600, 600)
+    # The day's first ping starts it from zero, the ones after it count again
+    assert cur.totals(datetime(2025, 6, 2, 0, 0)) == (0, 600, 0)
+    assert cur.totals(datetime(2025, 6, 2, 0, 5)) == (300, 900, 300)
+    assert cur.totals(datetime(2025, 6, 2, 0, 10)) == (300, 1200, 600)
+
+    first = cur.daily_summary[datetime(2025, 6, 1).date()]
+    assert first['outside_seconds'] == 600
+    assert first['sample_count'] == 3
+    assert first['last_time'] == datetime(2025, 6, 1, 23, 55)
+    second = cur.daily_summary[datetime(2025, 6, 2).date()]
+    assert second['outside_seconds'] == 600
+    assert second['sample_count'] == 3
+    assert second['last_time'] == datetime(2025, 6, 2, 0, 10)
@@ -0,0 +1,45 @@
+"""Lux estimates from weather conditions and sun elevation."""
+import numpy as np
+
+from lux import (
+    LEGACY_UNKNOWN_LUX, condition_transmission, estimate_lux, estimate_lux_array, legacy_lux,
+)
+
+
+def test_legacy_lux_matches_weather_keywords():
+    assert legacy_lux('Sunny') == 100000
+    assert legacy_lux(None) == LEGACY_UNKNOWN_LUX
+    assert legacy_lux('Something new') == LEGACY_UNKNOWN_LUX
+
+
+def test_without_elevation_the_legacy_table_is_used():
+    assert estimate_lux('Sunny') == legacy_lux('Sunny')
+
+
+def test_cloud_and_night_reduce_lux():
+    clear = estimate_lux('Sunny', 60)
+    assert 60000 < clear < 120000
+    assert estimate_lux('Overcast', 60) < clear
+    assert estimate_lux('Sunny', 10) < clear
+    # Below civil twilight it's dark whatever the weather
+    assert estimate_lux('Sunny', -10) == 0
+
+
+def test_low_uv_reading_lowers_a_clear_sky_estimate():
+    assert estimate_lux('Sunny', 60, uv=2) < estimate_lux('Sunny', 60)
+    assert estimate_lux('Sunny', 60, uv=None) == estimate_lux('Sunny', 60)
+
+
+def test_condition_keywords_fall_back_to_unknown():
+    assert condition_transmission('sunny') == condition_transmission('Sunny')
+    assert condition_transmission(None) == condition_transmission('unknown')
+
+
+def test_array_estimate_matches_the_scalar_one():
+    conditions = ['Sunny', 'Overcast', None, 'Sunny']
+    elevation = [60.0, 60.0, 30.0, -10.0]
+    uv = [np.nan, 2.0, np.nan, 0.0]
+    expected = [estimate_lux(c, e, None if np.isnan(u) else u)
+                for c, e, u in zip(conditions, elevation, uv)]
+    assert estimate_lux_array(conditions, elevation, uv).tolist() == expected
+    assert estimate_lux_array(conditions).tolist() == [legacy_lux(c) for c in conditions]
@@ -0,0 +1,64 @@
+"""Outdoor interval building and the daily chart's segments."""
+from datetime import date, datetime, time
+
+import pytest
+
+from outdoor_time import merge_intervals, outdoor_intervals, total_seconds
+from segments import Segment, build_segments
+
+DAY = date(2025, 6, 1)
+
+
+def at(hour, minute=0):
+    return datetime(2025, 6, 1, hour, minute)
+
+
+def test_merge_intervals_coalesces_touching_and_overlapping():
+    merged = merge_intervals([(at(9), at(10)), (at(10), at(10, 30)), (at(10, 15), at(10, 20)),
+                              (at(11), at(12))])
+    assert merged == [(at(9), at(10, 30)), (at(11), at(12))]
+
+
+def test_interval_runs_from_an_outdoor_ping_to_the_next():
+    pings = [(at(9), True), (at(9, 5), True), (at(9, 10), False), (at(9, 15), False)]
+    assert outdoor_intervals(pings) == [(at(9), at(9, 10))]
+
+
+def test_long_gap_after_an_outdoor_ping_is_capped():
+    pings = [(at(9), True), (at(11), False)]
+    assert outdoor_intervals(pings, max_gap=600) == [(at(10, 50), at(11))]
+
+
+def test_open_streak_counts_up_to_until():
+    pings = [(at(9), False), (at(9, 5), True)]
+    assert outdoor_intervals(pings) == []
+    assert outdoor_intervals(pings, until=at(9, 8)) == [(at(9, 5), at(9, 8))]
+    assert outdoor_intervals(pings, max_gap=600, until=at(12)) == [(at(9, 5), at(9, 15))]
+
+
+def test_intervals_do_not_cross_midnight():
+    pings = [(datetime(2025, 6, 1, 23, 58), True), (datetime(2025, 6, 2, 0, 3), True)]
+    assert outdoor_intervals(pings) == []
+
+
+def test_total_seconds():
+    assert total_seconds([(at(9), at(9, 10)), (at(12), at(12, 1))]) == 660
+
+
+def test_segments_are_clipped_to_daylight_with_angles():
+    sunrise, sunset = time(6), time(18)
+    segments = build_segments([(time(5), time(7)), (time(12), time(13)), (time(17), time(19))],
+                              DAY, sunrise, sunset)
+    assert segments == [
+        Segment(time(6), time(7), 0, 15),
+        Segment(time(12), time(13), 90, 105),
+        Segment(time(17), time(18), 165, 180),
+    ]
+
+
+def test_segments_are_merged_and_night_only_ones_dropped():
+    segments = build_segments([(time(10), time(11)), (time(2), time(3)), (time(10, 30), time(12))],
+                              DAY, time(6), time(18))
+    assert [(s.start, s.end) for s in segments] == [(time(10), time(12))]
+    assert segments[0].theta1 == pytest.approx(60)
+    assert segments[0].theta2 == pytest.approx(90)
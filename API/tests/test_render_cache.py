@@ -0,0 +1,68 @@
+"""RenderCache LRU eviction and invalidation."""
+from datetime import date, datetime
+
+from render_cache import RenderCache, time_bucket
+
+DAY = date(2025, 6, 1)
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = RenderCache(max_entries=2)
+    cache.put(('a', DAY, 1), b'one')
+    cache.put(('a', DAY, 2), b'two')
+    assert cache.get(('a', DAY, 1)) == b'one'
+    cache.put(('a', DAY, 3), b'three')
+    assert cache.get(('a', DAY, 2)) is None
+    assert cache.get(('a', DAY, 1)) == b'one'
+    assert cache.get(('a', DAY, 3)) == b'three'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_byte_limit_evicts_until_it_fits():
+    cache = RenderCache(max_entries=10, max_bytes=10)
+    cache.put(('a', DAY, 1), b'1234')
+    cache.put(('a', DAY, 2), b'5678')
+    cache.put(('a', DAY, 3), b'abcdef')
+    assert not cache.contains(('a', DAY, 1))
+    assert cache.contains(('a', DAY, 2)) and cache.contains(('a', DAY, 3))
+    assert cache.stats()['bytes'] == 10
+
+
+def test_entry_larger_than_the_cache_is_not_stored():
+    cache = RenderCache(max_bytes=4)
+    cache.put(('a', DAY, 1), b'12345')
+    assert cache.stats()['entries'] == 0
+
+
+def test_replacing_a_key_updates_its_size():
+    cache = RenderCache()
+    cache.put(('a', DAY, 1), b'1234')
+    cache.put(('a', DAY, 1), b'12')
+    stats = cache.stats()
+    assert stats['entries'] == 1 and stats['bytes'] == 2
+
+
+def test_contains_does_not_refresh_recency():
+    cache = RenderCache(max_entries=2)
+    cache.put(('a', DAY, 1), b'one')
+    cache.put(('a', DAY, 2), b'two')
+    assert cache.contains(('a', DAY, 1))
+    cache.put(('a', DAY, 3), b'three')
+    assert not cache.contains(('a', DAY, 1))
+    assert cache.stats()['hits'] == 0
+
+
+def test_invalidate_drops_only_that_users_day():
+    cache = RenderCache()
+    cache.put(('a', DAY, 'daily'), b'1')
+    cache.put(('a', DAY, 'weekly'), b'2')
+    cache.put(('a', date(2025, 6, 2), 'daily'), b'3')
+    cache.put(('b', DAY, 'daily'), b'4')
+    assert cache.invalidate('a', DAY) == 2
+    assert cache.stats()['entries'] == 2
+    assert cache.contains(('b', DAY, 'daily'))
+
+
+def test_time_bucket_rounds_down():
+    assert time_bucket(datetime(2025, 6, 1, 12, 7, 59), 300) == datetime(2025, 6, 1, 12, 5)
+    assert time_bucket(datetime(2025, 6, 1, 12, 5), 300) == datetime(2025, 6, 1, 12, 5)
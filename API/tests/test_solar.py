@@ -0,0 +1,50 @@
+"""Sunrise, sunset and sun elevation."""
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+from solar import default_utc_offset, sun_elevation, sun_times
+
+LONDON = (51.5074, -0.1278)
+LONGYEARBYEN = (78.22, 15.65)
+MIDSUMMER = date(2025, 6, 21)
+
+
+def minutes_apart(first: time, second: time) -> float:
+    day = date(2000, 1, 1)
+    return abs((datetime.combine(day, first) - datetime.combine(day, second)).total_seconds()) / 60
+
+
+def test_london_on_midsummer_day():
+    # Published times for 21 June 2025 are 04:43 and 21:21 BST
+    sunrise, sunset = sun_times(*LONDON, MIDSUMMER, 60)
+    assert minutes_apart(sunrise, time(4, 43)) <= 2
+    assert minutes_apart(sunset, time(21, 21)) <= 2
+
+
+def test_utc_offset_shifts_the_clock_times():
+    bst = sun_times(*LONDON, MIDSUMMER, 60)
+    utc = sun_times(*LONDON, MIDSUMMER, 0)
+    for local, universal in zip(bst, utc):
+        assert (datetime.combine(MIDSUMMER, local) - datetime.combine(MIDSUMMER, universal)
+                == timedelta(hours=1))
+
+
+def test_polar_day_spans_the_whole_clock():
+    assert sun_times(*LONGYEARBYEN, MIDSUMMER, 120) == (time(0, 0), time(23, 59))
+
+
+def test_polar_night_has_no_sun_times():
+    assert sun_times(*LONGYEARBYEN, date(2025, 12, 21), 60) == (None, None)
+
+
+def test_sun_elevation_at_london_noon_and_midnight():
+    # At solar noon the sun is 90 - latitude + declination (23.44) degrees up
+    assert sun_elevation(*LONDON, datetime(2025, 6, 21, 13, 2), 60) == pytest.approx(61.9, abs=0.3)
+    assert sun_elevation(*LONDON, datetime(2025, 6, 21, 1, 0), 60) < 0
+
+
+def test_default_utc_offset_from_longitude():
+    assert default_utc_offset(-0.1278) == 0
+    assert default_utc_offset(139.69) == 540
+    assert default_utc_offset(-74.0) == -300
@@ -0,0 +1,88 @@
+"""WeatherCache hits, request coalescing and failure handling."""
+import threading
+import time
+
+from weather import Conditions, WeatherCache
+
+DUBLIN = (53.3498, -6.2603)
+
+
+class BlockingProvider:
+    """Answers once ``release`` is set, counting calls."""
+
+    def __init__(self):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def current(self, latitude, longitude):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return Conditions('Sunny', 18.0, 5.0)
+
+
+class FailingProvider:
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    def current(self, latitude, longitude):
+        self.calls += 1
+        if self.fail:
+            raise OSError("provider unreachable")
+        return Conditions('Cloudy', 12.0, 2.0)
+
+
+def test_concurrent_misses_share_one_provider_call():
+    provider = BlockingProvider()
+    cache = WeatherCache(provider)
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get(*DUBLIN)))
+    first.start()
+    assert provider.started.wait(5)
+    # Same geohash cell, a few hundred metres away
+    others = [threading.Thread(target=lambda: results.append(cache.get(53.351, -6.262)))
+              for _ in range(4)]
+    for thread in others:
+        thread.start()
+    while cache.stats()['coalesced'] < len(others):
+        time.sleep(0.01)
+    provider.release.set()
+    for thread in [first] + others:
+        thread.join(5)
+
+    assert provider.calls == 1
+    assert results == [Conditions('Sunny', 18.0, 5.0)] * 5
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced'], stats['provider_calls']) == (1, 4, 1)
+
+
+def test_fresh_entry_is_a_hit():
+    provider = FailingProvider()
+    cache = WeatherCache(provider)
+    cache.get(*DUBLIN)
+    assert cache.cached(*DUBLIN) == (True, Conditions('Cloudy', 12.0, 2.0))
+    cache.get(*DUBLIN)
+    assert provider.calls == 1
+    assert cache.stats()['hits'] == 2
+
+
+def test_failure_serves_the_last_good_answer():
+    provider = FailingProvider()
+    cache = WeatherCache(provider, ttl=0, error_ttl=60)
+    good = cache.get(*DUBLIN)
+    provider.fail = True
+    assert cache.get(*DUBLIN) == good
+    # The failure is remembered, so the provider isn't asked again for a while
+    assert cache.get(*DUBLIN) == good
+    assert provider.calls == 2
+    stats = cache.stats()
+    assert stats['errors'] == 1 and stats['stale_served'] == 2
+
+
+def test_failure_without_a_previous_answer_gives_none():
+    provider = FailingProvider()
+    provider.fail = True
+    cache = WeatherCache(provider)
+    assert cache.get(*DUBLIN) is None
@@ -0,0 +1,254 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+
+try:
+    import redis
+except ImportError:  # only needed for the shared store
+    redis = None
+
+
+class LastState(NamedTuple):
+    """The running totals carried by a user's most recent final_table row."""
+    time: datetime
+    outside: bool
+    time_outside: float
+    total_time_outside: float
+    total_time_outside_for_given_day: float
+
+
+LATEST_STATE_SQL = """
+    SELECT time, "outside?",
+           time_outside, total_time_outside, total_time_outside_for_given_day
+    FROM final_table
+    WHERE user_id = %s
+    ORDER BY time DESC
+    LIMIT 1
+"""
+
+# Held until the transaction ends; keeps a late merge, which reads and
+# rewrites a whole day, clear of anything else writing for the user
+USER_XACT_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+
+
+class LocalStateStore:
+    """Per-process LRU map of user_id -> LastState.
+
+    Its states and user locks only cover this process, so only one process
+    may serve pings with it; RedisStateStore is for running several. Given
+    an ``owner_lock`` path, the first get or set takes an exclusive flock on
+    it and raises RuntimeError if another process already holds it.
+    """
+
+    shared = False
+
+    def __init__(self, max_users: int = 100000, lock_stripes: int = 64,
+                 owner_lock: Optional[str] = None):
+        self.max_users = max_users
+        self.owner_lock = owner_lock
+        self._owner_fd: Optional[int] = None
+        self._states: "OrderedDict[str, LastState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._hits = 0
+        self._misses = 0
+
+    def _claim(self) -> None:
+        # Taken on first use rather than at import, so scripts that import
+        # app alongside a running server aren't turned away
+        with self._lock:
+            if self._owner_fd is not None:
+                return
+            fd = os.open(self.owner_lock, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                raise RuntimeError("Another process is serving pings with a per-process state "
+                                   "store; set USER_STATE_REDIS_URL to run several workers")
+            self._owner_fd = fd
+
+    def user_lock(self, user_id: str) -> threading.Lock:
+        """Lock serialising read-compute-insert for one user within this process."""
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+    def get(self, user_id: str) -> Optional[LastState]:
+        if self.owner_lock and self._owner_fd is None:
+            self._claim()
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None:
+                self._misses += 1
+                return None
+            self._states.move_to_end(user_id)
+            self._hits += 1
+            return state
+
+    def set(self, user_id: str, state: LastState) -> None:
+        """Store ``state`` unless a newer one is already cached."""
+        if self.owner_lock and self._owner_fd is None:
+            self._claim()
+        with self._lock:
+            current = self._states.get(user_id)
+            if current is not None and current.time > state.time:
+                return
+            self._states[user_id] = state
+            self._states.move_to_end(user_id)
+            while len(self._states) > self.max_users:
+                self._states.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._states.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "local",
+                "users": len(self._states),
+                "max_users": self.max_users,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+
+# Only overwrite the stored state if the new row is at least as recent, so
+# workers racing on the same user can't roll the totals back
+_SET_IF_NEWER = """
+local current = redis.call('HGET', KEYS[1], 'time')
+if current and current > ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'time', ARGV[1], 'state', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+# Delete the lock only if we still hold it, not whoever took it after it expired
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisUserLock:
+    """One user's lock, shared by every worker: SET NX PX with a random token.
+
+    Threads of this process first queue on a local stripe lock, so only one
+    of them at a time polls Redis. The lock expires after ``ttl`` seconds in
+    case its holder dies.
+    """
+
+    def __init__(self, client, release_script, key: str, local: threading.Lock,
+                 ttl: float, timeout: float, poll: float = 0.01):
+        self._client = client
+        self._release_script = release_script
+        self.key = key
+        self._local = local
+        self.ttl = ttl
+        self.timeout = timeout
+        self.poll = poll
+        self._token: Optional[str] = None
+
+    def acquire(self) -> bool:
+        if not self._local.acquire(timeout=self.timeout):
+            raise TimeoutError(f"Timed out waiting for {self.key}")
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        try:
+            while not self._client.set(self.key, token, nx=True, px=int(self.ttl * 1000)):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for {self.key}")
+                time.sleep(self.poll)
+        except BaseException:
+            self._local.release()
+            raise
+        self._token = token
+        return True
+
+    def release(self) -> None:
+        try:
+            self._release_script(keys=[self.key], args=[self._token])
+        finally:
+            self._token = None
+            self._local.release()
+
+    def __enter__(self) -> "RedisUserLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class RedisStateStore:
+    """LastState store shared by every worker through Redis.
+
+    Works against any Redis-protocol server, including a local one for
+    development. Entries expire after ``ttl`` seconds of inactivity and are
+    then reloaded from final_table. User locks live in Redis too, so a user's
+    state is read and written by one worker at a time.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, ttl: int = 2 * 24 * 3600, prefix: str = 'solas:last_state:',
+                 lock_stripes: int = 64, lock_ttl: float = 60.0, lock_timeout: float = 15.0,
+                 lock_prefix: str = 'solas:user_lock:'):
+        if redis is None:
+            raise RuntimeError("The redis package is required for RedisStateStore")
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock_ttl = lock_ttl
+        self.lock_timeout = lock_timeout
+        self.lock_prefix = lock_prefix
+        self._client = redis.Redis.from_url(url)
+        self._set_if_newer = self._client.register_script(_SET_IF_NEWER)
+        self._release_lock = self._client.register_script(_RELEASE_LOCK)
+        self._user_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def user_lock(self, user_id: str) -> RedisUserLock:
+        """A lock on ``user_id`` across every worker; its holder should be done
+        within ``lock_ttl`` seconds."""
+        return RedisUserLock(self._client, self._release_lock, self.lock_prefix + user_id,
+                             self._user_locks[hash(user_id) % len(self._user_locks)],
+                             self.lock_ttl, self.lock_timeout)
+
+    def get(self, user_id: str) -> Optional[LastState]:
+        raw = self._client.hget(self.prefix + user_id, 'state')
+        with self._lock:
+            if raw is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        values = json.loads(raw)
+        return LastState(datetime.fromisoformat(values[0]), *values[1:])
+
+    def set(self, user_id: str, state: LastState) -> None:
+        # ISO timestamps sort lexically in time order, which the script relies on
+        stamp = state.time.isoformat(timespec='microseconds')
+        payload = json.dumps([stamp, *state[1:]])
+        self._set_if_newer(keys=[self.prefix + user_id], args=[stamp, payload, self.ttl])
+
+    def invalidate(self, user_id: str) -> None:
+        self._client.delete(self.prefix + user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "redis",
+                "hits": self._hits,
+                "misses": self._misses,
+            }
@@ -0,0 +1,254 @@
+"""Server-side weather lookups for location pings.
+
+Pings within a few kilometres of each other get the same weather, so
+lookups are cached per geohash cell for ``ttl`` seconds and the provider is
+asked for the cell's centre, not the user's exact position. When several
+requests miss on the same cell at once only one of them calls the
+provider; the rest wait for its answer. Sunrise and sunset need no lookup,
+app.resolve_sun_times works them out from the position (solar.py).
+
+Providers implement ``current(latitude, longitude) -> Conditions``:
+WeatherApiProvider calls weatherapi.com, StubWeatherProvider makes up
+plausible, deterministic conditions for local runs and tests.
+"""
+import hashlib
+import json
+import math
+import threading
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from solar import sun_elevation
+
+_GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+class Conditions(NamedTuple):
+    weather: str
+    temperature: Optional[float]
+    uv: Optional[float]
+
+
+def geohash(latitude: float, longitude: float, precision: int) -> str:
+    """The ``precision``-character geohash of a position (5 is ~4.9 km square)."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        span, coordinate = (lon_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def geohash_centre(cell: str) -> Tuple[float, float]:
+    """(latitude, longitude) of the middle of a geohash cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = _GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            span = lon_range if even else lat_range
+            middle = (span[0] + span[1]) / 2
+            if value >> shift & 1:
+                span[0] = middle
+            else:
+                span[1] = middle
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+class WeatherApiProvider:
+    """Current conditions from weatherapi.com."""
+
+    URL = 'https://api.weatherapi.com/v1/current.json'
+
+    def __init__(self, api_key: str, timeout: float = 3.0):
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def current(self, latitude: float, longitude: float) -> Conditions:
+        query = urlencode({'key': self.api_key, 'q': f"{latitude:.4f},{longitude:.4f}"})
+        with urlopen(f"{self.URL}?{query}", timeout=self.timeout) as response:
+            current = json.load(response)['current']
+        return Conditions(current['condition']['text'], current.get('temp_c'), current.get('uv'))
+
+
+class StubWeatherProvider:
+    """Made-up conditions, the same for a given place and hour, with a UV
+    index that follows the sun. Never use it where the data is kept."""
+
+    CONDITIONS = ('Sunny', 'Partly cloudy', 'Cloudy', 'Overcast', 'Light rain', 'Mist')
+
+    def __init__(self):
+        self.calls = 0
+
+    def current(self, latitude: float, longitude: float) -> Conditions:
+        self.calls += 1
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        seed = f"{latitude:.3f},{longitude:.3f},{now:%Y%m%d%H}".encode('utf-8')
+        pick = int.from_bytes(hashlib.blake2b(seed, digest_size=4).digest(), 'big')
+        elevation = sun_elevation(latitude, longitude, now, 0)
+        weather = self.CONDITIONS[pick % len(self.CONDITIONS)] if elevation > 0 else 'Clear'
+        uv = round(max(0.0, 11 * math.sin(math.radians(elevation))), 1) if elevation > 0 else 0.0
+        temperature = round(25 - abs(latitude) * 0.3 + (pick >> 8) % 7 - 3, 1)
+        return Conditions(weather, temperature, uv)
+
+
+def make_provider(name: Optional[str], api_key: Optional[str] = None, timeout: float = 3.0):
+    """The provider called ``name`` ('weatherapi' or 'stub'); None turns lookups off."""
+    if name is None:
+        return None
+    if name == 'weatherapi':
+        if not api_key:
+            raise ValueError("the weatherapi provider needs an API key")
+        return WeatherApiProvider(api_key, timeout)
+    if name == 'stub':
+        return StubWeatherProvider()
+    raise ValueError(f"unknown weather provider {name!r}")
+
+
+class _Entry(NamedTuple):
+    conditions: Optional[Conditions]  # None: the lookup failed
+    expires: float
+
+
+class WeatherCache:
+    """TTL cache of provider lookups per geohash cell, with concurrent misses
+    on a cell coalesced into one provider call.
+
+    A failed lookup is remembered for ``error_ttl`` seconds so a provider
+    outage isn't hit once per ping; meanwhile the cell's last good answer is
+    served if it's less than ``stale_ttl`` seconds past its expiry.
+    """
+
+    def __init__(self, provider, precision: int = 5, ttl: float = 600,
+                 error_ttl: float = 60, stale_ttl: float = 3600, max_entries: int = 50000):
+        self.provider = provider
+        self.precision = precision
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries: Dict[str, _Entry] = {}
+        self._last_good: Dict[str, _Entry] = {}
+        self._inflight: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._provider_calls = 0
+        self._errors = 0
+        self._stale_served = 0
+
+    def cached(self, latitude: float, longitude: float) -> Tuple[bool, Optional[Conditions]]:
+        """(found, conditions) for the position's cell without calling the
+        provider; lets async callers skip a thread hop on a hit."""
+        cell = geohash(latitude, longitude, self.precision)
+        with self._lock:
+            entry = self._entries.get(cell)
+            if entry is None or entry.expires <= monotonic():
+                return False, None
+            self._hits += 1
+            return True, self._usable(cell, entry)
+
+    def get(self, latitude: float, longitude: float) -> Optional[Conditions]:
+        """Conditions at the position's cell, or None if they can't be had."""
+        cell = geohash(latitude, longitude, self.precision)
+        waited = False
+        while True:
+            with self._lock:
+                entry = self._entries.get(cell)
+                if entry is not None and entry.expires > monotonic():
+                    if not waited:
+                        self._hits += 1
+                    return self._usable(cell, entry)
+                pending = self._inflight.get(cell)
+                if pending is None:
+                    self._misses += 1
+                    pending = self._inflight[cell] = threading.Event()
+                    break
+                if not waited:
+                    self._coalesced += 1
+                    waited = True
+            # Someone else is fetching this cell; their answer will be cached
+            if not pending.wait(self.error_ttl):
+                return None
+
+        try:
+            return self._fetch(cell)
+        finally:
+            with self._lock:
+                del self._inflight[cell]
+            pending.set()
+
+    def _fetch(self, cell: str) -> Optional[Conditions]:
+        latitude, longitude = geohash_centre(cell)
+        try:
+            with self._lock:
+                self._provider_calls += 1
+            conditions = self.provider.current(latitude, longitude)
+            entry = _Entry(conditions, monotonic() + self.ttl)
+        except Exception as e:
+            print(f"Error fetching weather for {cell}: {str(e)}")
+            conditions = None
+            entry = _Entry(None, monotonic() + self.error_ttl)
+        with self._lock:
+            if conditions is None:
+                self._errors += 1
+            else:
+                self._last_good[cell] = entry
+            if len(self._entries) >= self.max_entries:
+                self._evict()
+            self._entries[cell] = entry
+            return self._usable(cell, entry)
+
+    def _usable(self, cell: str, entry: _Entry) -> Optional[Conditions]:
+        if entry.conditions is not None:
+            return entry.conditions
+        last = self._last_good.get(cell)
+        if last is not None and last.expires + self.stale_ttl > monotonic():
+            self._stale_served += 1
+            return last.conditions
+        return None
+
+    def _evict(self) -> None:
+        now = monotonic()
+        for cell in [cell for cell, entry in self._entries.items() if entry.expires <= now]:
+            del self._entries[cell]
+        for cell in [cell for cell, entry in self._last_good.items()
+                     if entry.expires + self.stale_ttl <= now]:
+            del self._last_good[cell]
+        if len(self._entries) >= self.max_entries:
+            # All still fresh: start over rather than track recency per cell
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses + self._coalesced
+            return {
+                "provider": type(self.provider).__name__,
+                "cells": len(self._entries),
+                "precision": self.precision,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "hit_rate": round((self._hits + self._coalesced) / lookups, 4) if lookups else 0.0,
+                "provider_calls": self._provider_calls,
+                "errors": self._errors,
+                "stale_served": self._stale_served,
+            }
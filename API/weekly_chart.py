@@ -0,0 +1,87 @@
+from io import BytesIO
+from time import perf_counter
+from typing import List
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from daily_chart import RASTER_SAVE_OPTIONS, chart_style
+from metrics import record_span, span
+
+
+def render_weekly_chart(day_names: List[str], minutes: List[float],
+                        fmt: str = 'png', dpi: int = 120) -> bytes:
+    """Draw the bar chart (one bar per label) and return it encoded as ``fmt``."""
+    # Seven bars fit the original 10x6 figure; longer ranges grow downwards
+    height = max(6, 0.25 * len(day_names) + 1.5)
+    with chart_style('dark_background'):
+        started = perf_counter()
+        fig = Figure(figsize=(10, height), facecolor='#1a1a1a')
+        FigureCanvasAgg(fig)
+        fig.patch.set_edgecolor('#FFA500')
+        fig.patch.set_linewidth(2)
+
+        ax = fig.add_subplot(111, facecolor='#2a2a2a')
+
+        bars = ax.barh(
+            day_names,
+            minutes, 
+            height=0.7, 
+            color='#FFA500', 
+            alpha=0.9,
+            zorder=2
+        )
+
+        ax.set_xlabel('Minutes Outside', 
+                     color='#FFA500', 
+                     fontsize=12, 
+                     labelpad=10)
+
+        x_max = max(max(minutes) * 1.2, 60)
+        ax.set_xlim(0, x_max)
+
+        ax.tick_params(axis='y', colors='#FFA500', labelsize=12, pad=5)
+        ax.tick_params(axis='x', colors='#FFA500', labelsize=11)
+
+        ax.grid(color='#FFA50033', linestyle='--', linewidth=0.8, alpha=0.5, zorder=1, axis='x')
+        ax.axvline(0, color='#FFA500', linestyle='-', linewidth=1.5, zorder=2)
+
+        goal_minutes = 45
+        ax.axvline(goal_minutes, color='#FFA500', linestyle=':', linewidth=2.5, alpha=0.7, zorder=3)
+        ax.text(goal_minutes + 2, len(day_names) - 0.5, 
+                'Daily Goal: 45 mins', 
+                color='#FFA500', fontsize=11, va='center')
+
+        for spine in ax.spines.values():
+            spine.set_visible(False)
+
+        for bar in bars:
+            width = bar.get_width()
+            label_x = width + (x_max * 0.02)
+            ax.text(label_x, bar.get_y() + bar.get_height()/2,
+                   f'{int(width)} min',
+                   ha='left', va='center',
+                   color='#FFA500', fontsize=11, weight='bold')
+
+            if width >= goal_minutes:
+                check_x = width * 0.95
+                ax.text(check_x, bar.get_y() + bar.get_height()/2,
+                       '✓', 
+                       ha='center', va='center',
+                       color='#FFFFFF', fontsize=14, weight='bold')
+
+        fig.tight_layout(pad=2)
+        record_span('figure_build', perf_counter() - started)
+
+        save_options = {}
+        if fmt in RASTER_SAVE_OPTIONS:
+            save_options['pil_kwargs'] = RASTER_SAVE_OPTIONS[fmt]
+
+        buf = BytesIO()
+        with span('savefig'):
+            fig.savefig(buf, format=fmt, dpi=dpi, bbox_inches='tight',
+                        facecolor=fig.get_facecolor(), edgecolor=fig.get_edgecolor(),
+                        **save_options)
+    return buf.getvalue()
@@ -4,6 +4,7 @@ import ParallaxScrollView from '@/components/ParallaxScrollView';
 import { ThemedText } from '@/components/ThemedText';
 import { ThemedView } from '@/components/ThemedView';
 import { useLocation } from '@/hooks/useLocation';
+import { fetchJsonWithETag } from '@/utils/conditionalFetch';
 
 interface DailyData {
   day: string;
@@ -60,24 +61,12 @@ export default function WeeklyGraphScreen() {
       
       const deviceTime = formatTimeForDatabase(new Date());
       
-      const response = await fetch('http://16.170.231.125:5000/weekly-time-outside-graph', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          user_id,
-          sunrise,
-          sunset,
-          device_time: deviceTime
-        }),
+      const data = await fetchJsonWithETag('http://16.170.231.125:5000/weekly-time-outside-graph', {
+        user_id,
+        sunrise,
+        sunset,
+        device_time: deviceTime
       });
-
-      if (!response.ok) {
-        throw new Error('Failed to fetch weekly visualization');
-      }
-
-      const data = await response.json();
       setWeeklyGraph(data.image);
       
       if (data.days && data.seconds) {
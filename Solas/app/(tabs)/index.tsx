@@ -6,6 +6,7 @@ import { ThemedView } from '@/components/ThemedView';
 import { useLocation } from '@/hooks/useLocation';
 import { startBackgroundTracking, stopBackgroundTracking } from '@/services/backgroundTask';
 import { formatTimeForDatabase } from '@/utils/timeUtils';
+import { fetchJsonWithETag } from '@/utils/conditionalFetch';
 
 export default function HomeScreen() {
   const {
@@ -15,8 +16,8 @@ export default function HomeScreen() {
     error,
     isConnectedToWifi,
     user_id,
-    sunrise,
-    sunset,
+    latitude,
+    longitude,
     fetchLocation,
   } = useLocation();
 
@@ -28,40 +29,32 @@ export default function HomeScreen() {
 
   // Memoized function to fetch daily visualization
   const fetchDailyVisualisation = useCallback(async () => {
-    if (!user_id || !sunrise || !sunset) return;
+    if (!user_id || latitude === null || longitude === null) return;
     
     try {
-      const response = await fetch('http://16.170.231.125:5000/daily-visualisation', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          user_id,
-          sunrise,
-          sunset,
-          device_time: formatTimeForDatabase(new Date())
-        }),
+      // The server works out sunrise/sunset from the position, the same
+      // way it does for pre-rendered charts, so those can be served as is.
+      // Sent as a GET so an unchanged chart comes back as a bodiless 304
+      const data = await fetchJsonWithETag('http://16.170.231.125:5000/daily-visualisation', {
+        user_id,
+        latitude,
+        longitude,
+        utc_offset: -new Date().getTimezoneOffset(),
+        device_time: formatTimeForDatabase(new Date())
       });
-
-      if (!response.ok) {
-        throw new Error('Failed to fetch daily visualization');
-      }
-
-      const data = await response.json();
       setDailyVisualisation(data.image);
     } catch (error) {
       console.error('Error fetching daily visualization:', error);
     }
-  }, [user_id, sunrise, sunset]);
+  }, [user_id, latitude, longitude]);
 
   // Initial load of daily visualization (only once)
   useEffect(() => {
-    if (!initialLoadComplete && user_id && sunrise && sunset) {
+    if (!initialLoadComplete && user_id && latitude !== null && longitude !== null) {
       fetchDailyVisualisation();
       setInitialLoadComplete(true);
     }
-  }, [user_id, sunrise, sunset, initialLoadComplete, fetchDailyVisualisation]);
+  }, [user_id, latitude, longitude, initialLoadComplete, fetchDailyVisualisation]);
 
   // Start background tracking when the app loads
   useEffect(() => {
@@ -110,6 +103,7 @@ export default function HomeScreen() {
           user_id: user_id,
           correct_result: correctResult,
           gps_accuracy: accuracy,
+          is_connected_to_wifi: isConnectedToWifi,
           device_time: formatTimeForDatabase(new Date())
         }),
       });
@@ -1,9 +1,8 @@
 import { useEffect, useState } from 'react';
 import * as Location from 'expo-location';
 import NetInfo from '@react-native-community/netinfo';
-import { fetchWeatherData, fetchAstroData } from '@/services/weatherService';
 import { generateAndStoreUserId } from '@/services/userService';
-import { convertTo24HourFormat, formatTimeForDatabase } from '@/utils/timeUtils';
+import { formatTimeForDatabase } from '@/utils/timeUtils';
 
 export const useLocation = () => {
   const [isOutside, setIsOutside] = useState<boolean | null>(null);
@@ -17,6 +16,8 @@ export const useLocation = () => {
   const [uv, setUv] = useState<number | null>(null);
   const [sunrise, setSunrise] = useState<string | null>(null);
   const [sunset, setSunset] = useState<string | null>(null);
+  const [latitude, setLatitude] = useState<number | null>(null);
+  const [longitude, setLongitude] = useState<number | null>(null);
 
 
   const fetchLocation = async () => {
@@ -37,16 +38,11 @@ export const useLocation = () => {
 
       const location = await Location.getCurrentPositionAsync({ accuracy: Location.Accuracy.BestForNavigation });
       setAccuracy(location.coords.accuracy);
+      setLatitude(location.coords.latitude);
+      setLongitude(location.coords.longitude);
 
-      const weatherData = await fetchWeatherData(location.coords.latitude, location.coords.longitude);
-      setWeather(weatherData.current.condition.text);
-      setTemperature(weatherData.current.temp_c);
-      setUv(weatherData.current.uv);
-
-      const astroData = await fetchAstroData(location.coords.latitude, location.coords.longitude);
-      setSunrise(convertTo24HourFormat(astroData.astronomy.astro.sunrise));
-      setSunset(convertTo24HourFormat(astroData.astronomy.astro.sunset));
-
+      // The server fills in the weather and sun times for the position and
+      // sends them back
       const response = await fetch('http://16.170.231.125:5000/check-location', {
         method: 'POST',
         headers: {
@@ -56,11 +52,9 @@ export const useLocation = () => {
           gps_accuracy: location.coords.accuracy,
           user_id,
           is_connected_to_wifi: connectedToWifi,
-          weather: weatherData.current.condition.text,
-          temperature: weatherData.current.temp_c,
-          uv: weatherData.current.uv,
-          sunrise: convertTo24HourFormat(astroData.astronomy.astro.sunrise),
-          sunset: convertTo24HourFormat(astroData.astronomy.astro.sunset),
+          latitude: location.coords.latitude,
+          longitude: location.coords.longitude,
+          utc_offset: -new Date().getTimezoneOffset(),
           device_time: formatTimeForDatabase(new Date())
         }),
       });
@@ -71,6 +65,11 @@ export const useLocation = () => {
 
       const data = await response.json();
       setIsOutside(data.is_outside);
+      setWeather(data.weather);
+      setTemperature(data.temperature);
+      setUv(data.uv);
+      setSunrise(data.sunrise);
+      setSunset(data.sunset);
     } catch (error) {
       console.error('Error fetching location:', error);
       setError('Failed to determine location status');
@@ -104,6 +103,8 @@ export const useLocation = () => {
     uv,
     sunrise,
     sunset,
+    latitude,
+    longitude,
     fetchLocation, 
   };
 };
\ No newline at end of file
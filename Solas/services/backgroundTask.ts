@@ -2,12 +2,38 @@ import * as TaskManager from 'expo-task-manager';
 import * as Location from 'expo-location';
 import NetInfo from '@react-native-community/netinfo';
 import * as SecureStore from 'expo-secure-store';
-import { fetchWeatherData, fetchAstroData } from './weatherService';
-import { convertTo24HourFormat, formatTimeForDatabase } from '@/utils/timeUtils';
+import AsyncStorage from '@react-native-async-storage/async-storage';
+import { formatTimeForDatabase } from '@/utils/timeUtils';
 
 // Define the background task name
 export const LOCATION_TASK = 'background-location-task';
 
+const API_URL = 'http://16.170.231.125:5000';
+
+// Samples that couldn't be sent are kept here and uploaded together via
+// /check-location/batch once the API is reachable again
+const PENDING_SAMPLES_KEY = 'pending_location_samples';
+const MAX_BATCH_SAMPLES = 2016; // a week of 5-minute samples, the API's limit per batch
+// Leaves room for the new sample that goes up with them
+const MAX_PENDING_SAMPLES = MAX_BATCH_SAMPLES - 1;
+
+const loadPendingSamples = async (): Promise<object[]> => {
+  const stored = await AsyncStorage.getItem(PENDING_SAMPLES_KEY);
+  // Older versions kept one more than fits in a batch
+  return stored ? JSON.parse(stored).slice(-MAX_PENDING_SAMPLES) : [];
+};
+
+// The API turned the request down as it is, so sending it again won't help
+const isRejected = (status: number) =>
+  status >= 400 && status < 500 && status !== 408 && status !== 429;
+
+const savePendingSamples = async (samples: object[]) => {
+  await AsyncStorage.setItem(
+    PENDING_SAMPLES_KEY,
+    JSON.stringify(samples.slice(-MAX_PENDING_SAMPLES))
+  );
+};
+
 
 // Define the background task
 TaskManager.defineTask(LOCATION_TASK, async () => {
@@ -23,36 +49,61 @@ TaskManager.defineTask(LOCATION_TASK, async () => {
     const netInfoState = await NetInfo.fetch();
     const connectedToWifi = netInfoState.type === 'wifi';
 
-    // Fetch weather and astronomical data
-    const weatherData = await fetchWeatherData(latitude, longitude);
-    const astroData = await fetchAstroData(latitude, longitude);
-
     // Get user ID from secure storage
     const user_id = await SecureStore.getItemAsync('user_id');
 
-    // Send data to the database
-    const response = await fetch('http://16.170.231.125:5000/check-location', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        gps_accuracy: accuracy,
-        user_id,
-        is_connected_to_wifi: connectedToWifi,
-        weather: weatherData.current.condition.text,
-        temperature: weatherData.current.temp_c,
-        uv: weatherData.current.uv,
-        sunrise: convertTo24HourFormat(astroData.astronomy.astro.sunrise),
-        sunset: convertTo24HourFormat(astroData.astronomy.astro.sunset),
-        device_time: formatTimeForDatabase(new Date())
-      }),
-    });
+    // Weather, UV, sunrise and sunset are all looked up by the server from
+    // the position, so the sample needs nothing but what the phone knows
+    const sample = {
+      gps_accuracy: accuracy,
+      is_connected_to_wifi: connectedToWifi,
+      latitude,
+      longitude,
+      utc_offset: -new Date().getTimezoneOffset(),
+      device_time: formatTimeForDatabase(new Date())
+    };
 
-    if (!response.ok) {
-      throw new Error('Failed to send location data to the database');
+    const pending = await loadPendingSamples();
+
+    try {
+      // Send data to the database, along with anything left over from
+      // earlier failed attempts
+      const response = pending.length > 0
+        ? await fetch(`${API_URL}/check-location/batch`, {
+            method: 'POST',
+            headers: {
+              'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ user_id, samples: [...pending, sample] }),
+          })
+        : await fetch(`${API_URL}/check-location`, {
+            method: 'POST',
+            headers: {
+              'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ user_id, ...sample }),
+          });
+
+      if (isRejected(response.status)) {
+        await AsyncStorage.removeItem(PENDING_SAMPLES_KEY);
+        console.error(
+          `Location data rejected with ${response.status}, dropped ${pending.length + 1} samples`
+        );
+        return;
+      }
+      if (!response.ok) {
+        throw new Error('Failed to send location data to the database');
+      }
+    } catch (error) {
+      // Keep the sample so it isn't lost while offline
+      await savePendingSamples([...pending, sample]);
+      throw error;
     }
 
+    if (pending.length > 0) {
+      await AsyncStorage.removeItem(PENDING_SAMPLES_KEY);
+      console.log(`Synced ${pending.length} buffered location samples`);
+    }
     console.log('Location data sent to the database successfully');
   } catch (error) {
     console.error('Error in background task:', error);
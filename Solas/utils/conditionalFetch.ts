@@ -0,0 +1,33 @@
+// Last ETag and parsed body seen for each chart endpoint. The server answers
+// a request carrying a still-current ETag with an empty 304 instead of
+// re-sending (and re-rendering) the chart, and we reuse what we already have.
+const lastResponses = new Map<string, { etag: string; data: any }>();
+
+export const fetchJsonWithETag = async (url: string, params: Record<string, any>): Promise<any> => {
+  const query = Object.entries(params)
+    .filter(([, value]) => value !== null && value !== undefined)
+    .map(([key, value]) => `${encodeURIComponent(key)}=${encodeURIComponent(String(value))}`)
+    .join('&');
+  // Keyed by endpoint and user: device_time changes on every call
+  const key = `${url}|${params.user_id}`;
+  const cached = lastResponses.get(key);
+
+  const response = await fetch(`${url}?${query}`, {
+    method: 'GET',
+    headers: cached ? { 'If-None-Match': cached.etag } : {},
+  });
+
+  if (response.status === 304 && cached) {
+    return cached.data;
+  }
+  if (!response.ok) {
+    throw new Error(`Request failed with status ${response.status}`);
+  }
+
+  const data = await response.json();
+  const etag = response.headers.get('ETag');
+  if (etag) {
+    lastResponses.set(key, { etag, data });
+  }
+  return data;
+};